@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 import atexit
+import contextlib
 import datetime
 import errno
 import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
+import re
 import signal
 import shutil
 import sqlite3
@@ -15,8 +19,9 @@ import sys
 import tempfile
 import threading
 import time
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from io import BytesIO
 
 import fuse
@@ -40,6 +45,19 @@ fuse.fuse_python_api = (0, 2)
 
 
 ROOT_DRIVEWSID = "FOLDER::com.apple.CloudDocs::root"
+TRASH_DRIVEWSID = "FOLDER::com.apple.CloudDocs::TRASH_ROOT"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+TRANSFER_CHUNK_SIZE = 64 * 1024
+RECONCILE_BATCH_SIZE = 1000
+LISTED_FOLDERS_LIMIT = 4096
+RECONCILED_FIELDS = ("size", "mtime", "hydrated", "local_sha256", "stat_fingerprint")
+# Warmup orderings over unhydrated files; each has a matching partial index in SyncState.
+WARMUP_ORDERS = {
+    "path": "path",
+    "smallest": "size, path",
+    "recent": "mtime DESC, path",
+    "shallowest": "length(path) - length(replace(path, '/', '')), path",
+}
 
 
 class Stat(fuse.Stat):
@@ -83,10 +101,502 @@ def sha256_file(path):
     return digest.hexdigest()
 
 
+def stat_fingerprint(stats):
+    return f"{stats.st_size}:{stats.st_mtime_ns}:{stats.st_ino}:{stats.st_ctime_ns}"
+
+
 def row_to_dict(row):
     return dict(row) if row is not None else None
 
 
+def raise_if_error(response):
+    # Mirrors DriveService._raise_if_error, which is private to pyicloud.
+    if not response.ok:
+        raise PyiCloudAPIResponseException(response.reason, response.status_code)
+
+
+def retrieve_folder_details(drive, folders):
+    # retrieveItemDetailsInFolders takes a list; pyicloud only ever sends one.
+    payload = []
+    for drivewsid, shareid in folders:
+        item = {"drivewsid": drivewsid, "partialData": False}
+        if shareid:
+            item["shareID"] = shareid
+        payload.append(item)
+    response = drive.session.post(
+        drive.service_root + "/retrieveItemDetailsInFolders",
+        params=drive.params,
+        json=payload,
+    )
+    raise_if_error(response)
+    return response.json()
+
+
+class MultipartFileBody:
+    # multipart/form-data body read from the file while requests sends it, rather
+    # than assembled in memory the way files= does.
+    def __init__(self, file_object, throttle=None):
+        boundary = uuid.uuid4().hex
+        name = os.path.basename(file_object.name).replace('"', "%22")
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}"\r\n\r\n'.encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        start = file_object.tell()
+        size = file_object.seek(0, os.SEEK_END) - start
+        file_object.seek(start)
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self.length = len(head) + size + len(tail)
+        self.parts = deque([BytesIO(head), file_object, BytesIO(tail)])
+        self.throttle = throttle
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.popleft()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        data = b"".join(chunks)
+        if self.throttle is not None:
+            self.throttle(len(data))
+        return data
+
+
+def upload_document(
+    drive, folder, file_object, replace_document_id=None, throttle=None, slot=contextlib.nullcontext, **kwargs
+):
+    # Same requests as DriveNode.upload, but the update/documents reply describing
+    # the new document is returned instead of discarded. With replace_document_id the
+    # content is committed to that existing document rather than a new one. slot()
+    # wraps the two metadata requests; the body upload between them runs outside it.
+    # The metadata requests go through DriveService's private helpers, which is why
+    # requirements.txt pins pyicloud.
+    zone = folder.get("zone") or "com.apple.CloudDocs"
+    with slot():
+        document_id, content_url = drive._get_upload_contentws_url(file_object, zone=zone)
+    body = MultipartFileBody(file_object, throttle)
+    response = drive.session.post(content_url, data=body, headers={"Content-Type": body.content_type})
+    raise_if_error(response)
+    with slot():
+        return drive._update_contentws(
+            folder["docwsid"],
+            response.json()["singleFile"],
+            replace_document_id or document_id,
+            file_object,
+            zone,
+            **kwargs,
+        )
+
+
+def compact_ops(ops):
+    # Folds the op log into the set of change kinds pending for each current path.
+    # rename_tree rewrites queued paths as entries move, so an entry's history is
+    # keyed by where it lives now and a chain of renames is a single "rename". The
+    # planner itself works from entry flags, which already absorb create/delete
+    # pairs and rename chains; this only tells it whether a dirty file's content
+    # changed or it was just moved.
+    changes = {}
+    for op in ops:
+        if op["op"] == "rename":
+            changes.setdefault(op["target_path"], set()).add("rename")
+        elif op["op"] == "delete":
+            changes[op["path"]] = {"delete"}
+        else:
+            changes.setdefault(op["path"], set()).add(op["op"])
+    return changes
+
+
+def delete_items(drive, nodes):
+    # deleteItems with every node in one request; DriveService.delete_items sends one.
+    response = drive.session.post(
+        drive.service_root + "/deleteItems",
+        params=drive.params,
+        json={
+            "items": [
+                {
+                    "drivewsid": node.data["drivewsid"],
+                    "etag": node.data["etag"],
+                    "clientId": drive.params["clientId"],
+                }
+                for node in nodes
+            ],
+        },
+    )
+    raise_if_error(response)
+    return response.json()
+
+
+def glob_to_regex(pattern):
+    # "*" and "?" stay within one path component and "**" spans any number of them.
+    # A pattern without a leading "/" may match at any depth, and a pattern naming a
+    # folder also covers everything beneath it.
+    body = pattern.strip().strip("/")
+    prefix = "/" if pattern.strip().startswith("/") else "/(?:.*/)?"
+    parts = []
+    index = 0
+    while index < len(body):
+        if body.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif body.startswith("**", index):
+            parts.append(".*")
+            index += 2
+        elif body[index] == "*":
+            parts.append("[^/]*")
+            index += 1
+        elif body[index] == "?":
+            parts.append("[^/]")
+            index += 1
+        else:
+            parts.append(re.escape(body[index]))
+            index += 1
+    return prefix + "".join(parts) + "(?:/.*)?"
+
+
+class WarmupRules:
+    # Decides which files background warmup hydrates. Each pattern list is compiled
+    # into a single regex so a path costs one match per list however many rules exist.
+    def __init__(self, include=None, exclude=None, max_file_size=0):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+        self.max_file_size = int(max_file_size or 0)
+
+    @staticmethod
+    def _compile(patterns):
+        patterns = [pattern for pattern in (patterns or []) if str(pattern).strip()]
+        if not patterns:
+            return None
+        return re.compile("|".join(f"(?:{glob_to_regex(str(pattern))})" for pattern in patterns))
+
+    def wants(self, path, size):
+        if self.max_file_size and (size or 0) > self.max_file_size:
+            return False
+        if self.include is not None and not self.include.fullmatch(path):
+            return False
+        return self.exclude is None or not self.exclude.fullmatch(path)
+
+
+class RemoteNodeCache:
+    def __init__(self, max_entries=4096):
+        self.max_entries = max(1, int(max_entries))
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, drivewsid, etag):
+        with self.lock:
+            node = self.nodes.get(drivewsid)
+            if node is None:
+                return None
+            if node.data.get("etag") != etag:
+                del self.nodes[drivewsid]
+                return None
+            self.nodes.move_to_end(drivewsid)
+            return node
+
+    def put(self, node):
+        drivewsid = node.data.get("drivewsid")
+        if not drivewsid:
+            return
+        with self.lock:
+            self.nodes[drivewsid] = node
+            self.nodes.move_to_end(drivewsid)
+            while len(self.nodes) > self.max_entries:
+                self.nodes.popitem(last=False)
+
+    def invalidate(self, drivewsid):
+        with self.lock:
+            self.nodes.pop(drivewsid, None)
+
+
+class CrawlInterrupted(RuntimeError):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, rate_per_second=0):
+        rate = float(rate_per_second or 0)
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def acquire(self, stop_event=None):
+        if self.interval <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay <= 0:
+            return True
+        if stop_event is not None:
+            return not stop_event.wait(delay)
+        time.sleep(delay)
+        return True
+
+
+class TokenBucket:
+    # Byte budget refilled at rate_per_second and holding at most BURST_SECONDS of
+    # traffic. consume() may overdraw; the caller then waits until the debt is repaid,
+    # so transfers of any chunk size average out to the configured rate.
+    BURST_SECONDS = 0.25
+
+    def __init__(self, rate_per_second=0):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.updated_at = time.monotonic()
+        self.set_rate(rate_per_second)
+
+    def _refill(self, now):
+        self.tokens = min(self.rate * self.BURST_SECONDS, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate_per_second):
+        rate = float(rate_per_second or 0)
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = max(0.0, rate)
+            self.tokens = min(self.tokens, self.rate * self.BURST_SECONDS) if self.rate else 0.0
+
+    def consume(self, amount, stop_event=None):
+        with self.lock:
+            if self.rate <= 0:
+                return True
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay <= 0:
+            return True
+        if stop_event is not None:
+            return not stop_event.wait(delay)
+        time.sleep(delay)
+        return True
+
+
+class SessionPool:
+    # Authenticated PyiCloudService instances, each with its own HTTP connection
+    # pool. A transfer checks one out for its whole length, body included, so no two
+    # transfers share a session. Checkouts go highest priority first, and with more
+    # than one session the last idle one is kept for interactive hydration, so an
+    # open() never waits for a throttled upload or warmup to finish. A shared pool
+    # hands its one session to every caller at once.
+    def __init__(self, services, shared=False):
+        self.services = list(services)
+        self.shared = shared
+        self.idle = deque(self.services)
+        self.reserved = 1 if len(self.services) > 1 else 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.services)
+
+    @contextlib.contextmanager
+    def checkout(self, priority="warmup"):
+        if self.shared:
+            yield self.services[0]
+            return
+        rank = RequestBroker.PRIORITIES[priority]
+        reserved = 0 if rank == RequestBroker.PRIORITIES["interactive"] else self.reserved
+        ticket = (rank, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while self.waiting[0] != ticket or len(self.idle) <= reserved:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            service = self.idle.popleft()
+            self.condition.notify_all()
+        try:
+            yield service
+        finally:
+            with self.condition:
+                self.idle.append(service)
+                self.condition.notify_all()
+
+
+class LazySession:
+    # Stands in for a transfer session and opens it the first time a transfer uses
+    # it, so sessions that are never needed never sign in. Until then, or if it
+    # cannot be opened, the fallback service is used instead.
+    def __init__(self, opener, fallback, logger):
+        self.opener = opener
+        self.fallback = fallback
+        self.logger = logger
+        self.service = None
+        self.lock = threading.Lock()
+
+    @property
+    def drive(self):
+        with self.lock:
+            if self.service is None:
+                try:
+                    self.service = self.opener()
+                except Exception as exc:
+                    self.logger.warning("Failed to open transfer session; using the main session: %s", exc)
+                    self.service = self.fallback
+        return self.service.drive
+
+
+THROTTLE_STATUS_CODES = {"421", "429", "450", "503"}
+
+
+# Answers to an in-place replace that refuse that document rather than the request.
+REPLACE_REJECTED_STATUS_CODES = {"400", "404", "409", "412"}
+
+
+def response_status(exc):
+    code = getattr(exc, "code", None)
+    response = getattr(exc, "response", None)
+    if code is None and response is not None:
+        code = response.status_code
+    return str(code)
+
+
+def is_throttle_error(exc):
+    return response_status(exc) in THROTTLE_STATUS_CODES
+
+
+def is_replace_rejected(exc):
+    return response_status(exc) in REPLACE_REJECTED_STATUS_CODES
+
+
+class DelayScheduler:
+    # Runs callbacks after a delay from one thread and a min-heap of (due, sequence,
+    # key) rather than a sleeping Timer thread per key. Rescheduling or cancelling a
+    # key leaves its old heap entry behind; it is skipped when it reaches the top.
+    # Each pending key can carry data for its owner, such as a retry attempt count.
+    def __init__(self, logger, name="delay-scheduler"):
+        self.logger = logger
+        self.name = name
+        self.heap = []
+        self.pending = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+    def schedule(self, key, delay_seconds, callback, data=None):
+        with self.condition:
+            if self.stopped:
+                return False
+            sequence = next(self.sequence)
+            self.pending[key] = (sequence, callback, data)
+            heapq.heappush(self.heap, (time.monotonic() + delay_seconds, sequence, key))
+            if len(self.heap) > 2 * len(self.pending) + 64:
+                # Keys rescheduled before they came due would otherwise pile up stale entries.
+                self.heap = [item for item in self.heap if self.pending.get(item[2], (None,))[0] == item[1]]
+                heapq.heapify(self.heap)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return True
+
+    def cancel(self, key):
+        return self.pop(key) is not None
+
+    def pop(self, key):
+        # Cancels the key and returns its (callback, data), or None if it was not pending.
+        with self.condition:
+            entry = self.pending.pop(key, None)
+        return entry[1:] if entry is not None else None
+
+    def keys(self):
+        with self.condition:
+            return list(self.pending)
+
+    def shutdown(self, timeout=1):
+        with self.condition:
+            self.stopped = True
+            self.pending.clear()
+            self.heap.clear()
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                callback = None
+                while callback is None and not self.stopped:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    due, sequence, key = self.heap[0]
+                    current = self.pending.get(key)
+                    if current is None or current[0] != sequence:
+                        heapq.heappop(self.heap)
+                        continue
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+                    heapq.heappop(self.heap)
+                    callback = self.pending.pop(key)[1]
+                if self.stopped:
+                    return
+            try:
+                callback()
+            except Exception as exc:
+                self.logger.error("Delayed callback for %s failed: %s", key, exc)
+
+
+class RequestBroker:
+    PRIORITIES = {"interactive": 0, "upload": 1, "crawl": 2, "warmup": 3}
+
+    # Admits remote requests highest priority first (FIFO within a class). The
+    # concurrency limit grows by one per limit's worth of successful requests and
+    # halves when iCloud answers with a throttling status; requests that were
+    # already in flight when it halved cannot halve it again.
+    def __init__(self, initial_limit=4, max_limit=32):
+        self.max_limit = max(1, int(max_limit))
+        self.limit = float(min(max(1, int(initial_limit)), self.max_limit))
+        self.decreases = 0
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, priority):
+        ticket = (self.PRIORITIES[priority], next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while self.waiting[0] != ticket or self.in_flight >= int(self.limit):
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.in_flight += 1
+            admitted_after = self.decreases
+            self.condition.notify_all()
+        throttled = False
+        try:
+            yield
+        except Exception as exc:
+            throttled = is_throttle_error(exc)
+            raise
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                if not throttled:
+                    self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                elif admitted_after == self.decreases:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreases += 1
+                self.condition.notify_all()
+
+
 class SyncState:
     def __init__(self, db_path):
         self.db_path = db_path
@@ -131,6 +641,52 @@ class SyncState:
                     retry_count INTEGER NOT NULL DEFAULT 0,
                     last_error TEXT
                 );
+                CREATE TABLE IF NOT EXISTS crawl_staging (
+                    remote_drivewsid TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    parent_path TEXT NOT NULL,
+                    remote_docwsid TEXT,
+                    remote_etag TEXT,
+                    remote_zone TEXT,
+                    remote_shareid TEXT,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    mtime INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_entries_parent_path
+                    ON entries(parent_path);
+                CREATE TABLE IF NOT EXISTS folder_refresh (
+                    path TEXT PRIMARY KEY,
+                    interval_seconds REAL NOT NULL,
+                    next_refresh_at REAL NOT NULL,
+                    last_listed_at REAL,
+                    last_changed_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_folder_refresh_due
+                    ON folder_refresh(next_refresh_at);
+                CREATE TABLE IF NOT EXISTS upload_failures (
+                    path TEXT PRIMARY KEY,
+                    attempts INTEGER NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    size INTEGER,
+                    mtime INTEGER,
+                    last_error TEXT
+                );
+                CREATE TABLE IF NOT EXISTS partial_downloads (
+                    path TEXT PRIMARY KEY,
+                    remote_etag TEXT,
+                    tmp_path TEXT NOT NULL,
+                    bytes_received INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS crawl_frontier (
+                    remote_drivewsid TEXT PRIMARY KEY,
+                    remote_shareid TEXT,
+                    path TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS crawl_failures (
+                    path TEXT PRIMARY KEY
+                );
                 """
             )
             columns = {
@@ -139,38 +695,37 @@ class SyncState:
             }
             if "remote_shareid" not in columns:
                 self.conn.execute("ALTER TABLE entries ADD COLUMN remote_shareid TEXT")
+            if "stat_fingerprint" not in columns:
+                # local_sha256 is trusted without re-hashing while the file's stat still matches.
+                self.conn.execute("ALTER TABLE entries ADD COLUMN stat_fingerprint TEXT")
+            for name, order in WARMUP_ORDERS.items():
+                self.conn.execute(
+                    f"""
+                    CREATE INDEX IF NOT EXISTS idx_entries_warmup_{name}
+                        ON entries({order})
+                        WHERE type = 'file' AND tombstone = 0 AND hydrated = 0
+                    """
+                )
             self.conn.commit()
 
     def upsert_entry(self, entry):
-        payload = {
-            "path": entry["path"],
-            "type": entry["type"],
-            "parent_path": entry["parent_path"],
-            "remote_drivewsid": entry.get("remote_drivewsid"),
-            "remote_docwsid": entry.get("remote_docwsid"),
-            "remote_etag": entry.get("remote_etag"),
-            "remote_zone": entry.get("remote_zone"),
-            "remote_shareid": self._encode_shareid(entry.get("remote_shareid")),
-            "size": int(entry.get("size", 0) or 0),
-            "mtime": int(entry.get("mtime", 0) or 0),
-            "hydrated": int(bool(entry.get("hydrated", False))),
-            "dirty": int(bool(entry.get("dirty", False))),
-            "tombstone": int(bool(entry.get("tombstone", False))),
-            "local_sha256": entry.get("local_sha256"),
-            "last_synced_at": entry.get("last_synced_at"),
-            "synced_path": entry.get("synced_path", entry["path"]),
-        }
+        self.upsert_entries([entry])
+
+    def upsert_entries(self, entries):
+        payloads = [self._entry_payload(entry) for entry in entries]
+        if not payloads:
+            return
         with self.lock:
-            self.conn.execute(
+            self.conn.executemany(
                 """
                 INSERT INTO entries (
                     path, type, parent_path, remote_drivewsid, remote_docwsid, remote_etag,
                     remote_zone, remote_shareid, size, mtime, hydrated, dirty, tombstone, local_sha256,
-                    last_synced_at, synced_path
+                    last_synced_at, synced_path, stat_fingerprint
                 ) VALUES (
                     :path, :type, :parent_path, :remote_drivewsid, :remote_docwsid, :remote_etag,
                     :remote_zone, :remote_shareid, :size, :mtime, :hydrated, :dirty, :tombstone, :local_sha256,
-                    :last_synced_at, :synced_path
+                    :last_synced_at, :synced_path, :stat_fingerprint
                 )
                 ON CONFLICT(path) DO UPDATE SET
                     type = excluded.type,
@@ -187,11 +742,77 @@ class SyncState:
                     tombstone = excluded.tombstone,
                     local_sha256 = excluded.local_sha256,
                     last_synced_at = excluded.last_synced_at,
-                    synced_path = excluded.synced_path
+                    synced_path = excluded.synced_path,
+                    stat_fingerprint = excluded.stat_fingerprint
+                """,
+                payloads,
+            )
+            self.conn.commit()
+
+    def update_reconciled(self, pairs):
+        # Each row is only rewritten if it still matches the snapshot it was reconciled
+        # from, so filesystem changes made while reconciliation ran are never clobbered.
+        if not pairs:
+            return 0
+        with self.lock:
+            cursor = self.conn.executemany(
+                """
+                UPDATE entries
+                SET size = :size,
+                    mtime = :mtime,
+                    hydrated = :hydrated,
+                    local_sha256 = :local_sha256,
+                    stat_fingerprint = :stat_fingerprint
+                WHERE path = :path
+                    AND size = :was_size
+                    AND mtime = :was_mtime
+                    AND hydrated = :was_hydrated
+                    AND dirty = :was_dirty
+                    AND tombstone = 0
+                    AND local_sha256 IS :was_local_sha256
+                    AND stat_fingerprint IS :was_stat_fingerprint
                 """,
-                payload,
+                [
+                    {
+                        "path": reconciled["path"],
+                        "size": reconciled["size"],
+                        "mtime": reconciled["mtime"],
+                        "hydrated": int(bool(reconciled["hydrated"])),
+                        "local_sha256": reconciled.get("local_sha256"),
+                        "stat_fingerprint": reconciled.get("stat_fingerprint"),
+                        "was_size": original["size"],
+                        "was_mtime": original["mtime"],
+                        "was_hydrated": original["hydrated"],
+                        "was_dirty": original["dirty"],
+                        "was_local_sha256": original.get("local_sha256"),
+                        "was_stat_fingerprint": original.get("stat_fingerprint"),
+                    }
+                    for reconciled, original in pairs
+                ],
             )
             self.conn.commit()
+        return cursor.rowcount
+
+    def _entry_payload(self, entry):
+        return {
+            "path": entry["path"],
+            "type": entry["type"],
+            "parent_path": entry["parent_path"],
+            "remote_drivewsid": entry.get("remote_drivewsid"),
+            "remote_docwsid": entry.get("remote_docwsid"),
+            "remote_etag": entry.get("remote_etag"),
+            "remote_zone": entry.get("remote_zone"),
+            "remote_shareid": self._encode_shareid(entry.get("remote_shareid")),
+            "size": int(entry.get("size", 0) or 0),
+            "mtime": int(entry.get("mtime", 0) or 0),
+            "hydrated": int(bool(entry.get("hydrated", False))),
+            "dirty": int(bool(entry.get("dirty", False))),
+            "tombstone": int(bool(entry.get("tombstone", False))),
+            "local_sha256": entry.get("local_sha256"),
+            "last_synced_at": entry.get("last_synced_at"),
+            "synced_path": entry.get("synced_path", entry["path"]),
+            "stat_fingerprint": entry.get("stat_fingerprint"),
+        }
 
     def get_entry(self, path):
         with self.lock:
@@ -219,16 +840,27 @@ class SyncState:
             row = self.conn.execute("SELECT COUNT(*) AS count FROM entries").fetchone()
         return int(row["count"])
 
+    def list_children(self, parent_path):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM entries WHERE parent_path = ? AND path != ? ORDER BY path",
+                (parent_path, parent_path),
+            ).fetchall()
+        return [self._decode_entry(dict(row)) for row in rows]
+
     def list_unhydrated_paths(self):
+        return [path for path, _ in self.list_warmup_files()]
+
+    def list_warmup_files(self, order="path"):
         with self.lock:
             rows = self.conn.execute(
-                """
-                SELECT path FROM entries
+                f"""
+                SELECT path, size FROM entries
                 WHERE type = 'file' AND tombstone = 0 AND hydrated = 0
-                ORDER BY path
+                ORDER BY {WARMUP_ORDERS[order]}
                 """
             ).fetchall()
-        return [row["path"] for row in rows]
+        return [(row["path"], row["size"]) for row in rows]
 
     def list_dirty_entries(self):
         with self.lock:
@@ -241,7 +873,12 @@ class SyncState:
             ).fetchall()
         return [self._decode_entry(dict(row)) for row in rows]
 
-    def mark_hydrated(self, path, local_sha256=None, size=None, mtime=None):
+    def has_dirty_entries(self):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM entries WHERE dirty = 1 OR tombstone = 1 LIMIT 1").fetchone()
+        return row is not None
+
+    def mark_hydrated(self, path, local_sha256=None, size=None, mtime=None, fingerprint=None):
         with self.lock:
             self.conn.execute(
                 """
@@ -249,10 +886,11 @@ class SyncState:
                 SET hydrated = 1,
                     local_sha256 = COALESCE(?, local_sha256),
                     size = COALESCE(?, size),
-                    mtime = COALESCE(?, mtime)
+                    mtime = COALESCE(?, mtime),
+                    stat_fingerprint = ?
                 WHERE path = ?
                 """,
-                (local_sha256, size, mtime, path),
+                (local_sha256, size, mtime, fingerprint, path),
             )
             self.conn.commit()
 
@@ -325,6 +963,7 @@ class SyncState:
                 "DELETE FROM pending_ops WHERE path = ? OR target_path = ?",
                 (path, path),
             )
+            self.conn.execute("DELETE FROM upload_failures WHERE path = ?", (path,))
             self.conn.commit()
 
     def remove_entry(self, path):
@@ -334,6 +973,8 @@ class SyncState:
                 "DELETE FROM pending_ops WHERE path = ? OR target_path = ?",
                 (path, path),
             )
+            self.conn.execute("DELETE FROM upload_failures WHERE path = ?", (path,))
+            self._delete_partial_downloads("path = ?", (path,))
             self.conn.commit()
 
     def remove_subtree(self, path):
@@ -347,8 +988,21 @@ class SyncState:
                 "DELETE FROM pending_ops WHERE path = ? OR path LIKE ? OR target_path = ? OR target_path LIKE ?",
                 (path, prefix + "%", path, prefix + "%"),
             )
+            self.conn.execute(
+                "DELETE FROM upload_failures WHERE path = ? OR path LIKE ?",
+                (path, prefix + "%"),
+            )
+            self._delete_partial_downloads("path = ? OR path LIKE ?", (path, prefix + "%"))
             self.conn.commit()
 
+    def _delete_partial_downloads(self, condition, params):
+        # The rows own their tmp files, so the files go with them.
+        rows = self.conn.execute(f"SELECT tmp_path FROM partial_downloads WHERE {condition}", params).fetchall()
+        self.conn.execute(f"DELETE FROM partial_downloads WHERE {condition}", params)
+        for row in rows:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(row["tmp_path"])
+
     def rename_tree(self, oldpath, newpath, root_dirty=True, update_synced=False):
         entries = self._fetch_subtree(oldpath)
         if not entries:
@@ -415,30 +1069,109 @@ class SyncState:
                     len(prefix) + 1,
                 ),
             )
+            self.conn.execute(
+                """
+                UPDATE OR REPLACE upload_failures
+                SET path = CASE
+                    WHEN path = ? THEN ?
+                    ELSE ? || substr(path, ?)
+                END
+                WHERE path = ? OR path LIKE ?
+                """,
+                (oldpath, newpath, newpath.rstrip("/") + "/", len(prefix) + 1, oldpath, prefix + "%"),
+            )
+            self.conn.execute(
+                """
+                UPDATE OR REPLACE partial_downloads
+                SET path = CASE
+                    WHEN path = ? THEN ?
+                    ELSE ? || substr(path, ?)
+                END
+                WHERE path = ? OR path LIKE ?
+                """,
+                (oldpath, newpath, newpath.rstrip("/") + "/", len(prefix) + 1, oldpath, prefix + "%"),
+            )
             self.conn.commit()
 
     def mark_synced_subtree(self, path):
-        prefix = path.rstrip("/") + "/"
+        # Entries last synced under the folder's old remote location moved with it;
+        # anything else below keeps its own synced_path so its own rename still runs.
+        entry = self.get_entry(path)
+        old_prefix = ((entry and entry["synced_path"]) or path).rstrip("/") + "/"
+        new_prefix = path.rstrip("/") + "/"
         with self.lock:
             self.conn.execute(
                 """
                 UPDATE entries
                 SET synced_path = path,
-                    dirty = CASE
-                        WHEN path = ? THEN 0
-                        ELSE dirty
-                    END,
-                    tombstone = CASE
-                        WHEN path = ? THEN 0
-                        ELSE tombstone
-                    END,
+                    dirty = 0,
+                    tombstone = 0,
                     last_synced_at = ?
-                WHERE path = ? OR path LIKE ?
+                WHERE path = ?
+                """,
+                (int(time.time()), path),
+            )
+            self.conn.execute(
+                """
+                UPDATE entries
+                SET synced_path = ? || substr(synced_path, ?)
+                WHERE synced_path LIKE ?
                 """,
-                (path, path, int(time.time()), path, prefix + "%"),
+                (new_prefix, len(old_prefix) + 1, old_prefix + "%"),
+            )
+            self.conn.execute(
+                "DELETE FROM pending_ops WHERE path = ? OR target_path = ?",
+                (path, path),
             )
             self.conn.commit()
 
+    def replace_tree(self, oldpath, newpath):
+        # rename(2) over an existing path. A new file saved over a synced one takes
+        # over its remote identity, so an editor's write-then-rename save becomes a
+        # content update; otherwise the replaced remote node is left behind as a
+        # tombstone at oldpath for the next sync pass to delete.
+        source = self.get_entry(oldpath)
+        target = self.get_entry(newpath)
+        with self.lock:
+            self.remove_subtree(newpath)
+            self.rename_tree(oldpath, newpath, root_dirty=True)
+            if not target or not target["remote_drivewsid"]:
+                return
+            if source["type"] == "file" and target["type"] == "file" and not source["remote_drivewsid"]:
+                self.conn.execute(
+                    """
+                    UPDATE entries
+                    SET remote_drivewsid = ?,
+                        remote_docwsid = ?,
+                        remote_etag = ?,
+                        remote_zone = ?,
+                        remote_shareid = ?,
+                        synced_path = ?
+                    WHERE path = ?
+                    """,
+                    (
+                        target["remote_drivewsid"],
+                        target["remote_docwsid"],
+                        target["remote_etag"],
+                        target["remote_zone"],
+                        self._encode_shareid(target.get("remote_shareid")),
+                        target["synced_path"],
+                        newpath,
+                    ),
+                )
+                self.conn.commit()
+                return
+            self.upsert_entry(
+                {
+                    **target,
+                    "path": oldpath,
+                    "parent_path": os.path.dirname(oldpath) or "/",
+                    "hydrated": False,
+                    "dirty": True,
+                    "tombstone": True,
+                }
+            )
+
     def detach_subtree_as_conflict(self, oldpath, newpath):
         entries = self._fetch_subtree(oldpath)
         if not entries:
@@ -469,6 +1202,11 @@ class SyncState:
                 )
             self.conn.commit()
 
+    def set_remote_etag(self, path, remote_etag):
+        with self.lock:
+            self.conn.execute("UPDATE entries SET remote_etag = ? WHERE path = ?", (remote_etag, path))
+            self.conn.commit()
+
     def clear_remote_identity(self, path):
         with self.lock:
             self.conn.execute(
@@ -488,9 +1226,22 @@ class SyncState:
             )
             self.conn.commit()
 
+    def list_pending_ops(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM pending_ops ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
     def queue_op(self, op, path, target_path=None):
         now = int(time.time())
         with self.lock:
+            if op == "update":
+                # Repeated writes fold into the create/update already queued for the path.
+                pending = self.conn.execute(
+                    "SELECT 1 FROM pending_ops WHERE path = ? AND op IN ('create', 'update') LIMIT 1",
+                    (path,),
+                ).fetchone()
+                if pending:
+                    return
             if op == "delete":
                 existing_create = self.conn.execute(
                     "SELECT id FROM pending_ops WHERE path = ? AND op IN ('create', 'mkdir')",
@@ -505,9 +1256,294 @@ class SyncState:
                 INSERT INTO pending_ops (op, path, target_path, queued_at)
                 VALUES (?, ?, ?, ?)
                 """,
-                (op, path, target_path, now),
-            )
-            self.conn.commit()
+                (op, path, target_path, now),
+            )
+            self.conn.commit()
+
+    def clear_crawl_staging(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM crawl_staging")
+            self.conn.execute("DELETE FROM crawl_failures")
+            self.conn.commit()
+
+    def crawl_in_progress(self):
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) AS count FROM crawl_frontier").fetchone()
+        return int(row["count"]) > 0
+
+    def begin_crawl(self, root_drivewsid):
+        with self.lock:
+            self.conn.execute("DELETE FROM crawl_staging")
+            self.conn.execute("DELETE FROM crawl_frontier")
+            self.conn.execute("DELETE FROM crawl_failures")
+            self.conn.execute(
+                "INSERT INTO crawl_frontier (remote_drivewsid, remote_shareid, path) VALUES (?, NULL, '/')",
+                (root_drivewsid,),
+            )
+            self.conn.commit()
+
+    def list_crawl_frontier(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT remote_drivewsid, remote_shareid, path FROM crawl_frontier ORDER BY rowid"
+            ).fetchall()
+        return [
+            (row["remote_drivewsid"], self._decode_shareid(row["remote_shareid"]), row["path"])
+            for row in rows
+        ]
+
+    def checkpoint_crawl(self, listed_drivewsids, metas, folders, failed_paths=()):
+        # A listed folder leaves the frontier in the same transaction that stages its
+        # children, so a resumed crawl neither repeats nor skips any folder.
+        with self.lock:
+            self._stage_rows(metas)
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO crawl_failures (path) VALUES (?)",
+                [(path,) for path in failed_paths],
+            )
+            self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO crawl_frontier (remote_drivewsid, remote_shareid, path)
+                VALUES (?, ?, ?)
+                """,
+                [(drivewsid, self._encode_shareid(shareid), path) for drivewsid, shareid, path in folders],
+            )
+            self.conn.executemany(
+                "DELETE FROM crawl_frontier WHERE remote_drivewsid = ?",
+                [(drivewsid,) for drivewsid in listed_drivewsids],
+            )
+            self.conn.commit()
+
+    def _stage_rows(self, metas):
+        rows = [
+            (
+                meta["remote_drivewsid"],
+                meta["path"],
+                meta["type"],
+                meta["parent_path"],
+                meta.get("remote_docwsid"),
+                meta.get("remote_etag"),
+                meta.get("remote_zone"),
+                self._encode_shareid(meta.get("remote_shareid")),
+                int(meta.get("size", 0) or 0),
+                int(meta.get("mtime", 0) or 0),
+            )
+            for meta in metas
+        ]
+        self.conn.executemany(
+            """
+            INSERT INTO crawl_staging (
+                remote_drivewsid, path, type, parent_path, remote_docwsid, remote_etag,
+                remote_zone, remote_shareid, size, mtime
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(remote_drivewsid) DO UPDATE SET
+                path = excluded.path,
+                type = excluded.type,
+                parent_path = excluded.parent_path,
+                remote_docwsid = excluded.remote_docwsid,
+                remote_etag = excluded.remote_etag,
+                remote_zone = excluded.remote_zone,
+                remote_shareid = excluded.remote_shareid,
+                size = excluded.size,
+                mtime = excluded.mtime
+            """,
+            rows,
+        )
+
+    def count_staged_entries(self):
+        with self.lock:
+            row = self.conn.execute("SELECT COUNT(*) AS count FROM crawl_staging").fetchone()
+        return int(row["count"])
+
+    def iter_staged_entries(self, page_size=500):
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    """
+                    SELECT rowid, * FROM crawl_staging
+                    WHERE rowid > ?
+                    ORDER BY rowid
+                    LIMIT ?
+                    """,
+                    (last_rowid, page_size),
+                ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1]["rowid"]
+            for row in rows:
+                entry = dict(row)
+                entry.pop("rowid")
+                yield self._decode_entry(entry)
+
+    def list_paths_missing_from_staging(self):
+        # Nothing below a folder the crawl failed to list counts as missing.
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT path FROM entries
+                WHERE remote_drivewsid IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM crawl_staging
+                      WHERE crawl_staging.remote_drivewsid = entries.remote_drivewsid
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1 FROM crawl_failures
+                      WHERE entries.path LIKE rtrim(crawl_failures.path, '/') || '/%'
+                  )
+                ORDER BY path
+                """
+            ).fetchall()
+        return [row["path"] for row in rows]
+
+    def list_crawl_failures(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT path FROM crawl_failures ORDER BY path").fetchall()
+        return [row["path"] for row in rows]
+
+    def get_folder_refresh(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM folder_refresh WHERE path = ?", (path,)).fetchone()
+        return row_to_dict(row)
+
+    def schedule_folders(self, paths, next_refresh_at, interval_seconds):
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO folder_refresh (path, interval_seconds, next_refresh_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    next_refresh_at = MIN(next_refresh_at, excluded.next_refresh_at)
+                """,
+                [(path, interval_seconds, next_refresh_at) for path in paths],
+            )
+            self.conn.commit()
+
+    def schedule_unlisted_folders(self, next_refresh_at, interval_seconds):
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR IGNORE INTO folder_refresh (path, interval_seconds, next_refresh_at)
+                SELECT '/', ?, ?
+                UNION ALL
+                SELECT path, ?, ? FROM entries
+                WHERE type = 'folder' AND tombstone = 0 AND remote_drivewsid IS NOT NULL
+                """,
+                (interval_seconds, next_refresh_at, interval_seconds, next_refresh_at),
+            )
+            self.conn.commit()
+
+    def mark_all_folders_listed(self, listed_at, interval_seconds):
+        self.schedule_unlisted_folders(listed_at + interval_seconds, interval_seconds)
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE folder_refresh
+                SET last_listed_at = ?,
+                    next_refresh_at = ? + interval_seconds
+                """,
+                (listed_at, listed_at),
+            )
+            self.conn.commit()
+
+    def record_folder_refresh(self, path, listed_at, changed, interval_seconds):
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO folder_refresh (
+                    path, interval_seconds, next_refresh_at, last_listed_at, last_changed_at
+                ) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    interval_seconds = excluded.interval_seconds,
+                    next_refresh_at = excluded.next_refresh_at,
+                    last_listed_at = excluded.last_listed_at,
+                    last_changed_at = COALESCE(excluded.last_changed_at, last_changed_at)
+                """,
+                (
+                    path,
+                    interval_seconds,
+                    listed_at + interval_seconds,
+                    listed_at,
+                    listed_at if changed else None,
+                ),
+            )
+            self.conn.commit()
+
+    def get_upload_failure(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM upload_failures WHERE path = ?", (path,)).fetchone()
+        return row_to_dict(row)
+
+    def record_upload_failure(self, path, attempts, next_attempt_at, size, mtime, error):
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO upload_failures (path, attempts, next_attempt_at, size, mtime, last_error)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    attempts = excluded.attempts,
+                    next_attempt_at = excluded.next_attempt_at,
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    last_error = excluded.last_error
+                """,
+                (path, attempts, next_attempt_at, size, mtime, error),
+            )
+            self.conn.commit()
+
+    def get_partial_download(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM partial_downloads WHERE path = ?", (path,)).fetchone()
+        return row_to_dict(row)
+
+    def record_partial_download(self, path, remote_etag, tmp_path, bytes_received):
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO partial_downloads (path, remote_etag, tmp_path, bytes_received, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    remote_etag = excluded.remote_etag,
+                    tmp_path = excluded.tmp_path,
+                    bytes_received = excluded.bytes_received,
+                    updated_at = excluded.updated_at
+                """,
+                (path, remote_etag, tmp_path, bytes_received, time.time()),
+            )
+            self.conn.commit()
+
+    def clear_partial_download(self, path):
+        with self.lock:
+            self.conn.execute("DELETE FROM partial_downloads WHERE path = ?", (path,))
+            self.conn.commit()
+
+    def list_partial_download_files(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT tmp_path FROM partial_downloads").fetchall()
+        return {row["tmp_path"] for row in rows}
+
+    def forget_folder_refresh(self, path):
+        with self.lock:
+            self.conn.execute("DELETE FROM folder_refresh WHERE path = ?", (path,))
+            self.conn.commit()
+
+    def list_due_folders(self, now, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT * FROM folder_refresh
+                WHERE next_refresh_at <= ?
+                ORDER BY next_refresh_at
+                LIMIT ?
+                """,
+                (now, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def next_folder_refresh_at(self):
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(next_refresh_at) AS due FROM folder_refresh").fetchone()
+        return row["due"]
 
     def _fetch_subtree(self, path):
         prefix = path.rstrip("/") + "/"
@@ -527,15 +1563,18 @@ class SyncState:
             return None
         return json.dumps(shareid, sort_keys=True)
 
-    def _decode_entry(self, entry):
-        if entry is None:
-            return None
-        shareid = entry.get("remote_shareid")
+    def _decode_shareid(self, shareid):
         if isinstance(shareid, str) and shareid:
             try:
-                entry["remote_shareid"] = json.loads(shareid)
+                return json.loads(shareid)
             except json.JSONDecodeError:
-                entry["remote_shareid"] = None
+                return None
+        return shareid
+
+    def _decode_entry(self, entry):
+        if entry is None:
+            return None
+        entry["remote_shareid"] = self._decode_shareid(entry.get("remote_shareid"))
         return entry
 
 
@@ -589,6 +1628,19 @@ class LocalMirror:
             if os.path.exists(tmp_path):
                 os.unlink(tmp_path)
 
+    def partial_download_path(self, path):
+        digest = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.tmp_dir, f"download-{digest}")
+
+    def install_download(self, path, tmp_path, mtime=None):
+        self.ensure_parent(path)
+        local = self.local_path(path)
+        if os.path.isdir(local):
+            shutil.rmtree(local)
+        os.replace(tmp_path, local)
+        if mtime is not None:
+            os.utime(local, (mtime, mtime))
+
     def read(self, path, size, offset):
         local = self.local_path(path)
         with open(local, "rb") as handle:
@@ -647,6 +1699,37 @@ class LocalMirror:
     def stat_local(self, path):
         return os.lstat(self.local_path(path))
 
+    def scan_tree(self, workers=8):
+        # One scandir task per directory, fanned out over a pool, so a large mirror is
+        # walked at the speed of its directory reads rather than one stat at a time.
+        files = {}
+        dirs = {"/"}
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scan") as pool:
+            pending = {pool.submit(self._scan_dir, self.root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found_files, found_dirs = future.result()
+                    files.update(found_files)
+                    for local in found_dirs:
+                        dirs.add(self._mirror_path(local))
+                        pending.add(pool.submit(self._scan_dir, local))
+        return files, dirs
+
+    def _scan_dir(self, local_dir):
+        found_files = {}
+        found_dirs = []
+        with os.scandir(local_dir) as items:
+            for item in items:
+                if item.is_dir(follow_symlinks=False):
+                    found_dirs.append(item.path)
+                else:
+                    found_files[self._mirror_path(item.path)] = item.stat(follow_symlinks=False)
+        return found_files, found_dirs
+
+    def _mirror_path(self, local):
+        return "/" + os.path.relpath(local, self.root).replace(os.sep, "/")
+
     def statvfs(self):
         return os.statvfs(self.root)
 
@@ -670,6 +1753,30 @@ class ICloudSyncEngine:
         upload_interval_seconds=30,
         remote_refresh_interval_seconds=300,
         warmup_workers=1,
+        crawl_workers=4,
+        crawl_requests_per_second=0,
+        crawl_batch_size=10,
+        crawl_page_size=500,
+        refresh_min_interval_seconds=15,
+        refresh_max_interval_seconds=86400,
+        refresh_overrides=None,
+        refresh_max_requests_per_minute=30,
+        directory_ttl_seconds=30,
+        node_cache_size=4096,
+        upload_workers=4,
+        upload_debounce_seconds=2,
+        delete_batch_size=100,
+        request_concurrency_initial=4,
+        request_concurrency_max=32,
+        transfer_sessions=None,
+        download_bytes_per_second=0,
+        upload_bytes_per_second=0,
+        throttle_interactive_downloads=False,
+        warmup_order="path",
+        warmup_include=None,
+        warmup_exclude=None,
+        warmup_max_file_size=0,
+        reconcile_workers=8,
     ):
         self.api = api
         self.mirror = mirror
@@ -680,22 +1787,73 @@ class ICloudSyncEngine:
         self.upload_interval_seconds = upload_interval_seconds
         self.remote_refresh_interval_seconds = remote_refresh_interval_seconds
         self.warmup_workers = max(1, int(warmup_workers))
+        self.warmup_order = warmup_order if warmup_order in WARMUP_ORDERS else "path"
+        self.deferring_warmup = False
+        self.warmup_rules = WarmupRules(warmup_include, warmup_exclude, warmup_max_file_size)
+        self.reconcile_workers = max(1, int(reconcile_workers))
+        self.ready = threading.Event()
+        self.folders_listed = threading.Event()
+        self.listed_folders = OrderedDict()
+        self.listed_folders_lock = threading.Lock()
+        self.remote_apply_lock = threading.RLock()
         self.executor = ThreadPoolExecutor(max_workers=self.warmup_workers, thread_name_prefix="warmup")
+        self.crawl_workers = max(1, int(crawl_workers))
+        self.crawl_rate_limiter = RateLimiter(crawl_requests_per_second)
+        self.crawl_batch_size = max(1, int(crawl_batch_size))
+        self.crawl_page_size = max(1, int(crawl_page_size))
+        self.refresh_min_interval_seconds = max(1, refresh_min_interval_seconds)
+        self.refresh_max_interval_seconds = max(self.refresh_min_interval_seconds, refresh_max_interval_seconds)
+        self.refresh_overrides = {
+            "/" + str(path).strip("/"): float(seconds) for path, seconds in (refresh_overrides or {}).items()
+        }
+        self.refresh_max_requests_per_minute = max(1, int(refresh_max_requests_per_minute))
+        self.refresh_request_times = deque()
+        self.folder_schedule_scanned_at = 0
+        self.directory_ttl_seconds = directory_ttl_seconds
+        self.revalidate_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="revalidate")
+        self.pending_revalidations = set()
+        self.revalidations_lock = threading.Lock()
+        self.deferred_child_meta = {}
+        self.deferred_child_meta_lock = threading.Lock()
+        self.node_cache = RemoteNodeCache(node_cache_size)
+        self.upload_workers = max(1, int(upload_workers))
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="upload")
+        self.upload_debounce_seconds = upload_debounce_seconds
+        self.delete_batch_size = max(1, int(delete_batch_size))
+        self.pending_uploads = {}
+        self.upload_condition = threading.Condition()
+        self.parent_nodes = {}
+        self.pending_changes = {}
         self.stop_event = threading.Event()
         self.path_locks = {}
         self.path_locks_lock = threading.Lock()
         self.scheduled_downloads = set()
         self.downloads_lock = threading.Lock()
-        self.download_retry_attempts = {}
-        self.download_retry_timers = {}
+        self.retry_scheduler = DelayScheduler(logger, name="download-retry")
         self.threads = []
         self.hydration_total = 0
         self.hydration_completed = 0
+        self.hydration_total_bytes = 0
+        self.hydration_completed_bytes = 0
         self.hydration_progress_lock = threading.Lock()
         self.shutdown_lock = threading.Lock()
         self.is_shutdown = False
-        # PyiCloud downloads appear sensitive to concurrent use of one session.
-        self.download_semaphore = threading.Semaphore(1)
+        self.broker = RequestBroker(request_concurrency_initial, request_concurrency_max)
+        self.session_pool = SessionPool(transfer_sessions) if transfer_sessions else SessionPool([api], shared=True)
+        self.download_bucket = TokenBucket(download_bytes_per_second)
+        self.upload_bucket = TokenBucket(upload_bytes_per_second)
+        self.throttle_interactive_downloads = throttle_interactive_downloads
+
+    def set_bandwidth_limits(self, download_bytes_per_second, upload_bytes_per_second, throttle_interactive_downloads):
+        self.download_bucket.set_rate(download_bytes_per_second)
+        self.upload_bucket.set_rate(upload_bytes_per_second)
+        self.throttle_interactive_downloads = throttle_interactive_downloads
+        self.logger.info(
+            "Bandwidth limits: download=%s B/s upload=%s B/s interactive downloads %s",
+            download_bytes_per_second or "unlimited",
+            upload_bytes_per_second or "unlimited",
+            "throttled" if throttle_interactive_downloads else "exempt",
+        )
 
     def _log_sync(self, event, level=logging.INFO, **fields):
         details = " ".join(f"{key}={value!r}" for key, value in fields.items() if value is not None)
@@ -705,17 +1863,77 @@ class ICloudSyncEngine:
         self.logger.log(level, "sync %s", event)
 
     def start(self):
-        if self.has_persistent_cache():
-            self.logger.info("Using persistent local cache from %s", self.mirror.root)
-            self._reconcile_persistent_cache()
-            if self.warmup_mode == "background":
-                self._schedule_all_unhydrated()
-        else:
-            self.logger.info("Persistent cache not initialized yet; performing first remote crawl")
-            self.initial_scan()
+        self._sweep_tmp_dir()
+        # Reconciliation and the first crawl run behind the mount; until they finish,
+        # folders are listed on demand by ensure_listed.
+        startup_thread = threading.Thread(target=self._startup, name="icloud-startup", daemon=True)
+        startup_thread.start()
+        self.threads.append(startup_thread)
+
+    def _sweep_tmp_dir(self):
+        # Runs before anything can start a transfer, so every file in tmp_dir that no
+        # partial_downloads row points at was left behind by an earlier run.
+        keep = self.state.list_partial_download_files()
+        removed = 0
+        for name in os.listdir(self.mirror.tmp_dir):
+            tmp_path = os.path.join(self.mirror.tmp_dir, name)
+            if tmp_path in keep or not os.path.isfile(tmp_path):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+                removed += 1
+        if removed:
+            self.logger.info("Removed %s leftover files from %s", removed, self.mirror.tmp_dir)
+
+    def _startup(self):
+        started_at = time.monotonic()
+        try:
+            if self.has_persistent_cache():
+                self.logger.info("Using persistent local cache from %s", self.mirror.root)
+                self._reconcile_persistent_cache()
+            else:
+                self.logger.info("Persistent cache not initialized yet; performing first remote crawl")
+                self.initial_scan()
             if self.warmup_mode == "background":
                 self._schedule_all_unhydrated()
-        self._start_background_threads()
+            self.logger.info("Background startup finished in %.1fs", time.monotonic() - started_at)
+        except CrawlInterrupted:
+            pass
+        except Exception as exc:
+            # Uploads and folder refreshes still run; folders stay listed on demand and
+            # the checkpointed crawl resumes on the next start.
+            self.logger.error("Background startup failed: %s", exc)
+        finally:
+            if not self.stop_event.is_set():
+                self._start_background_threads()
+            self.ready.set()
+
+    def ensure_listed(self, path):
+        if self.folders_listed.is_set():
+            return
+        folders = ["/"]
+        for part in [piece for piece in path.split("/") if piece]:
+            folders.append(folders[-1].rstrip("/") + "/" + part)
+        for folder in folders:
+            with self.listed_folders_lock:
+                if folder in self.listed_folders:
+                    continue
+            with self._path_lock(folder):
+                schedule = self.state.get_folder_refresh(folder)
+                if not schedule or schedule["last_listed_at"] is None:
+                    if folder != "/":
+                        entry = self.state.get_entry(folder)
+                        if entry is None or entry["type"] != "folder" or entry["tombstone"]:
+                            return
+                    self._log_sync("folder-list-on-demand", path=folder)
+                    self._refresh_folders([folder], priority="interactive")
+            # Only a shortcut past the folder_refresh lookup, so the oldest are dropped
+            # once it is full; it matters only until the crawl finishes, or for as long
+            # as a failed one leaves listing to ensure_listed.
+            with self.listed_folders_lock:
+                self.listed_folders[folder] = True
+                while len(self.listed_folders) > LISTED_FOLDERS_LIMIT:
+                    self.listed_folders.popitem(last=False)
 
     def _start_background_threads(self):
         upload_thread = threading.Thread(target=self._upload_loop, name="icloud-upload", daemon=True)
@@ -730,16 +1948,16 @@ class ICloudSyncEngine:
                 return
             self.is_shutdown = True
             self.stop_event.set()
+            with self.upload_condition:
+                self.upload_condition.notify_all()
             with self.downloads_lock:
-                timers = list(self.download_retry_timers.values())
-                self.download_retry_timers.clear()
                 self.scheduled_downloads.clear()
-            for timer in timers:
-                timer.cancel()
-            try:
-                self.executor.shutdown(wait=False, cancel_futures=True)
-            except TypeError:
-                self.executor.shutdown(wait=False)
+            self.retry_scheduler.shutdown()
+            for executor in (self.executor, self.revalidate_executor, self.upload_executor):
+                try:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                except TypeError:
+                    executor.shutdown(wait=False)
             for thread in list(self.threads):
                 thread.join(timeout=1)
 
@@ -747,60 +1965,79 @@ class ICloudSyncEngine:
         return self.state.count_entries() > 0 and os.path.isdir(self.mirror.root)
 
     def initial_scan(self):
-        snapshot = self._crawl_remote_snapshot()
-        self._apply_remote_snapshot(snapshot)
+        self._crawl_remote_snapshot()
+        # Leave every new file for _schedule_all_unhydrated, which queues them in
+        # warmup_order rather than crawl order.
+        self.deferring_warmup = True
+        try:
+            self._apply_remote_snapshot()
+        finally:
+            self.deferring_warmup = False
 
     def _reconcile_persistent_cache(self):
+        # The mirror is scanned once in parallel and compared against SyncState in
+        # memory. A file is only re-hashed when its stat fingerprint moved since the
+        # checksum was taken, and that hashing runs on a worker pool.
+        files, dirs = self.mirror.scan_tree(self.reconcile_workers)
         entries = self.state.list_entries()
         missing_files = 0
         recreated_dirs = 0
+        to_hash = []
+        updates = []
 
         for entry in entries:
             path = entry["path"]
             if entry["tombstone"]:
                 continue
             if entry["type"] == "folder":
-                if not self.mirror.exists(path):
+                if path not in dirs:
                     self.mirror.ensure_dir(path)
                     recreated_dirs += 1
                 continue
 
-            if self.mirror.exists(path):
-                stats = self.mirror.stat_local(path)
-                checksum = entry.get("local_sha256")
-                hydrated = bool(entry["hydrated"])
-                if entry["type"] == "file" and (hydrated or not entry["remote_drivewsid"]):
-                    checksum = self.mirror.file_sha256(path)
-                    hydrated = True
-                self.state.upsert_entry(
-                    {
-                        **entry,
-                        "size": stats.st_size,
-                        "mtime": int(stats.st_mtime),
-                        "hydrated": hydrated,
-                        "local_sha256": checksum,
-                    }
-                )
+            stats = files.get(path)
+            if stats is None and path in dirs:
+                self.logger.warning("Cached file %s is a directory in the mirror; leaving it alone", path)
+                continue
+            if stats is not None:
+                hydrated = bool(entry["hydrated"]) or not entry["remote_drivewsid"]
+                reconciled = {**entry, "size": stats.st_size, "mtime": int(stats.st_mtime), "hydrated": hydrated}
+                if hydrated and (entry.get("stat_fingerprint") != stat_fingerprint(stats) or not entry["local_sha256"]):
+                    to_hash.append((reconciled, entry, stats))
+                elif any(reconciled[key] != entry[key] for key in RECONCILED_FIELDS):
+                    updates.append((reconciled, entry))
                 continue
 
-            missing_files += 1
-            if entry["remote_drivewsid"]:
-                self.mirror.materialize_placeholder(path, entry["size"], entry["mtime"])
-                self.state.upsert_entry({**entry, "hydrated": entry["size"] == 0})
-            else:
-                self.mirror.create_file(path)
-                stats = self.mirror.stat_local(path)
-                checksum = self.mirror.file_sha256(path)
-                self.state.upsert_entry(
-                    {
-                        **entry,
-                        "size": stats.st_size,
-                        "mtime": int(stats.st_mtime),
-                        "hydrated": True,
-                        "local_sha256": checksum,
-                    }
-                )
+            # The filesystem is already mounted, so a missing file is recreated under its
+            # path lock and only if nothing has put it back in the meantime.
+            with self._path_lock(path):
+                if self.mirror.exists(path):
+                    continue
+                missing_files += 1
+                if entry["remote_drivewsid"]:
+                    self.mirror.materialize_placeholder(path, entry["size"], entry["mtime"])
+                    updates.append(({**entry, "hydrated": entry["size"] == 0, "stat_fingerprint": None}, entry))
+                else:
+                    self.mirror.create_file(path)
+                    stats = self.mirror.stat_local(path)
+                    to_hash.append(({**entry, "size": 0, "mtime": int(stats.st_mtime), "hydrated": True}, entry, stats))
+
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=self.reconcile_workers, thread_name_prefix="rehash") as pool:
+                checksums = pool.map(lambda item: self.mirror.file_sha256(item[0]["path"]), to_hash)
+                for (reconciled, entry, stats), checksum in zip(to_hash, checksums):
+                    updates.append(
+                        ({**reconciled, "local_sha256": checksum, "stat_fingerprint": stat_fingerprint(stats)}, entry)
+                    )
 
+        for index in range(0, len(updates), RECONCILE_BATCH_SIZE):
+            self.state.update_reconciled(updates[index : index + RECONCILE_BATCH_SIZE])
+        self.logger.info(
+            "Persistent cache reconciled: %s files scanned, %s re-hashed, %s entries updated",
+            len(files),
+            len(to_hash),
+            len(updates),
+        )
         self.logger.info(
             "Persistent cache ready: %s entries, %s directories recreated, %s files queued for hydration",
             len(entries),
@@ -808,45 +2045,43 @@ class ICloudSyncEngine:
             missing_files,
         )
 
-    def ensure_local_file(self, path):
-        entry = self.state.get_entry(path)
-        if not entry or entry["type"] != "file" or entry["tombstone"]:
-            return
-        if entry["hydrated"] and self.mirror.exists(path):
+    def ensure_local_file(self, path, priority="interactive"):
+        if self._entry_to_hydrate(path) is None:
             return
 
-        lock = self._path_lock(path)
-        with lock:
-            entry = self.state.get_entry(path)
-            if not entry or entry["type"] != "file" or entry["tombstone"]:
-                return
-            if entry["hydrated"] and self.mirror.exists(path):
+        # A hydration already running for this path is waited out before a broker
+        # slot is requested, so a duplicate caller does not sit on a slot while it
+        # is blocked on the path lock.
+        with self._path_lock(path):
+            entry = self._entry_to_hydrate(path)
+            if entry is None:
                 return
             if not entry["remote_drivewsid"]:
-                self._log_sync("hydrate-local", level=logging.DEBUG, path=path)
-                if not self.mirror.exists(path):
-                    self.mirror.create_file(path)
-                checksum = self.mirror.file_sha256(path)
-                stats = self.mirror.stat_local(path)
-                self.state.mark_hydrated(path, checksum, stats.st_size, int(stats.st_mtime))
+                self._hydrate_local(path)
+                return
+
+        # The session and then the slot are taken before the path lock, so nothing
+        # waits for either while holding it. The slot is released as soon as the
+        # response headers are in, so the body streams and waits on the bandwidth
+        # limit without holding it; the session is kept until the body is read.
+        with self.session_pool.checkout(priority) as api, contextlib.ExitStack() as request:
+            request.enter_context(self.broker.slot(priority))
+            with self._path_lock(path):
+                entry = self._entry_to_hydrate(path)
+                if entry is None:
+                    return
+                if not entry["remote_drivewsid"]:
+                    request.close()
+                    self._hydrate_local(path)
+                    return
+
                 self._log_sync(
-                    "hydrate-complete",
+                    "hydrate-start",
                     level=logging.INFO,
                     path=path,
-                    source="local",
-                    size=stats.st_size,
+                    drivewsid=entry.get("remote_drivewsid"),
+                    size=entry.get("size"),
                 )
-                return
-
-            self._log_sync(
-                "hydrate-start",
-                level=logging.INFO,
-                path=path,
-                drivewsid=entry.get("remote_drivewsid"),
-                size=entry.get("size"),
-            )
-            self.logger.debug("Hydrating %s", path)
-            with self.download_semaphore:
                 self.logger.debug(
                     "Hydrating file path=%s drivewsid=%s docwsid=%s zone=%s size=%s",
                     path,
@@ -855,62 +2090,255 @@ class ICloudSyncEngine:
                     entry.get("remote_zone"),
                     entry.get("size"),
                 )
-                node = self._node_from_entry(entry)
-                content = node.open(stream=True).raw.read()
-            self.mirror.write_atomic_bytes(path, content, entry["mtime"])
-            stats = self.mirror.stat_local(path)
-            checksum = self.mirror.file_sha256(path)
-            self.state.mark_hydrated(path, checksum, stats.st_size, int(stats.st_mtime))
-            self._log_sync("hydrate-complete", level=logging.INFO, path=path, source="remote", size=stats.st_size)
+                node = DriveNode(api.drive, self._node_from_entry(entry).data)
+                tmp_path, checksum = self._download_to_tmp(node, entry, priority, request.close)
+                self.mirror.install_download(path, tmp_path, entry["mtime"])
+                self.state.clear_partial_download(path)
+                stats = self.mirror.stat_local(path)
+                self.state.mark_hydrated(path, checksum, stats.st_size, int(stats.st_mtime), stat_fingerprint(stats))
+                self._log_sync("hydrate-complete", level=logging.INFO, path=path, source="remote", size=stats.st_size)
+        self.forget_download_retries(path)
+
+    def _entry_to_hydrate(self, path):
+        entry = self.state.get_entry(path)
+        if not entry or entry["type"] != "file" or entry["tombstone"]:
+            return None
+        if entry["hydrated"] and self.mirror.exists(path):
+            return None
+        return entry
+
+    def _hydrate_local(self, path):
+        self._log_sync("hydrate-local", level=logging.DEBUG, path=path)
+        if not self.mirror.exists(path):
+            self.mirror.create_file(path)
+        checksum = self.mirror.file_sha256(path)
+        stats = self.mirror.stat_local(path)
+        self.state.mark_hydrated(path, checksum, stats.st_size, int(stats.st_mtime), stat_fingerprint(stats))
+        self._log_sync(
+            "hydrate-complete",
+            level=logging.INFO,
+            path=path,
+            source="local",
+            size=stats.st_size,
+        )
+
+    def _download_to_tmp(self, node, entry, priority, headers_received):
+        # Bytes land in a per-path file under mirror.tmp_dir with progress checkpointed
+        # in SyncState, so a failed attempt resumes with a Range request as long as the
+        # remote etag it started from is still current.
+        path = entry["path"]
+        etag = entry.get("remote_etag")
+        tmp_path = self.mirror.partial_download_path(path)
+        partial = self.state.get_partial_download(path)
+        offset = 0
+        if partial and partial["remote_etag"] == etag and os.path.exists(partial["tmp_path"]):
+            tmp_path = partial["tmp_path"]
+            offset = min(os.path.getsize(tmp_path), partial["bytes_received"])
+        size = entry.get("size")
+        hasher = hashlib.sha256()
+        with open(tmp_path, "r+b" if offset else "wb") as handle:
+            handle.truncate(offset)
+            while handle.tell() < offset:
+                hasher.update(handle.read(min(DOWNLOAD_CHUNK_SIZE, offset - handle.tell())))
+            if size is None or offset < size:
+                kwargs = {"stream": True}
+                if offset:
+                    kwargs["headers"] = {"Range": f"bytes={offset}-"}
+                    self._log_sync("hydrate-resume", level=logging.INFO, path=path, offset=offset)
+                response = node.open(**kwargs)
+                headers_received()
+                if offset and response.status_code != 206:
+                    # The server ignored the range; start over from the first byte.
+                    offset = 0
+                    hasher = hashlib.sha256()
+                    handle.seek(0)
+                    handle.truncate(0)
+                throttled = priority != "interactive" or self.throttle_interactive_downloads
+                received = checkpointed = offset
+                try:
+                    while True:
+                        chunk = response.raw.read(TRANSFER_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        handle.write(chunk)
+                        hasher.update(chunk)
+                        received += len(chunk)
+                        if throttled:
+                            self.download_bucket.consume(len(chunk), self.stop_event)
+                        if received - checkpointed >= DOWNLOAD_CHUNK_SIZE and (size is None or received < size):
+                            handle.flush()
+                            self.state.record_partial_download(path, etag, tmp_path, received)
+                            checkpointed = received
+                except Exception:
+                    handle.flush()
+                    self.state.record_partial_download(path, etag, tmp_path, received)
+                    raise
+                if size is not None and received != size:
+                    self.state.record_partial_download(path, etag, tmp_path, received)
+                    raise IOError(f"Download of {path} ended at {received} of {size} bytes")
+        return tmp_path, hasher.hexdigest()
 
     def _crawl_remote_snapshot(self):
-        self.logger.info("Starting remote metadata crawl")
-        snapshot = {}
-        queue = deque()
-        root = self.api.drive.root
-        queue.append((root, "/"))
+        # Each listed batch is checkpointed into crawl_staging/crawl_frontier, so memory
+        # stays flat with drive size and an interrupted crawl resumes where it stopped.
+        if self.state.crawl_in_progress():
+            queue = deque(self.state.list_crawl_frontier())
+            discovered = self.state.count_staged_entries()
+            self.logger.info(
+                "Resuming interrupted remote metadata crawl: %s entries staged, %s folders pending",
+                discovered,
+                len(queue),
+            )
+        else:
+            self.logger.info("Starting remote metadata crawl")
+            self.state.begin_crawl(ROOT_DRIVEWSID)
+            queue = deque([(ROOT_DRIVEWSID, None, "/")])
+            discovered = 0
+        in_flight = {}
         started_at = time.time()
         last_progress_log = started_at
         scanned_folders = 0
-
-        while queue:
-            node, path = queue.popleft()
-            scanned_folders += 1
-            try:
-                children = node.get_children(force=True)
-            except Exception as exc:
-                self.logger.error("Failed to enumerate %s: %s", path, exc)
-                continue
-
-            for child in children:
-                child_path = "/" + child.name if path == "/" else path.rstrip("/") + "/" + child.name
-                meta = self._node_to_meta(child, child_path)
-                snapshot[meta["remote_drivewsid"]] = meta
-                if meta["type"] == "folder":
-                    queue.append((child, child_path))
-
-            now = time.time()
-            if scanned_folders == 1 or scanned_folders % 25 == 0 or now - last_progress_log >= 5:
-                self.logger.info(
-                    "Remote metadata crawl progress: %s folders scanned, %s entries discovered, %s folders queued",
-                    scanned_folders,
-                    len(snapshot),
-                    len(queue),
-                )
-                last_progress_log = now
-
+        logged_folders = 0
+
+        with ThreadPoolExecutor(max_workers=self.crawl_workers, thread_name_prefix="crawl") as pool:
+            while queue or in_flight:
+                if self.stop_event.is_set():
+                    for future in in_flight:
+                        future.cancel()
+                    raise CrawlInterrupted("Remote metadata crawl interrupted by shutdown")
+
+                while queue and len(in_flight) < self.crawl_workers:
+                    free_workers = self.crawl_workers - len(in_flight)
+                    batch_size = min(self.crawl_batch_size, -(-len(queue) // free_workers))
+                    batch = [queue.popleft() for _ in range(batch_size)]
+                    in_flight[pool.submit(self._list_remote_folders, batch)] = batch
+
+                done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    try:
+                        listings = future.result()
+                    except Exception as exc:
+                        listings = [(path, None, exc) for _, _, path in batch]
+
+                    listed = []
+                    staged = []
+                    folders = []
+                    failed = []
+                    for (drivewsid, _, _), (path, items, error) in zip(batch, listings):
+                        if error is not None and self._is_auth_error(error):
+                            raise error
+                        scanned_folders += 1
+                        listed.append(drivewsid)
+                        if error is not None:
+                            self.logger.error("Failed to enumerate %s: %s", path, error)
+                            failed.append(path)
+                            continue
+
+                        for item in items:
+                            child = DriveNode(self.api.drive, item)
+                            child_path = "/" + child.name if path == "/" else path.rstrip("/") + "/" + child.name
+                            meta = self._node_to_meta(child, child_path)
+                            staged.append(meta)
+                            if meta["type"] == "folder":
+                                folders.append((meta["remote_drivewsid"], item.get("shareID"), child_path))
+                    self.state.checkpoint_crawl(listed, staged, folders, failed)
+                    queue.extend(folders)
+                    discovered += len(staged)
+
+                    now = time.time()
+                    if (
+                        not logged_folders
+                        or scanned_folders - logged_folders >= 25
+                        or now - last_progress_log >= 5
+                    ):
+                        self.logger.info(
+                            "Remote metadata crawl progress: %s folders scanned, %s entries discovered, %s folders queued",
+                            scanned_folders,
+                            discovered,
+                            len(queue) + sum(len(pending) for pending in in_flight.values()),
+                        )
+                        last_progress_log = now
+                        logged_folders = scanned_folders
+
+        discovered = self.state.count_staged_entries()
         self.logger.info(
             "Remote metadata crawl complete: %s entries across %s folders in %.1fs",
-            len(snapshot),
+            discovered,
             scanned_folders,
             time.time() - started_at,
         )
-        return snapshot
+        return discovered
+
+    def _list_remote_folders(self, batch, priority="crawl", on_request=None):
+        listings = {}
+        if len(batch) > 1:
+            if not self.crawl_rate_limiter.acquire(self.stop_event):
+                raise CrawlInterrupted("Remote metadata crawl interrupted by shutdown")
+            if on_request is not None:
+                on_request()
+            try:
+                with self.broker.slot(priority):
+                    details = retrieve_folder_details(
+                        self.api.drive,
+                        [(drivewsid, shareid) for drivewsid, shareid, _ in batch],
+                    )
+            except Exception as exc:
+                self.logger.warning(
+                    "Batched listing of %s folders failed: %s; falling back to per-folder requests",
+                    len(batch),
+                    exc,
+                )
+            else:
+                by_id = {data.get("drivewsid"): data for data in details}
+                for drivewsid, _, path in batch:
+                    data = by_id.get(drivewsid)
+                    if data is not None and "items" in data:
+                        listings[path] = data["items"]
+
+        results = []
+        for drivewsid, shareid, path in batch:
+            if path in listings:
+                results.append((path, listings[path], None))
+                continue
+            if not self.crawl_rate_limiter.acquire(self.stop_event):
+                raise CrawlInterrupted("Remote metadata crawl interrupted by shutdown")
+            if on_request is not None:
+                on_request()
+            try:
+                with self.broker.slot(priority):
+                    data = self.api.drive.get_node_data(drivewsid, shareid)
+                if "items" not in data:
+                    raise KeyError(f"No items in folder, status: {data.get('status')}")
+                results.append((path, data["items"], None))
+            except Exception as exc:
+                results.append((path, None, exc))
+        return results
 
-    def _apply_remote_snapshot(self, snapshot):
-        remote_ids = set(snapshot.keys())
+    def _apply_remote_snapshot(self):
+        for meta in self.state.iter_staged_entries(self.crawl_page_size):
+            self._apply_remote_meta(meta)
 
-        for meta in snapshot.values():
+        for path in self.state.list_paths_missing_from_staging():
+            entry = self.state.get_entry(path)
+            if entry is None or not entry["remote_drivewsid"]:
+                continue
+            self._apply_remote_deletion(entry)
+        failed = self.state.list_crawl_failures()
+        self.state.clear_crawl_staging()
+        now = time.time()
+        self.state.mark_all_folders_listed(now, self.remote_refresh_interval_seconds)
+        if failed:
+            # Their contents were kept as they were; list them again straight away.
+            self.logger.warning("Crawl could not list %s folders; keeping their local contents", len(failed))
+            self.state.schedule_folders(failed, now, self.remote_refresh_interval_seconds)
+        self.folders_listed.set()
+        with self.listed_folders_lock:
+            self.listed_folders.clear()
+
+    def _apply_remote_meta(self, meta):
+        # The startup crawl and on-demand folder listings may apply the same items.
+        with self.remote_apply_lock:
             existing = self.state.get_entry_by_remote_id(meta["remote_drivewsid"])
             if existing and existing["dirty"] and self._entry_conflicts(existing, meta):
                 self._resolve_conflict(existing)
@@ -921,24 +2349,225 @@ class ICloudSyncEngine:
                 if path_entry and path_entry["dirty"]:
                     self._resolve_conflict(path_entry)
                 self._materialize_remote_entry(meta)
-                continue
+                return True
 
             if existing["dirty"]:
-                continue
+                return False
 
+            path_entry = self.state.get_entry(meta["path"]) if existing["path"] != meta["path"] else None
+            if path_entry and path_entry["remote_drivewsid"] != meta["remote_drivewsid"]:
+                # Moved onto a path whose previous occupant is no longer there remotely.
+                if path_entry["dirty"]:
+                    self._resolve_conflict(path_entry)
+                else:
+                    self._apply_remote_deletion(path_entry)
+
+            changed = (
+                existing["path"] != meta["path"]
+                or existing["remote_etag"] != meta["remote_etag"]
+                or (meta["type"] == "file" and (existing["size"], existing["mtime"]) != (meta["size"], meta["mtime"]))
+            )
             self._refresh_clean_entry(existing, meta)
+            return changed
 
-        for entry in self.state.list_entries():
-            remote_id = entry["remote_drivewsid"]
-            if not remote_id or remote_id in remote_ids:
-                continue
+    def _apply_remote_deletion(self, entry):
+        with self.remote_apply_lock:
             if entry["dirty"]:
                 self.logger.warning("Remote deleted dirty path %s; keeping local copy for upload", entry["path"])
                 self.state.clear_remote_identity(entry["path"])
-                continue
+                return
             self.logger.info("Removing clean path deleted remotely: %s", entry["path"])
             self.mirror.remove_tree(entry["path"])
             self.state.remove_subtree(entry["path"])
+            self.forget_download_retries(entry["path"], subtree=True)
+
+    def _apply_folder_listing(self, folder_path, items, listed_at):
+        # Children missing from the listing are returned rather than removed: they may
+        # have moved into a folder that has not been listed yet.
+        changed = False
+        seen = set()
+        missing = []
+        stale_folders = []
+        for item in items:
+            child = DriveNode(self.api.drive, item)
+            child_path = "/" + child.name if folder_path == "/" else folder_path.rstrip("/") + "/" + child.name
+            meta = self._node_to_meta(child, child_path)
+            seen.add(meta["remote_drivewsid"])
+            if meta["type"] == "folder":
+                known = self.state.get_entry_by_remote_id(meta["remote_drivewsid"])
+                if known is None or known["path"] != child_path or known["remote_etag"] != meta["remote_etag"]:
+                    stale_folders.append(child_path)
+            if self._apply_remote_meta(meta):
+                changed = True
+
+        for entry in self.state.list_children(folder_path):
+            if entry["remote_drivewsid"] and entry["remote_drivewsid"] not in seen:
+                missing.append(entry)
+                changed = True
+
+        if stale_folders:
+            self.state.schedule_folders(stale_folders, listed_at, self.remote_refresh_interval_seconds)
+        return changed, missing
+
+    def _resolve_missing_entries(self, entries, now, priority, on_request):
+        # Entries that another listing in the same pass already moved are done. For the
+        # rest the item's own details tell a deletion (gone or in the trash) from a
+        # move into a folder not listed yet; that folder is then due for a listing and
+        # the entry stays where it is until the listing moves it.
+        pending = []
+        for entry in entries:
+            current = self.state.get_entry_by_remote_id(entry["remote_drivewsid"])
+            if current is not None and current["path"] == entry["path"]:
+                pending.append(current)
+
+        for start in range(0, len(pending), self.crawl_batch_size):
+            batch = pending[start : start + self.crawl_batch_size]
+            on_request()
+            try:
+                with self.broker.slot(priority):
+                    details = retrieve_folder_details(
+                        self.api.drive,
+                        [(entry["remote_drivewsid"], entry.get("remote_shareid")) for entry in batch],
+                    )
+            except Exception as exc:
+                if self._is_auth_error(exc):
+                    raise
+                self.logger.warning("Failed to check %s items missing from listings: %s", len(batch), exc)
+                continue
+            parents = {data.get("drivewsid"): data.get("parentId") for data in details}
+            moved_into = set()
+            for entry in batch:
+                parent_id = parents.get(entry["remote_drivewsid"])
+                if parent_id is None or parent_id == TRASH_DRIVEWSID:
+                    self._apply_remote_deletion(entry)
+                    continue
+                parent = self.state.get_entry_by_remote_id(parent_id)
+                self._log_sync("remote-possibly-moved", path=entry["path"], parent=parent["path"] if parent else parent_id)
+                if parent is not None and parent["type"] == "folder":
+                    moved_into.add(parent["path"])
+            if moved_into:
+                self.state.schedule_folders(sorted(moved_into), now, self.remote_refresh_interval_seconds)
+
+    def revalidate_directory(self, path):
+        if self.directory_ttl_seconds <= 0 or self.stop_event.is_set():
+            return
+        schedule = self.state.get_folder_refresh(path)
+        listed_at = schedule["last_listed_at"] if schedule else None
+        if listed_at is not None and time.time() - listed_at < self.directory_ttl_seconds:
+            return
+        with self.revalidations_lock:
+            if path in self.pending_revalidations:
+                return
+            self.pending_revalidations.add(path)
+        self._log_sync("directory-revalidate", level=logging.DEBUG, path=path, listed_at=listed_at)
+        try:
+            self.revalidate_executor.submit(self._revalidate_directory_job, path)
+        except RuntimeError:
+            with self.revalidations_lock:
+                self.pending_revalidations.discard(path)
+
+    def _revalidate_directory_job(self, path):
+        try:
+            self._refresh_folders([path])
+        except Exception as exc:
+            self.logger.error("Failed revalidating directory %s: %s", path, exc)
+        finally:
+            with self.revalidations_lock:
+                self.pending_revalidations.discard(path)
+
+    def _folder_refresh_interval(self, path, previous_interval, changed):
+        override = None
+        override_length = -1
+        for prefix, seconds in self.refresh_overrides.items():
+            if path == prefix or prefix == "/" or path.startswith(prefix + "/"):
+                if len(prefix) > override_length:
+                    override, override_length = seconds, len(prefix)
+        if override is not None:
+            return override
+        if previous_interval is None:
+            return self.remote_refresh_interval_seconds
+        if changed:
+            return self.refresh_min_interval_seconds
+        return min(self.refresh_max_interval_seconds, previous_interval * 2)
+
+    def _refresh_requests_available(self):
+        window_start = time.monotonic() - 60
+        while self.refresh_request_times and self.refresh_request_times[0] < window_start:
+            self.refresh_request_times.popleft()
+        return self.refresh_max_requests_per_minute - len(self.refresh_request_times)
+
+    def _seconds_until_next_refresh(self):
+        if self._refresh_requests_available() <= 0:
+            return max(1, self.refresh_request_times[0] + 60 - time.monotonic())
+        due = self.state.next_folder_refresh_at()
+        if due is None:
+            return 60
+        return min(60, max(1, due - time.time()))
+
+    def _refresh_due_folders(self, now=None):
+        now = time.time() if now is None else now
+        if now - self.folder_schedule_scanned_at >= 60:
+            self.state.schedule_unlisted_folders(now + self.remote_refresh_interval_seconds, self.remote_refresh_interval_seconds)
+            self.folder_schedule_scanned_at = now
+        available = self._refresh_requests_available()
+        if available <= 0:
+            return 0
+        due = self.state.list_due_folders(now, available * self.crawl_batch_size)
+        return self._refresh_folders([row["path"] for row in due], now)
+
+    def _refresh_folders(self, paths, now=None, priority="crawl"):
+        now = time.time() if now is None else now
+        folders = []
+        for path in paths:
+            if path == "/":
+                folders.append((ROOT_DRIVEWSID, None, "/"))
+                continue
+            entry = self.state.get_entry(path)
+            if entry is None or entry["type"] != "folder" or entry["tombstone"]:
+                self.state.forget_folder_refresh(path)
+                continue
+            if not entry["remote_drivewsid"]:
+                self.state.record_folder_refresh(path, now, False, self.remote_refresh_interval_seconds)
+                continue
+            folders.append((entry["remote_drivewsid"], entry.get("remote_shareid"), path))
+
+        # Every request of the pass, per-folder fallbacks included, counts against the
+        # refresh budget.
+        requests = 0
+
+        def spend_request():
+            nonlocal requests
+            requests += 1
+            self.refresh_request_times.append(time.monotonic())
+
+        missing = {}
+        for start in range(0, len(folders), self.crawl_batch_size):
+            batch = folders[start : start + self.crawl_batch_size]
+            for path, items, error in self._list_remote_folders(batch, priority, spend_request):
+                schedule = self.state.get_folder_refresh(path)
+                previous_interval = schedule["interval_seconds"] if schedule else None
+                if error is not None:
+                    if self._is_auth_error(error):
+                        raise error
+                    self.logger.error("Failed to refresh %s: %s", path, error)
+                    self.state.record_folder_refresh(
+                        path, now, False, previous_interval or self.remote_refresh_interval_seconds
+                    )
+                    continue
+                changed, gone = self._apply_folder_listing(path, items, now)
+                missing.update((entry["remote_drivewsid"], entry) for entry in gone)
+                interval = self._folder_refresh_interval(path, previous_interval, changed)
+                self.state.record_folder_refresh(path, now, changed, interval)
+                self._log_sync(
+                    "folder-refresh",
+                    level=logging.INFO if changed else logging.DEBUG,
+                    path=path,
+                    changed=changed,
+                    next_refresh_seconds=interval,
+                )
+        if missing:
+            self._resolve_missing_entries(list(missing.values()), now, priority, spend_request)
+        return requests
 
     def _materialize_remote_entry(self, meta):
         local_path = meta["path"]
@@ -964,8 +2593,8 @@ class ICloudSyncEngine:
                 "synced_path": local_path,
             }
         )
-        if meta["type"] == "file" and not hydrated:
-            self._schedule_download(local_path)
+        if meta["type"] == "file" and not hydrated and not self.deferring_warmup:
+            self._schedule_warmup(local_path, meta["size"])
 
     def _refresh_clean_entry(self, entry, meta):
         oldpath = entry["path"]
@@ -979,6 +2608,8 @@ class ICloudSyncEngine:
             self._log_sync("remote-rename", path=oldpath, target_path=newpath, entry_type=meta["type"])
             self.state.rename_tree(oldpath, newpath, root_dirty=False, update_synced=True)
             entry = self.state.get_entry(newpath)
+        if oldpath != newpath:
+            self.move_download_retries(oldpath, newpath)
 
         if meta["type"] == "folder":
             self.mirror.ensure_dir(newpath)
@@ -1024,7 +2655,7 @@ class ICloudSyncEngine:
             }
         )
         if not hydrated:
-            self._schedule_download(newpath)
+            self._schedule_warmup(newpath, meta["size"])
 
     def _resolve_conflict(self, entry):
         if self.conflict_mode != "copy":
@@ -1039,22 +2670,40 @@ class ICloudSyncEngine:
             self.state.queue_op("conflict-copy", child["path"])
 
     def _schedule_all_unhydrated(self):
-        paths = self.state.list_unhydrated_paths()
-        total = len(paths)
+        candidates = self.state.list_warmup_files(self.warmup_order)
+        files = [(path, size) for path, size in candidates if self.warmup_rules.wants(path, size)]
+        if len(files) < len(candidates):
+            self.logger.info(
+                "Selective sync leaves %s files as placeholders until opened",
+                len(candidates) - len(files),
+            )
+        total = len(files)
+        total_bytes = sum(size for _, size in files)
         with self.hydration_progress_lock:
             self.hydration_total = total
             self.hydration_completed = 0
+            self.hydration_total_bytes = total_bytes
+            self.hydration_completed_bytes = 0
         if total:
-            self.logger.info("Background cache warmup scheduled for %s files", total)
+            self.logger.info(
+                "Background cache warmup scheduled for %s files (%s bytes), %s order",
+                total,
+                total_bytes,
+                self.warmup_order,
+            )
         else:
             self.logger.info("Background cache warmup skipped; all files already hydrated")
-        for path in paths:
+        for path, _ in files:
+            self._schedule_download(path)
+
+    def _schedule_warmup(self, path, size):
+        if self.warmup_rules.wants(path, size):
             self._schedule_download(path)
 
     def _schedule_download(self, path):
         self._schedule_download_with_delay(path, 0)
 
-    def _schedule_download_with_delay(self, path, delay_seconds):
+    def _schedule_download_with_delay(self, path, delay_seconds, attempt=0):
         if self.stop_event.is_set() or self.is_shutdown:
             return
 
@@ -1078,25 +2727,47 @@ class ICloudSyncEngine:
                     self.scheduled_downloads.discard(path)
             return
 
-        timer = threading.Timer(delay_seconds, self._submit_retry_download, args=(path,))
-        timer.daemon = True
-        with self.downloads_lock:
-            self.download_retry_timers[path] = timer
-        timer.start()
+        # The attempt count lives in the pending retry, so it lasts exactly as long as
+        # the path has a retry outstanding.
+        if not self.retry_scheduler.schedule(
+            path, delay_seconds, lambda: self._submit_retry_download(path, attempt), attempt
+        ):
+            with self.downloads_lock:
+                self.scheduled_downloads.discard(path)
 
-    def _submit_retry_download(self, path):
-        with self.downloads_lock:
-            self.download_retry_timers.pop(path, None)
+    def _submit_retry_download(self, path, attempt):
         if self.stop_event.is_set() or self.is_shutdown:
             with self.downloads_lock:
                 self.scheduled_downloads.discard(path)
             return
         try:
-            self.executor.submit(self._download_job, path)
+            self.executor.submit(self._download_job, path, attempt)
         except RuntimeError:
             with self.downloads_lock:
                 self.scheduled_downloads.discard(path)
 
+    def forget_download_retries(self, path, subtree=False):
+        # Retries are keyed by path, so one for a path that was hydrated meanwhile,
+        # removed or renamed away is cancelled along with its attempt count. Returns
+        # the attempt counts of the retries that were still pending.
+        prefix = path.rstrip("/") + "/"
+        with self.downloads_lock:
+            keys = {path}
+            if subtree:
+                keys.update(key for key in self.retry_scheduler.keys() if key.startswith(prefix))
+            cancelled = {}
+            for key in keys:
+                pending = self.retry_scheduler.pop(key)
+                if pending is not None:
+                    self.scheduled_downloads.discard(key)
+                    cancelled[key] = pending[1]
+        return cancelled
+
+    def move_download_retries(self, oldpath, newpath):
+        for key, attempt in self.forget_download_retries(oldpath, subtree=True).items():
+            moved = newpath + key[len(oldpath) :]
+            self._schedule_download_with_delay(moved, self._retry_delay_for_attempt(attempt), attempt)
+
     def _retry_delay_for_attempt(self, attempt):
         return min(300, 5 * (2 ** max(0, attempt - 1)))
 
@@ -1113,22 +2784,26 @@ class ICloudSyncEngine:
             return True
         return False
 
-    def _download_job(self, path):
+    def _download_job(self, path, attempt=0):
         retry_delay = None
         try:
-            self.ensure_local_file(path)
-            with self.downloads_lock:
-                self.download_retry_attempts.pop(path, None)
+            self.ensure_local_file(path, priority="warmup")
             self._log_sync("download-complete", level=logging.INFO, path=path)
+            entry = self.state.get_entry(path)
             with self.hydration_progress_lock:
                 self.hydration_completed += 1
+                self.hydration_completed_bytes += entry["size"] if entry else 0
                 completed = self.hydration_completed
                 total = self.hydration_total
+                completed_bytes = self.hydration_completed_bytes
+                total_bytes = self.hydration_total_bytes
             if total and (completed == 1 or completed == total or completed % 25 == 0):
                 self.logger.info(
-                    "Background cache warmup progress: %s/%s files hydrated",
+                    "Background cache warmup progress: %s/%s files, %s/%s bytes hydrated",
                     completed,
                     total,
+                    completed_bytes,
+                    total_bytes,
                 )
         except Exception as exc:
             if self._is_auth_error(exc):
@@ -1138,12 +2813,8 @@ class ICloudSyncEngine:
                     path,
                     exc,
                 )
-                with self.downloads_lock:
-                    self.download_retry_attempts.pop(path, None)
                 return
-            with self.downloads_lock:
-                attempt = self.download_retry_attempts.get(path, 0) + 1
-                self.download_retry_attempts[path] = attempt
+            attempt += 1
             retry_delay = self._retry_delay_for_attempt(attempt)
             self.logger.error(
                 "Warmup download failed for %s (attempt %s): %s; retrying in %ss",
@@ -1155,73 +2826,181 @@ class ICloudSyncEngine:
         finally:
             with self.downloads_lock:
                 self.scheduled_downloads.discard(path)
-                self.download_retry_timers.pop(path, None)
             if retry_delay is not None:
-                self._schedule_download_with_delay(path, retry_delay)
+                self._schedule_download_with_delay(path, retry_delay, attempt)
+
+    def notify_local_change(self, path, settled=False):
+        # Writes push the path's upload back by the debounce window; release of a
+        # path that is already pending makes it due immediately.
+        with self.upload_condition:
+            if settled and path not in self.pending_uploads:
+                return
+            delay = 0 if settled else self.upload_debounce_seconds
+            self.pending_uploads[path] = time.monotonic() + delay
+            self.upload_condition.notify()
 
     def _upload_loop(self):
-        while not self.stop_event.wait(self.upload_interval_seconds):
+        # Sleeps until a local change comes due. upload_interval_seconds only paces
+        # retries while entries that failed to sync are still dirty.
+        retry_at = time.monotonic()
+        while True:
+            with self.upload_condition:
+                while not self.stop_event.is_set():
+                    deadlines = list(self.pending_uploads.values())
+                    if retry_at is not None:
+                        deadlines.append(retry_at)
+                    now = time.monotonic()
+                    if deadlines and min(deadlines) <= now:
+                        break
+                    self.upload_condition.wait(min(deadlines) - now if deadlines else None)
+                if self.stop_event.is_set():
+                    return
+                now = time.monotonic()
+                for path, deadline in list(self.pending_uploads.items()):
+                    if deadline <= now:
+                        del self.pending_uploads[path]
+                settling = set(self.pending_uploads)
             try:
-                self.sync_dirty_entries()
+                self.sync_dirty_entries(exclude=settling)
             except Exception as exc:
                 self.logger.error("Upload loop failed: %s", exc)
+            retry_at = time.monotonic() + self.upload_interval_seconds if self.state.has_dirty_entries() else None
 
     def _refresh_loop(self):
         immediate = self.has_persistent_cache()
         if immediate:
             try:
                 self.logger.info("Starting background remote refresh from persistent cache")
-                snapshot = self._crawl_remote_snapshot()
-                self._apply_remote_snapshot(snapshot)
+                self._crawl_remote_snapshot()
+                self._apply_remote_snapshot()
             except Exception as exc:
                 self.logger.error("Initial background refresh failed: %s", exc)
-        while not self.stop_event.wait(self.remote_refresh_interval_seconds):
+        while not self.stop_event.wait(self._seconds_until_next_refresh()):
             try:
-                snapshot = self._crawl_remote_snapshot()
-                self._apply_remote_snapshot(snapshot)
+                self._refresh_due_folders()
             except Exception as exc:
                 self.logger.error("Refresh loop failed: %s", exc)
 
-    def sync_dirty_entries(self):
-        dirty_entries = self.state.list_dirty_entries()
+    def sync_dirty_entries(self, exclude=()):
+        dirty_entries = [entry for entry in self.state.list_dirty_entries() if entry["path"] not in exclude]
         if not dirty_entries:
             return
 
         self._log_sync("dirty-scan", dirty_count=len(dirty_entries))
-
-        tombstones = sorted(
-            [entry for entry in dirty_entries if entry["tombstone"]],
-            key=lambda entry: (entry["path"].count("/"), entry["path"]),
-            reverse=True,
-        )
-        regular = sorted(
-            [entry for entry in dirty_entries if not entry["tombstone"]],
-            key=lambda entry: (entry["type"] != "folder", entry["path"].count("/"), entry["path"]),
-        )
-
-        for entry in tombstones:
-            self._sync_tombstone(entry)
-
-        for entry in regular:
-            fresh = self.state.get_entry(entry["path"])
-            if fresh is None or fresh["tombstone"] or not fresh["dirty"]:
+        # Remote handles for clean parent folders, resolved at most once per pass.
+        self.parent_nodes = {}
+        self.pending_changes = compact_ops(self.state.list_pending_ops())
+
+        self._sync_tombstones([entry for entry in dirty_entries if entry["tombstone"]])
+        self._run_sync_graph([entry for entry in dirty_entries if not entry["tombstone"]])
+
+        self._resolve_deferred_child_meta()
+
+    def _run_sync_graph(self, entries):
+        # Every entry waits for the nearest dirty entry above it, so folders are created
+        # before their contents; entries with no ordering between them sync in parallel.
+        entries = {entry["path"]: entry for entry in entries}
+        waiting = dict.fromkeys(entries, 0)
+        dependents = {path: [] for path in entries}
+        for path in entries:
+            ancestor = os.path.dirname(path) or "/"
+            while ancestor not in entries and ancestor != "/":
+                ancestor = os.path.dirname(ancestor) or "/"
+            if ancestor == path or ancestor not in entries:
                 continue
-            if fresh["type"] == "folder":
-                self._sync_directory(fresh)
-            else:
-                self._sync_file(fresh)
-
-    def _sync_tombstone(self, entry):
-        self._log_sync("delete-start", path=entry["path"], remote=bool(entry["remote_drivewsid"]))
-        if entry["remote_drivewsid"]:
+            dependents[ancestor].append(path)
+            waiting[path] += 1
+
+        ready = deque(sorted(path for path, count in waiting.items() if not count))
+        in_flight = {}
+        while ready or in_flight:
+            while ready and len(in_flight) < self.upload_workers and not self.stop_event.is_set():
+                path = ready.popleft()
+                in_flight[self.upload_executor.submit(self._sync_entry, entries[path])] = path
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    future.result()
+                except Exception as exc:
+                    self.logger.error("Failed syncing %s: %s", path, exc)
+                if dependents[path]:
+                    fresh = self.state.get_entry(path)
+                    if fresh is not None and fresh["dirty"]:
+                        self._log_sync("sync-blocked", path=path, waiting=len(dependents[path]))
+                        continue
+                for dependent in dependents[path]:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+
+    def _sync_entry(self, entry):
+        fresh = self.state.get_entry(entry["path"])
+        if fresh is None or fresh["tombstone"] or not fresh["dirty"]:
+            return
+        if fresh["type"] == "folder":
+            self._sync_directory(fresh)
+        else:
+            self._sync_file(fresh)
+
+    def _sync_tombstones(self, tombstones):
+        # A deleted subtree collapses into its topmost deleted folder: deleting that
+        # remotely takes everything synced beneath it along. What is left goes out in
+        # multi-item deleteItems requests.
+        roots = {}
+        for entry in sorted(tombstones, key=lambda entry: entry["path"]):
+            ancestor = os.path.dirname(entry["path"]) or "/"
+            while ancestor not in roots and ancestor != "/":
+                ancestor = os.path.dirname(ancestor) or "/"
+            root = roots.get(ancestor)
+            if root is not None and self._deleted_with(entry, root):
+                continue
+            roots[entry["path"]] = entry
+
+        remote = [entry for entry in roots.values() if entry["remote_drivewsid"]]
+        local = [entry for entry in roots.values() if not entry["remote_drivewsid"]]
+        failed = []
+        for start in range(0, len(remote), self.delete_batch_size):
+            batch = remote[start : start + self.delete_batch_size]
+            self._log_sync("delete-start", path=batch[0]["path"], count=len(batch))
             try:
-                node = self._node_from_entry(entry)
-                node.delete()
+                with self.broker.slot("upload"):
+                    response = delete_items(self.api.drive, [self._node_from_entry(entry) for entry in batch])
             except Exception as exc:
-                self.logger.error("Failed deleting remote path %s: %s", entry["path"], exc)
-                return
-        self.state.remove_subtree(entry["path"])
-        self._log_sync("delete-complete", path=entry["path"])
+                self.logger.error("Failed deleting %s remote paths from %s: %s", len(batch), batch[0]["path"], exc)
+                failed.extend(entry["path"] for entry in batch)
+                continue
+            items = response.get("items") if isinstance(response, dict) else None
+            statuses = {item.get("drivewsid"): item.get("status") for item in items or []}
+            for entry in batch:
+                if statuses and statuses.get(entry["remote_drivewsid"]) != "OK":
+                    self.logger.error(
+                        "Failed deleting remote path %s: %s", entry["path"], statuses.get(entry["remote_drivewsid"])
+                    )
+                    failed.append(entry["path"])
+                    continue
+                self.node_cache.invalidate(entry["remote_drivewsid"])
+                self.state.remove_subtree(entry["path"])
+                self._log_sync("delete-complete", path=entry["path"])
+
+        # A never-uploaded folder holds the tombstones of items moved into it, so it
+        # stays until every remote delete beneath it has gone through.
+        for entry in local:
+            prefix = entry["path"].rstrip("/") + "/"
+            if any(path.startswith(prefix) for path in failed):
+                continue
+            self.state.remove_subtree(entry["path"])
+
+    def _deleted_with(self, entry, root):
+        # Entries moved in from elsewhere are not inside the root remotely yet.
+        if not root["remote_drivewsid"]:
+            return not entry["remote_drivewsid"]
+        if not entry["remote_drivewsid"]:
+            return True
+        prefix = (root["synced_path"] or root["path"]).rstrip("/") + "/"
+        return (entry["synced_path"] or entry["path"]).startswith(prefix)
 
     def _sync_directory(self, entry):
         parent_node = self._ensure_remote_parent(entry["path"])
@@ -1236,8 +3015,13 @@ class ICloudSyncEngine:
                 synced_path=entry.get("synced_path"),
             )
             if not entry["remote_drivewsid"]:
-                parent_node.mkdir(os.path.basename(entry["path"]))
-                meta = self._refresh_child_meta(os.path.dirname(entry["path"]) or "/", os.path.basename(entry["path"]))
+                with self.broker.slot("upload"):
+                    response = parent_node.mkdir(os.path.basename(entry["path"]))
+                meta = self._meta_from_mkdir_response(response, entry["path"])
+                if meta is None:
+                    meta = self._refresh_child_meta(
+                        os.path.dirname(entry["path"]) or "/", os.path.basename(entry["path"])
+                    )
                 self.state.mark_clean(entry["path"], meta)
                 self._log_sync("directory-create-complete", path=entry["path"])
                 return
@@ -1266,30 +3050,164 @@ class ICloudSyncEngine:
                 self._log_sync("file-missing-marked-tombstone", path=entry["path"])
                 return
 
-            self.ensure_local_file(entry["path"])
+            self.ensure_local_file(entry["path"], priority="upload")
+
+            failure = self.state.get_upload_failure(entry["path"])
+            if (
+                failure
+                and failure["next_attempt_at"] > time.time()
+                and (failure["size"], failure["mtime"]) == (entry["size"], entry["mtime"])
+            ):
+                self._log_sync("file-sync-backoff", path=entry["path"], attempts=failure["attempts"])
+                return
 
             if entry["remote_drivewsid"] and entry["synced_path"] and entry["synced_path"] != entry["path"]:
-                self._sync_move_or_rename(entry)
+                node = self._sync_move_or_rename(entry)
+                if not self._content_changed(entry):
+                    self.state.mark_clean(entry["path"], {"remote_etag": node.data.get("etag")})
+                    self._log_sync("file-sync-complete", path=entry["path"], moved_only=True)
+                    return
                 entry = self.state.get_entry(entry["path"])
 
-            if entry["remote_drivewsid"]:
-                try:
-                    self._node_from_entry(entry).delete()
-                except Exception:
-                    pass
-
-            with open(self.mirror.local_path(entry["path"]), "rb") as handle:
-                file_obj = BytesIO(handle.read())
-            file_obj.name = os.path.basename(entry["path"])
-            parent_node.upload(file_obj)
-
-            meta = self._refresh_child_meta(os.path.dirname(entry["path"]) or "/", os.path.basename(entry["path"]))
+            response = self._upload_file(entry, parent_node)
             checksum = self.mirror.file_sha256(entry["path"])
+            meta = self._meta_from_upload_response(response, entry["path"], parent_node.data)
+            if meta is None:
+                self._defer_child_meta(entry["path"], checksum)
+                self._log_sync("file-sync-uploaded", path=entry["path"], meta="deferred")
+                return
             self.state.mark_clean(entry["path"], meta, checksum)
             self._log_sync("file-sync-complete", path=entry["path"], size=meta.get("size"))
         except Exception as exc:
             self.logger.error("Failed syncing file %s: %s", entry["path"], exc)
 
+    def _upload_file(self, entry, parent_node):
+        mtime = self.mirror.stat_local(entry["path"]).st_mtime
+        # Unbuffered so the name can be set: pyicloud names the remote file after
+        # file_object.name, and the content is streamed from disk.
+        with open(self.mirror.local_path(entry["path"]), "rb", buffering=0) as handle:
+            handle.name = os.path.basename(entry["path"])
+            try:
+                if entry["remote_drivewsid"] and entry["remote_docwsid"]:
+                    try:
+                        with self.session_pool.checkout("upload") as api:
+                            return upload_document(
+                                api.drive,
+                                parent_node.data,
+                                handle,
+                                replace_document_id=entry["remote_docwsid"],
+                                throttle=self._throttle_upload,
+                                slot=self._upload_slot,
+                                mtime=mtime,
+                                ctime=mtime,
+                            )
+                    except PyiCloudAPIResponseException as exc:
+                        # Only a refusal of the replace itself falls back to delete-then-upload;
+                        # auth, throttling, connection and server errors are retried as they are.
+                        if self._is_auth_error(exc) or is_throttle_error(exc) or not is_replace_rejected(exc):
+                            raise
+                        self._log_sync("file-replace-rejected", path=entry["path"], error=str(exc))
+                        handle.seek(0)
+                    try:
+                        with self.broker.slot("upload"):
+                            self._node_from_entry(entry).delete()
+                    except Exception as exc:
+                        self._log_sync(
+                            "file-replace-delete-failed", level=logging.WARNING, path=entry["path"], error=str(exc)
+                        )
+                with self.session_pool.checkout("upload") as api:
+                    return upload_document(
+                        api.drive,
+                        parent_node.data,
+                        handle,
+                        throttle=self._throttle_upload,
+                        slot=self._upload_slot,
+                        mtime=mtime,
+                        ctime=mtime,
+                    )
+            except Exception as exc:
+                if not self._is_auth_error(exc):
+                    self._record_upload_failure(entry, exc)
+                raise
+
+    def _throttle_upload(self, amount):
+        self.upload_bucket.consume(amount, self.stop_event)
+
+    def _upload_slot(self):
+        return self.broker.slot("upload")
+
+    def _record_upload_failure(self, entry, exc):
+        # The content endpoint takes the whole file in one POST under a fresh upload
+        # URL each time, so a retry sends the file again from its first byte.
+        failure = self.state.get_upload_failure(entry["path"])
+        attempt = (failure["attempts"] if failure else 0) + 1
+        retry_delay = self._retry_delay_for_attempt(attempt)
+        self.state.record_upload_failure(
+            entry["path"], attempt, time.time() + retry_delay, entry["size"], entry["mtime"], str(exc)
+        )
+        self._log_sync(
+            "file-sync-failed",
+            path=entry["path"],
+            attempt=attempt,
+            retry_in=retry_delay,
+        )
+
+    def _meta_from_mkdir_response(self, response, path):
+        folders = response.get("folders") if isinstance(response, dict) else None
+        for folder in folders or []:
+            if folder.get("drivewsid") and folder.get("name") == os.path.basename(path):
+                return self._node_to_meta(DriveNode(self.api.drive, folder), path)
+        return None
+
+    def _meta_from_upload_response(self, response, path, folder):
+        if folder.get("shareID") or not isinstance(response, dict):
+            return None
+        for result in response.get("results") or []:
+            document = result.get("document") or {}
+            if not document.get("document_id") or not document.get("etag"):
+                continue
+            zone = document.get("zone") or folder.get("zone")
+            return {
+                "path": path,
+                "type": "file",
+                "parent_path": os.path.dirname(path) or "/",
+                "remote_drivewsid": f"FILE::{zone}::{document['document_id']}",
+                "remote_docwsid": document["document_id"],
+                "remote_etag": document["etag"],
+                "remote_zone": zone,
+                "size": int(document.get("size", 0) or 0),
+                "mtime": int(document["mtime"] / 1000) if document.get("mtime") else int(time.time()),
+            }
+        return None
+
+    def _defer_child_meta(self, path, checksum):
+        parent_path = os.path.dirname(path) or "/"
+        with self.deferred_child_meta_lock:
+            self.deferred_child_meta.setdefault(parent_path, {})[os.path.basename(path)] = checksum
+
+    def _resolve_deferred_child_meta(self):
+        with self.deferred_child_meta_lock:
+            deferred = self.deferred_child_meta
+            self.deferred_child_meta = {}
+        for parent_path, names in deferred.items():
+            try:
+                parent = self._remote_node_for_path(parent_path)
+                if parent is None:
+                    raise RuntimeError(f"Missing remote parent: {parent_path}")
+                with self.broker.slot("upload"):
+                    children = {child.name: child for child in parent.get_children(force=True)}
+            except Exception as exc:
+                self.logger.error("Failed listing %s for uploaded file metadata: %s", parent_path, exc)
+                continue
+            for name, checksum in names.items():
+                path = "/" + name if parent_path == "/" else parent_path.rstrip("/") + "/" + name
+                child = children.get(name)
+                if child is None:
+                    self.logger.error("Uploaded file %s is missing from its remote folder listing", path)
+                    continue
+                self.state.mark_clean(path, self._node_to_meta(child, path), checksum)
+                self._log_sync("file-sync-complete", path=path, size=child.data.get("size"))
+
     def _sync_move_or_rename(self, entry):
         synced_path = entry["synced_path"]
         if not synced_path:
@@ -1300,24 +3218,59 @@ class ICloudSyncEngine:
         new_name = os.path.basename(entry["path"])
 
         self._log_sync("move-start", path=synced_path, target_path=entry["path"])
+        self._forget_parent_nodes(entry["path"])
+        self._forget_parent_nodes(synced_path)
         node = self._node_from_entry(entry)
         if old_parent != new_parent:
             destination = self._remote_node_for_path(new_parent)
             if destination is None:
                 raise RuntimeError(f"Remote parent not available for {new_parent}")
-            self.api.drive.move_nodes_to_node([node], destination)
-            node = self._refresh_node_by_id(
-                entry["remote_drivewsid"],
-                entry.get("remote_shareid"),
-            )
+            with self.broker.slot("upload"):
+                response = self.api.drive.move_nodes_to_node([node], destination)
+            if not self._update_node_from_response(node, response):
+                node = self._refresh_node_by_id(
+                    entry["remote_drivewsid"],
+                    entry.get("remote_shareid"),
+                )
         if old_name != new_name:
-            node.rename(new_name)
+            with self.broker.slot("upload"):
+                response = node.rename(new_name)
+            if not self._update_node_from_response(node, response):
+                node = self._refresh_node_by_id(
+                    entry["remote_drivewsid"],
+                    entry.get("remote_shareid"),
+                )
+        self.state.set_remote_etag(entry["path"], node.data.get("etag"))
+        self.node_cache.put(node)
         self._log_sync("move-complete", path=synced_path, target_path=entry["path"])
+        return node
+
+    def _content_changed(self, entry):
+        # Dirty files with nothing in the op log (e.g. after utime) are re-uploaded.
+        changes = self.pending_changes.get(entry["path"])
+        return not changes or bool(changes & {"create", "update"})
+
+    def _update_node_from_response(self, node, response):
+        items = response.get("items") if isinstance(response, dict) else None
+        for item in items or []:
+            if item.get("drivewsid") == node.data["drivewsid"] and item.get("etag"):
+                node.data = {**node.data, **item}
+                return True
+        return False
+
+    def _forget_parent_nodes(self, path):
+        prefix = path.rstrip("/") + "/"
+        for cached_path in list(self.parent_nodes):
+            if cached_path == path or cached_path.startswith(prefix):
+                self.parent_nodes.pop(cached_path, None)
 
     def _ensure_remote_parent(self, path):
         parent_path = os.path.dirname(path) or "/"
         if parent_path == "/":
             return self.api.drive.root
+        cached = self.parent_nodes.get(parent_path)
+        if cached is not None:
+            return cached
         parent_entry = self.state.get_entry(parent_path)
         if not parent_entry:
             return None
@@ -1326,13 +3279,18 @@ class ICloudSyncEngine:
             parent_entry = self.state.get_entry(parent_path)
         if not parent_entry or not parent_entry["remote_drivewsid"]:
             return None
-        return self._node_from_entry(parent_entry)
+        node = self._node_from_entry(parent_entry)
+        if not parent_entry["dirty"]:
+            self.parent_nodes[parent_path] = node
+        return node
 
     def _refresh_child_meta(self, parent_path, child_name):
         parent = self._remote_node_for_path(parent_path)
         if parent is None:
             raise RuntimeError(f"Missing remote parent: {parent_path}")
-        for child in parent.get_children(force=True):
+        with self.broker.slot("upload"):
+            children = parent.get_children(force=True)
+        for child in children:
             if child.name == child_name:
                 return self._node_to_meta(
                     child,
@@ -1343,16 +3301,25 @@ class ICloudSyncEngine:
     def _remote_node_for_path(self, path):
         if path == "/" or path == "":
             return self.api.drive.root
+        cached = self.parent_nodes.get(path)
+        if cached is not None:
+            return cached
         entry = self.state.get_entry(path)
         if not entry or not entry["remote_drivewsid"]:
             return None
         return self._node_from_entry(entry)
 
     def _refresh_node_by_id(self, remote_drivewsid, remote_shareid=None):
-        data = self.api.drive.get_node_data(remote_drivewsid, remote_shareid)
-        return DriveNode(self.api.drive, data)
+        with self.broker.slot("upload"):
+            data = self.api.drive.get_node_data(remote_drivewsid, remote_shareid)
+        node = DriveNode(self.api.drive, data)
+        self.node_cache.put(node)
+        return node
 
     def _node_from_entry(self, entry):
+        cached = self.node_cache.get(entry["remote_drivewsid"], entry.get("remote_etag"))
+        if cached is not None:
+            return cached
         data = {
             "drivewsid": entry["remote_drivewsid"],
             "docwsid": entry.get("remote_docwsid"),
@@ -1363,7 +3330,9 @@ class ICloudSyncEngine:
             "type": entry.get("type", "file").upper(),
             "name": os.path.basename(entry["path"].rstrip("/")) or "root",
         }
-        return DriveNode(self.api.drive, data)
+        node = DriveNode(self.api.drive, data)
+        self.node_cache.put(node)
+        return node
 
     def _node_to_meta(self, node, path):
         data = node.data
@@ -1401,13 +3370,23 @@ class ICloudSyncEngine:
             else dirname.rstrip("/") + "/" + f"{basename}.local-conflict-{stamp}"
         )
 
+    @contextlib.contextmanager
     def _path_lock(self, path):
+        # Entries are reference counted and dropped once no thread holds or waits on
+        # them, so the table only ever covers paths being worked on right now.
         with self.path_locks_lock:
-            lock = self.path_locks.get(path)
-            if lock is None:
-                lock = threading.Lock()
-                self.path_locks[path] = lock
-            return lock
+            holder = self.path_locks.get(path)
+            if holder is None:
+                holder = self.path_locks[path] = [threading.Lock(), 0]
+            holder[1] += 1
+        try:
+            with holder[0]:
+                yield
+        finally:
+            with self.path_locks_lock:
+                holder[1] -= 1
+                if not holder[1]:
+                    del self.path_locks[path]
 
 
 class ICloudFS(Fuse):
@@ -1421,6 +3400,7 @@ class ICloudFS(Fuse):
         self.mirror = None
         self.state = None
         self.sync_engine = None
+        self.transfer_sessions = []
 
     def _log_file_op(self, op, path=None, level=logging.INFO, **fields):
         payload = {}
@@ -1437,7 +3417,7 @@ class ICloudFS(Fuse):
         if self.sync_engine is not None:
             self.sync_engine.shutdown()
 
-    def init_icloud(self, username, password, cache_dir, cookie_dir=None):
+    def init_icloud(self, username, password, cache_dir, cookie_dir=None, session_pool_size=1):
         self.username = username
         self.password = password
         self.cache_dir = cache_dir
@@ -1486,6 +3466,34 @@ class ICloudFS(Fuse):
             self.logger.error("Failed to connect to iCloud: %s", exc)
             raise
 
+        if session_pool_size > 1:
+            self.transfer_sessions = self._open_transfer_sessions(username, password, cookie_dir, session_pool_size)
+
+    def _open_transfer_sessions(self, username, password, cookie_dir, count):
+        if not cookie_dir:
+            self.logger.warning("session_pool_size needs cookie_dir; transfers will share the main session")
+            return []
+        return [
+            LazySession(
+                lambda index=index: self._open_transfer_session(username, password, cookie_dir, index),
+                self.api,
+                self.logger,
+            )
+            for index in range(count)
+        ]
+
+    def _open_transfer_session(self, username, password, cookie_dir, index):
+        # Each extra session starts from a copy of the cookies the main session has
+        # just refreshed, so it signs in with the trusted session token and never
+        # writes to the main cookie jar.
+        session_dir = os.path.join(self.cache_dir, "sessions", str(index))
+        shutil.rmtree(session_dir, ignore_errors=True)
+        shutil.copytree(cookie_dir, session_dir)
+        api = PyiCloudService(username, password, cookie_directory=session_dir)
+        if api.requires_2fa or api.requires_2sa:
+            raise RuntimeError("session was not trusted")
+        return api
+
     def init_local_cache(
         self,
         cache_dir,
@@ -1494,6 +3502,7 @@ class ICloudFS(Fuse):
         upload_interval_seconds,
         remote_refresh_interval_seconds,
         warmup_workers,
+        **sync_options,
     ):
         self.mirror = LocalMirror(cache_dir)
         state_path = os.path.join(cache_dir, "state.sqlite3")
@@ -1508,12 +3517,17 @@ class ICloudFS(Fuse):
             upload_interval_seconds=upload_interval_seconds,
             remote_refresh_interval_seconds=remote_refresh_interval_seconds,
             warmup_workers=warmup_workers,
+            transfer_sessions=self.transfer_sessions,
+            **sync_options,
         )
         self.sync_engine.start()
 
     def getattr(self, path):
         now = int(time.time())
         entry = self.state.get_entry(path) if self.state else None
+        if entry is None and self.sync_engine is not None and path != "/":
+            self._ensure_listed(os.path.dirname(path))
+            entry = self.state.get_entry(path)
         attrs = Stat()
 
         if path == "/":
@@ -1553,12 +3567,30 @@ class ICloudFS(Fuse):
 
         return -errno.ENOENT
 
+    def _ensure_listed(self, path):
+        try:
+            self.sync_engine.ensure_listed(path)
+        except Exception as exc:
+            self.logger.error("Failed listing %s on demand: %s", path, exc)
+
     def readdir(self, path, offset):
+        self._ensure_listed(path)
+        entry = self.state.get_entry(path)
+        if entry and entry["type"] == "folder" and not entry["tombstone"] and not self.mirror.exists(path):
+            # Not recreated by startup reconciliation yet.
+            self.mirror.ensure_dir(path)
         if not self.mirror.exists(path) or not self.mirror.is_dir(path):
             return -errno.ENOENT
 
         self._log_file_op("readdir", path, level=logging.DEBUG)
-        entries = [".", ".."] + sorted(self.mirror.listdir(path))
+        self.sync_engine.revalidate_directory(path)
+        names = set(self.mirror.listdir(path))
+        if not self.sync_engine.ready.is_set():
+            # Files whose placeholders reconciliation has not restored yet.
+            names.update(
+                os.path.basename(child["path"]) for child in self.state.list_children(path) if not child["tombstone"]
+            )
+        entries = [".", ".."] + sorted(names)
         for entry in entries:
             yield fuse.Direntry(entry)
 
@@ -1597,6 +3629,7 @@ class ICloudFS(Fuse):
                 }
             )
             self.state.queue_op("create", path)
+            self.sync_engine.notify_local_change(path)
             self._log_file_op("create", path, mode=oct(mode), flags=flags)
             return 0
         except Exception as exc:
@@ -1648,6 +3681,7 @@ class ICloudFS(Fuse):
             else:
                 self.state.mark_dirty(path, stats.st_size, int(stats.st_mtime), 1, checksum)
             self.state.queue_op("update", path)
+            self.sync_engine.notify_local_change(path)
             self._log_file_op("write", path, size=len(buf), offset=offset, written=written)
             return written
         except Exception as exc:
@@ -1658,6 +3692,7 @@ class ICloudFS(Fuse):
         return 0
 
     def release(self, path, flags):
+        self.sync_engine.notify_local_change(path, settled=True)
         return 0
 
     def mkdir(self, path, mode):
@@ -1678,6 +3713,7 @@ class ICloudFS(Fuse):
                 }
             )
             self.state.queue_op("mkdir", path)
+            self.sync_engine.notify_local_change(path)
             self._log_file_op("mkdir", path, mode=oct(mode))
             return 0
         except Exception as exc:
@@ -1691,11 +3727,14 @@ class ICloudFS(Fuse):
 
         try:
             self.mirror.remove_dir(path)
-            if entry["remote_drivewsid"]:
+            # Rows left under an emptied folder are tombstones still owed a remote delete.
+            if entry["remote_drivewsid"] or self.state.list_children(path):
                 self.state.mark_tombstone(path)
                 self.state.queue_op("delete", path)
+                self.sync_engine.notify_local_change(path)
             else:
                 self.state.remove_subtree(path)
+            self.sync_engine.forget_download_retries(path, subtree=True)
             self._log_file_op("rmdir", path)
             return 0
         except OSError as exc:
@@ -1715,8 +3754,10 @@ class ICloudFS(Fuse):
             if entry["remote_drivewsid"]:
                 self.state.mark_tombstone(path)
                 self.state.queue_op("delete", path)
+                self.sync_engine.notify_local_change(path)
             else:
                 self.state.remove_entry(path)
+            self.sync_engine.forget_download_retries(path)
             self._log_file_op("unlink", path)
             return 0
         except OSError as exc:
@@ -1733,15 +3774,15 @@ class ICloudFS(Fuse):
         try:
             if self.mirror.exists(newpath):
                 self.mirror.remove_tree(newpath)
-                existing = self.state.get_entry(newpath)
-                if existing:
-                    if existing["remote_drivewsid"]:
-                        self.state.mark_tombstone(newpath)
-                    else:
-                        self.state.remove_subtree(newpath)
             self.mirror.rename_path(oldpath, newpath)
-            self.state.rename_tree(oldpath, newpath, root_dirty=True)
+            if self.state.get_entry(newpath):
+                self.state.replace_tree(oldpath, newpath)
+            else:
+                self.state.rename_tree(oldpath, newpath, root_dirty=True)
             self.state.queue_op("rename", oldpath, newpath)
+            self.sync_engine.notify_local_change(newpath)
+            self.sync_engine.forget_download_retries(newpath, subtree=True)
+            self.sync_engine.move_download_retries(oldpath, newpath)
             self._log_file_op("rename", oldpath, target_path=newpath)
             return 0
         except Exception as exc:
@@ -1779,6 +3820,7 @@ class ICloudFS(Fuse):
             else:
                 self.state.mark_dirty(path, stats.st_size, int(stats.st_mtime), 1, checksum)
             self.state.queue_op("update", path)
+            self.sync_engine.notify_local_change(path)
             self._log_file_op("truncate", path, length=length)
             return 0
         except Exception as exc:
@@ -1799,6 +3841,7 @@ class ICloudFS(Fuse):
             stats = self.mirror.stat_local(path)
             if self.state.get_entry(path):
                 self.state.mark_dirty(path, stats.st_size, int(stats.st_mtime))
+                self.sync_engine.notify_local_change(path)
             self._log_file_op("utime", path, atime=int(atime), mtime=int(mtime))
             return 0
         except Exception as exc:
@@ -1841,6 +3884,14 @@ def parse_config(config_path):
         sys.exit(1)
 
 
+def bandwidth_options(config):
+    return {
+        "download_bytes_per_second": int(config.get("download_bytes_per_second", 0)),
+        "upload_bytes_per_second": int(config.get("upload_bytes_per_second", 0)),
+        "throttle_interactive_downloads": bool(config.get("throttle_interactive_downloads", False)),
+    }
+
+
 def main():
     usage = """
 iCloud Linux: Mount iCloud Drive as a FUSE filesystem
@@ -1885,8 +3936,30 @@ iCloud Linux: Mount iCloud Drive as a FUSE filesystem
     upload_interval_seconds = int(config.get("upload_interval_seconds", 30))
     remote_refresh_interval_seconds = int(config.get("remote_refresh_interval_seconds", 300))
     warmup_workers = int(config.get("warmup_workers", 1))
-
-    fs.init_icloud(username, password, cache_dir, cookie_dir)
+    sync_options = {
+        "warmup_order": config.get("warmup_order", "path"),
+        "warmup_include": config.get("warmup_include") or [],
+        "warmup_exclude": config.get("warmup_exclude") or [],
+        "warmup_max_file_size": int(config.get("warmup_max_file_size", 0)),
+        "reconcile_workers": int(config.get("reconcile_workers", 8)),
+        "crawl_workers": int(config.get("crawl_workers", 4)),
+        "crawl_requests_per_second": float(config.get("crawl_requests_per_second", 0)),
+        "crawl_batch_size": int(config.get("crawl_batch_size", 10)),
+        "refresh_min_interval_seconds": float(config.get("refresh_min_interval_seconds", 15)),
+        "refresh_max_interval_seconds": float(config.get("refresh_max_interval_seconds", 86400)),
+        "refresh_overrides": config.get("refresh_overrides") or {},
+        "refresh_max_requests_per_minute": int(config.get("refresh_max_requests_per_minute", 30)),
+        "directory_ttl_seconds": float(config.get("directory_ttl_seconds", 30)),
+        "node_cache_size": int(config.get("node_cache_size", 4096)),
+        "upload_workers": int(config.get("upload_workers", 4)),
+        "upload_debounce_seconds": float(config.get("upload_debounce_seconds", 2)),
+        "delete_batch_size": int(config.get("delete_batch_size", 100)),
+        "request_concurrency_initial": int(config.get("request_concurrency_initial", 4)),
+        "request_concurrency_max": int(config.get("request_concurrency_max", 32)),
+        **bandwidth_options(config),
+    }
+
+    fs.init_icloud(username, password, cache_dir, cookie_dir, int(config.get("session_pool_size", 1)))
     fs.init_local_cache(
         cache_dir,
         warmup_mode,
@@ -1894,6 +3967,7 @@ iCloud Linux: Mount iCloud Drive as a FUSE filesystem
         upload_interval_seconds,
         remote_refresh_interval_seconds,
         warmup_workers,
+        **sync_options,
     )
 
     atexit.register(fs.shutdown)
@@ -1903,8 +3977,22 @@ iCloud Linux: Mount iCloud Drive as a FUSE filesystem
         fs.shutdown()
         raise SystemExit(0)
 
+    def handle_reload(signum, frame):
+        # Only the bandwidth limits are applied live; other settings still need a restart.
+        logger.info("Received signal %s, reloading bandwidth limits from %s", signum, args.config)
+        if fs.sync_engine is None:
+            return
+        try:
+            with open(args.config, "r", encoding="utf-8") as handle:
+                options = bandwidth_options(yaml.safe_load(handle) or {})
+        except Exception as exc:
+            logger.error("Keeping current bandwidth limits; failed to reload %s: %s", args.config, exc)
+            return
+        fs.sync_engine.set_bandwidth_limits(**options)
+
     signal.signal(signal.SIGTERM, handle_shutdown)
     signal.signal(signal.SIGINT, handle_shutdown)
+    signal.signal(signal.SIGHUP, handle_reload)
 
     try:
         fs.main()
@@ -1,12 +1,454 @@
+import errno
+import hashlib
+import io
+import itertools
+import logging
+import json
 import os
+import random
 import shutil
+import socket
 import sqlite3
+import struct
 import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
-from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
 
-from driver import ICloudSyncEngine, LocalMirror, SyncState
 from pyicloud.exceptions import PyiCloudAPIResponseException, PyiCloudFailedLoginException
+from pyicloud.services.drive import DriveService
+import requests
+from requests import Response
+from requests.cookies import RequestsCookieJar
+
+from driver import (
+    ROOT_DRIVEWSID,
+    WARMUP_ORDERS,
+    CrawlInterrupted,
+    DelayScheduler,
+    ICloudFS,
+    ICloudSyncEngine,
+    LazySession,
+    LocalMirror,
+    RequestBroker,
+    SyncState,
+    TokenBucket,
+    WarmupRules,
+    compact_ops,
+    retrieve_folder_details,
+)
+
+
+SERVICE_ROOT = "https://drivews.fake"
+DOCUMENT_ROOT = "https://docws.fake"
+CONTENT_ROOT = "https://content.fake"
+
+
+def fake_response(payload=None, status_code=200, content=None):
+    response = Response()
+    response.status_code = status_code
+    response.reason = "OK" if status_code < 400 else "Error"
+    if content is not None:
+        response.raw = io.BytesIO(content)
+    else:
+        response._content = json.dumps(payload).encode("utf-8")
+    return response
+
+
+def multipart_content(body):
+    content = body.partition(b"\r\n\r\n")[2]
+    return content[: content.rindex(b"\r\n--")]
+
+
+class TruncatedStream(io.BytesIO):
+    # Serves `limit` bytes and then fails the way a dropped connection does.
+    def __init__(self, content, limit):
+        super().__init__(content)
+        self.limit = limit
+
+    def read(self, size=-1):
+        remaining = self.limit - self.tell()
+        if remaining <= 0:
+            raise ConnectionResetError("connection dropped")
+        return super().read(remaining if size < 0 else min(size, remaining))
+
+
+class BusyUntilRead:
+    # Wraps a streamed body so its session stays busy until the body is read to the end.
+    def __init__(self, raw, release):
+        self.raw = raw
+        self.release = release
+
+    def read(self, size=-1):
+        try:
+            chunk = self.raw.read(size)
+        except Exception:
+            self.done()
+            raise
+        if not chunk:
+            self.done()
+        return chunk
+
+    def done(self):
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+
+class FakeICloudSession:
+    # Serves the iCloud Drive web endpoints pyicloud talks to from an in-memory tree.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        self.tree_lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.nodes = {}
+        self.contents = {}
+        self.staged_uploads = {}
+        self.download_ranges = []
+        self.download_cutoff = None
+        self.cookies = RequestsCookieJar()
+        self.cookies.set("X-APPLE-WEBAUTH-VALIDATE", "v=1:t=token")
+        self.nodes[ROOT_DRIVEWSID] = {
+            "drivewsid": ROOT_DRIVEWSID,
+            "docwsid": "root",
+            "zone": "com.apple.CloudDocs",
+            "name": "root",
+            "type": "FOLDER",
+            "etag": "root-1",
+            "parent": None,
+        }
+
+    def drive(self):
+        return DriveService(SERVICE_ROOT, DOCUMENT_ROOT, self, {"clientId": "test-client"})
+
+    def api(self):
+        return SimpleNamespace(drive=self.drive())
+
+    def count(self, endpoint):
+        with self.calls_lock:
+            return sum(1 for call in self.calls if call == endpoint)
+
+    def add_folder(self, parent_id, name):
+        return self._add_node(parent_id, name, "FOLDER")
+
+    def add_file(self, parent_id, name, content=b""):
+        drivewsid = self._add_node(parent_id, name, "FILE", size=len(content))
+        self.contents[self.nodes[drivewsid]["docwsid"]] = content
+        return drivewsid
+
+    def find(self, path):
+        current = ROOT_DRIVEWSID
+        for part in [piece for piece in path.split("/") if piece]:
+            current = next(
+                node_id
+                for node_id, node in self.nodes.items()
+                if node["parent"] == current and node["name"] == part
+            )
+        return self.nodes[current]
+
+    def children(self, drivewsid):
+        return [node for node in self.nodes.values() if node["parent"] == drivewsid]
+
+    def _add_node(self, parent_id, name, node_type, size=0, docwsid=None):
+        number = next(self.ids)
+        docwsid = docwsid or f"doc-{number}"
+        drivewsid = f"{node_type}::com.apple.CloudDocs::{docwsid}"
+        self.nodes[drivewsid] = {
+            "drivewsid": drivewsid,
+            "docwsid": docwsid,
+            "zone": "com.apple.CloudDocs",
+            "name": name,
+            "type": node_type,
+            "etag": f"etag-{number}",
+            "size": size,
+            "dateModified": "2024-01-01T00:00:00Z",
+            "parent": parent_id,
+        }
+        return drivewsid
+
+    def _public(self, node):
+        data = {key: value for key, value in node.items() if key != "parent"}
+        if node["parent"]:
+            data["parentId"] = node["parent"]
+        if node["type"] == "FOLDER":
+            data.pop("size", None)
+        return data
+
+    def _record(self, endpoint):
+        with self.calls_lock:
+            self.calls.append(endpoint)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def post(self, url, params=None, json=None, headers=None, files=None, data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        if url.startswith(CONTENT_ROOT):
+            endpoint = "content"
+        self._record(endpoint)
+        handler = getattr(self, "_post_" + endpoint.replace("/", "_"))
+        with self.tree_lock:
+            return handler(url, json, files if files is not None else data)
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        if url.startswith(CONTENT_ROOT):
+            self._record("download-content")
+            docwsid = url.rsplit("/", 1)[-1]
+            content = self.contents[docwsid]
+            requested = (headers or {}).get("Range")
+            self.download_ranges.append(requested)
+            response = fake_response(content=content)
+            if requested:
+                offset = int(requested[len("bytes="):].rstrip("-"))
+                response = fake_response(content=content[offset:], status_code=206)
+            if self.download_cutoff is not None:
+                response.raw = TruncatedStream(response.raw.read(), self.download_cutoff)
+            return response
+        self._record("download")
+        docwsid = params["document_id"]
+        return fake_response({"data_token": {"url": f"{CONTENT_ROOT}/download/{docwsid}"}})
+
+    def _post_retrieveItemDetailsInFolders(self, url, payload, files):
+        results = []
+        for item in payload:
+            node = self.nodes.get(item["drivewsid"])
+            if node is None:
+                results.append({"drivewsid": item["drivewsid"], "status": "ID_INVALID"})
+                continue
+            data = self._public(node)
+            data["items"] = [self._public(child) for child in self.children(node["drivewsid"])]
+            data["numberOfItems"] = len(data["items"])
+            results.append(data)
+        return fake_response(results)
+
+    def _post_createFolders(self, url, payload, files):
+        created = []
+        for folder in payload["folders"]:
+            drivewsid = self.add_folder(payload["destinationDrivewsId"], folder["name"])
+            created.append(self._public(self.nodes[drivewsid]))
+        return fake_response({"destinationDrivewsId": payload["destinationDrivewsId"], "folders": created})
+
+    def _post_deleteItems(self, url, payload, files):
+        deleted = []
+        for item in payload["items"]:
+            self._remove_tree(item["drivewsid"])
+            deleted.append({"drivewsid": item["drivewsid"], "status": "OK"})
+        return fake_response({"items": deleted})
+
+    def _post_renameItems(self, url, payload, files):
+        renamed = []
+        for item in payload["items"]:
+            node = self.nodes[item["drivewsid"]]
+            node["name"] = item["name"]
+            node["etag"] = node["etag"] + "r"
+            renamed.append(self._public(node))
+        return fake_response({"items": renamed})
+
+    def _post_moveItems(self, url, payload, files):
+        moved = []
+        for item in payload["items"]:
+            node = self.nodes[item["drivewsid"]]
+            node["parent"] = payload["destinationDrivewsId"]
+            node["etag"] = node["etag"] + "m"
+            moved.append(self._public(node))
+        return fake_response({"items": moved})
+
+    def _post_web(self, url, payload, files):
+        token = f"upload-{next(self.ids)}"
+        return fake_response([{"document_id": token, "url": f"{CONTENT_ROOT}/upload/{token}"}])
+
+    def _post_content(self, url, payload, files):
+        return fake_response(self.stage_upload(url, files.read()))
+
+    def stage_upload(self, url, body):
+        token = url.rsplit("/", 1)[-1]
+        data = multipart_content(body)
+        self.staged_uploads[token] = data
+        return {
+            "singleFile": {
+                "fileChecksum": token,
+                "wrappingKey": "key",
+                "referenceChecksum": "ref",
+                "size": len(data),
+                "receipt": "receipt",
+            }
+        }
+
+    def _post_documents(self, url, payload, files):
+        content = self.staged_uploads.pop(payload["data"]["signature"])
+        parent = next(
+            node for node in self.nodes.values() if node["docwsid"] == payload["path"]["starting_document_id"]
+        )
+        name = payload["path"]["path"]
+        existing = [node for node in self.nodes.values() if node["docwsid"] == payload["document_id"]]
+        if existing:
+            node = existing[0]
+            node["etag"] = node["etag"] + "u"
+            node["size"] = len(content)
+        else:
+            drivewsid = self._add_node(
+                parent["drivewsid"], name, "FILE", size=len(content), docwsid=payload["document_id"]
+            )
+            node = self.nodes[drivewsid]
+        self.contents[node["docwsid"]] = content
+        return fake_response(
+            {
+                "results": [
+                    {
+                        "document": {
+                            "document_id": node["docwsid"],
+                            "item_id": node["drivewsid"],
+                            "etag": node["etag"],
+                            "name": node["name"],
+                            "type": "FILE",
+                            "size": node["size"],
+                            "mtime": payload["mtime"],
+                            "zone": node["zone"],
+                        }
+                    }
+                ]
+            }
+        )
+
+    def _remove_tree(self, drivewsid):
+        for child in self.children(drivewsid):
+            self._remove_tree(child["drivewsid"])
+        node = self.nodes.pop(drivewsid, None)
+        if node is not None:
+            self.contents.pop(node["docwsid"], None)
+
+
+class FlakyUploadHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        if self.server.failures:
+            # Hang up with a reset partway through the request body.
+            self.server.failures -= 1
+            self.rfile.read(self.server.random.randint(1, length - 1))
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        payload = json.dumps(self.server.session.stage_upload(self.path, self.rfile.read(length))).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FlakyUploadSession(FakeICloudSession):
+    # Sends file content to a real local HTTP server that drops the first uploads.
+    def __init__(self, failures):
+        super().__init__()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyUploadHandler)
+        self.server.session = self
+        self.server.failures = failures
+        self.server.random = random.Random(7)
+        self.server_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _post_web(self, url, payload, files):
+        token = f"upload-{next(self.ids)}"
+        return fake_response([{"document_id": token, "url": f"{self.server_url}/upload/{token}"}])
+
+    def post(self, url, params=None, json=None, headers=None, files=None, data=None, **kwargs):
+        if not url.startswith(self.server_url):
+            return super().post(url, params=params, json=json, headers=headers, files=files, data=data, **kwargs)
+        self._record("content")
+        return requests.post(url, data=data, headers=headers, timeout=10)
+
+
+class ExclusiveSession:
+    # Another client of the same fake drive that fails if two requests overlap on it,
+    # counting a streamed download as in use until its body has been read.
+    def __init__(self, backend, latency=0.02):
+        self.backend = backend
+        self.latency = latency
+        self.cookies = backend.cookies
+        self.busy = threading.Lock()
+        self.requests = 0
+
+    def api(self):
+        return SimpleNamespace(drive=DriveService(SERVICE_ROOT, DOCUMENT_ROOT, self, {"clientId": "test-client"}))
+
+    def _exclusive(self, method, *args, **kwargs):
+        if not self.busy.acquire(blocking=False):
+            raise RuntimeError("session used by two requests at once")
+        streaming = False
+        try:
+            self.requests += 1
+            time.sleep(self.latency)
+            response = method(*args, **kwargs)
+            if kwargs.get("stream"):
+                response.raw = BusyUntilRead(response.raw, self.busy.release)
+                streaming = True
+            return response
+        finally:
+            if not streaming:
+                self.busy.release()
+
+    def post(self, *args, **kwargs):
+        return self._exclusive(self.backend.post, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._exclusive(self.backend.get, *args, **kwargs)
+
+
+class SyntheticICloudSession(FakeICloudSession):
+    # Generates folder listings on demand so arbitrarily large drives cost no test memory.
+    def __init__(self, folders, files_per_folder):
+        super().__init__()
+        self.folders = folders
+        self.files_per_folder = files_per_folder
+
+    def _post_retrieveItemDetailsInFolders(self, url, payload, files):
+        results = []
+        for item in payload:
+            drivewsid = item["drivewsid"]
+            if drivewsid == ROOT_DRIVEWSID:
+                items = [self._synthetic("FOLDER", f"f-{index}") for index in range(self.folders)]
+            else:
+                folder = drivewsid.rsplit("::", 1)[-1]
+                items = [
+                    self._synthetic("FILE", f"{folder}-{index}", size=index)
+                    for index in range(self.files_per_folder)
+                ]
+            results.append({"drivewsid": drivewsid, "type": "FOLDER", "items": items})
+        return fake_response(results)
+
+    def _synthetic(self, node_type, name, size=0):
+        return {
+            "drivewsid": f"{node_type}::com.apple.CloudDocs::{name}",
+            "docwsid": name,
+            "zone": "com.apple.CloudDocs",
+            "name": name,
+            "type": node_type,
+            "etag": "1",
+            "size": size,
+            "dateModified": "2024-01-01T00:00:00Z",
+        }
+
+
+def build_fake_tree(session, folders=3, subfolders=5, files=2):
+    for index in range(folders):
+        top = session.add_folder(ROOT_DRIVEWSID, f"top-{index}")
+        for sub_index in range(subfolders):
+            sub = session.add_folder(top, f"sub-{sub_index}")
+            for file_index in range(files):
+                session.add_file(sub, f"file-{file_index}.txt", b"x" * (file_index + 1))
 
 
 class DriverStateTests(unittest.TestCase):
@@ -154,6 +596,102 @@ class DriverStateTests(unittest.TestCase):
         entry = self.state.get_entry("/docs/a.txt")
         self.assertEqual(entry["hydrated"], 0)
 
+    def add_hydrated_files(self, count, size):
+        self.mirror.ensure_dir("/docs")
+        entries = []
+        for index in range(count):
+            path = f"/docs/file-{index}.bin"
+            self.mirror.write_atomic_bytes(path, os.urandom(size))
+            entries.append(
+                {
+                    "path": path,
+                    "type": "file",
+                    "parent_path": "/docs",
+                    "remote_drivewsid": f"file-{index}",
+                    "size": size,
+                    "hydrated": True,
+                    "synced_path": path,
+                }
+            )
+        self.state.upsert_entries(entries)
+
+    def reconcile(self):
+        api = Mock()
+        api.drive.root = Mock()
+        engine = ICloudSyncEngine(api, self.mirror, self.state, Mock())
+        hashed = []
+        self.hashing_threads = set()
+        file_sha256 = self.mirror.file_sha256
+
+        def counting_sha256(path):
+            hashed.append(path)
+            self.hashing_threads.add(threading.current_thread().name)
+            return file_sha256(path)
+
+        self.mirror.file_sha256 = counting_sha256
+        started_at = time.perf_counter()
+        try:
+            engine._reconcile_persistent_cache()
+        finally:
+            del self.mirror.file_sha256
+        return hashed, time.perf_counter() - started_at
+
+    def test_reconcile_rehashes_only_files_whose_fingerprint_changed(self):
+        self.add_hydrated_files(3, 64)
+        self.assertEqual(len(self.reconcile()[0]), 3)
+
+        self.assertEqual(self.reconcile()[0], [])
+
+        self.mirror.write("/docs/file-1.bin", b"changed", 0)
+        hashed, _ = self.reconcile()
+        self.assertEqual(hashed, ["/docs/file-1.bin"])
+        self.assertTrue(all(name.startswith("rehash") for name in self.hashing_threads))
+        self.assertEqual(
+            self.state.get_entry("/docs/file-1.bin")["local_sha256"],
+            self.mirror.file_sha256("/docs/file-1.bin"),
+        )
+
+    def test_restart_cost_follows_file_count_not_bytes(self):
+        self.add_hydrated_files(32, 2 * 1024 * 1024)
+        _, first_start = self.reconcile()
+
+        hashed, restart = self.reconcile()
+
+        self.assertEqual(hashed, [])
+        self.assertLess(restart, first_start / 4)
+
+    def test_scan_tree_lists_every_file_and_directory(self):
+        for index in range(3):
+            self.mirror.create_file(f"/a/b{index}/c/file.txt")
+        self.mirror.create_file("/top.txt")
+
+        files, dirs = self.mirror.scan_tree(workers=4)
+
+        self.assertEqual(
+            sorted(files),
+            ["/a/b0/c/file.txt", "/a/b1/c/file.txt", "/a/b2/c/file.txt", "/top.txt"],
+        )
+        self.assertEqual(files["/top.txt"].st_ino, self.mirror.stat_local("/top.txt").st_ino)
+        self.assertIn("/a/b2/c", dirs)
+
+    def test_reconcile_writes_updates_in_batches_and_restores_missing_paths(self):
+        self.add_hydrated_files(2500, 1)
+        self.reconcile()
+        for index in range(2500):
+            os.utime(self.mirror.local_path(f"/docs/file-{index}.bin"), (1000, 1000))
+        os.unlink(self.mirror.local_path("/docs/file-7.bin"))
+        self.state.upsert_entry({"path": "/empty", "type": "folder", "parent_path": "/", "hydrated": True})
+        update_reconciled = self.state.update_reconciled
+        batches = []
+        self.state.update_reconciled = lambda pairs: batches.append(len(pairs)) or update_reconciled(pairs)
+
+        self.reconcile()
+
+        self.assertEqual(sorted(batches), [500, 1000, 1000])
+        self.assertEqual(self.state.get_entry("/docs/file-3.bin")["mtime"], 1000)
+        self.assertFalse(self.state.get_entry("/docs/file-7.bin")["hydrated"])
+        self.assertTrue(self.mirror.is_dir("/empty"))
+
     def test_remote_shareid_round_trips_through_state(self):
         self.state.upsert_entry(
             {
@@ -240,6 +778,7 @@ class SyncEngineStartupTests(unittest.TestCase):
         )
 
         self.engine.start()
+        self.assertTrue(self.engine.ready.wait(5))
 
         self.engine.initial_scan.assert_not_called()
         self.engine._reconcile_persistent_cache.assert_called_once()
@@ -248,6 +787,7 @@ class SyncEngineStartupTests(unittest.TestCase):
 
     def test_start_performs_initial_scan_on_first_run(self):
         self.engine.start()
+        self.assertTrue(self.engine.ready.wait(5))
 
         self.engine.initial_scan.assert_called_once()
         self.engine._reconcile_persistent_cache.assert_not_called()
@@ -319,5 +859,1497 @@ class SyncEngineStartupTests(unittest.TestCase):
         self.assertEqual(node.data["size"], 5)
 
 
+class FakeDriveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="icloud-linux-test-")
+        self.mirror = LocalMirror(self.root)
+        self.state = SyncState(os.path.join(self.root, "state.sqlite3"))
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.shutdown()
+            engine.executor.shutdown(wait=True)
+        shutil.rmtree(self.root)
+
+    def make_engine(self, session, state=None, **options):
+        engine = ICloudSyncEngine(session.api(), self.mirror, state or self.state, Mock(), **options)
+        self.engines.append(engine)
+        return engine
+
+    def make_fs(self, engine):
+        fs = ICloudFS()
+        fs.mirror, fs.state, fs.sync_engine = self.mirror, self.state, engine
+        return fs
+
+
+class RemoteCrawlTests(FakeDriveTestCase):
+    def staged(self):
+        return {meta["remote_drivewsid"]: meta for meta in self.state.iter_staged_entries()}
+
+    def crawl(self, session, **options):
+        self.make_engine(session, **options)._crawl_remote_snapshot()
+        return self.staged()
+
+    def timed_crawl(self, session, workers):
+        started_at = time.monotonic()
+        snapshot = self.crawl(session, crawl_workers=workers, crawl_batch_size=1)
+        return snapshot, time.monotonic() - started_at
+
+    def test_parallel_crawl_matches_serial_snapshot_and_scales_with_workers(self):
+        session = FakeICloudSession(latency=0.02)
+        build_fake_tree(session)
+
+        serial, serial_seconds = self.timed_crawl(session, workers=1)
+        parallel, parallel_seconds = self.timed_crawl(session, workers=4)
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(parallel), 3 + 15 + 30)
+        self.assertIn("/top-2/sub-4/file-1.txt", {meta["path"] for meta in parallel.values()})
+        self.assertLess(parallel_seconds, serial_seconds / 2)
+
+    def test_batched_crawl_cuts_listing_round_trips(self):
+        session = FakeICloudSession()
+        build_fake_tree(session)
+        serial = self.crawl(session, crawl_workers=1, crawl_batch_size=1)
+        serial_calls = session.count("retrieveItemDetailsInFolders")
+        session.calls.clear()
+
+        batched = self.crawl(session, crawl_workers=1, crawl_batch_size=8)
+
+        self.assertEqual(serial, batched)
+        self.assertEqual(serial_calls, 1 + 3 + 15)
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 1 + 1 + 2)
+
+    def test_failed_batch_falls_back_to_per_folder_listing(self):
+        session = FakeICloudSession()
+        build_fake_tree(session)
+        handler = session._post_retrieveItemDetailsInFolders
+
+        def reject_batches(url, payload, files):
+            if len(payload) > 1:
+                return fake_response({"error": "batch"}, status_code=500)
+            return handler(url, payload, files)
+
+        session._post_retrieveItemDetailsInFolders = reject_batches
+        snapshot = self.crawl(session, crawl_workers=1, crawl_batch_size=8)
+
+        self.assertEqual(len(snapshot), 3 + 15 + 30)
+
+    def test_apply_staged_snapshot_materializes_and_prunes_entries(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=1, subfolders=1, files=2)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        self.assertTrue(self.mirror.is_dir("/top-0/sub-0"))
+        self.assertEqual(self.state.get_entry("/top-0/sub-0/file-1.txt")["size"], 2)
+
+        session._remove_tree(session.find("/top-0/sub-0/file-0.txt")["drivewsid"])
+        engine._crawl_remote_snapshot()
+        engine._apply_remote_snapshot()
+
+        self.assertIsNone(self.state.get_entry("/top-0/sub-0/file-0.txt"))
+        self.assertFalse(self.mirror.exists("/top-0/sub-0/file-0.txt"))
+        self.assertEqual(self.state.count_staged_entries(), 0)
+
+    def test_folder_that_fails_to_list_keeps_its_local_subtree(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=2, subfolders=1, files=2)
+        engine = self.make_engine(session, warmup_mode="lazy", crawl_batch_size=1)
+        engine.initial_scan()
+        failing = session.find("/top-0")["drivewsid"]
+        handler = session._post_retrieveItemDetailsInFolders
+
+        def fail_one(url, payload, files):
+            if any(item["drivewsid"] == failing for item in payload):
+                return fake_response({"error": "unavailable"}, status_code=500)
+            return handler(url, payload, files)
+
+        session._post_retrieveItemDetailsInFolders = fail_one
+        session._remove_tree(session.find("/top-1/sub-0/file-0.txt")["drivewsid"])
+        engine._crawl_remote_snapshot()
+        engine._apply_remote_snapshot()
+
+        self.assertEqual(self.state.get_entry("/top-0/sub-0/file-0.txt")["size"], 1)
+        self.assertTrue(self.mirror.exists("/top-0/sub-0/file-1.txt"))
+        self.assertIsNone(self.state.get_entry("/top-1/sub-0/file-0.txt"))
+        self.assertEqual(self.state.list_crawl_failures(), [])
+        due = [row["path"] for row in self.state.list_due_folders(time.time(), 10)]
+        self.assertEqual(due, ["/top-0"])
+
+    def test_folder_refresh_adapts_interval_to_change_history(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=2, subfolders=1, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy", remote_refresh_interval_seconds=300)
+        engine.initial_scan()
+        session.add_file(session.find("/top-0")["drivewsid"], "new.txt", b"new")
+        session._remove_tree(session.find("/top-0/sub-0")["drivewsid"])
+        session.calls.clear()
+
+        engine._refresh_folders(["/top-0", "/top-1"], now=1000)
+
+        # One listing for both folders and one check that the missing sub-0 was deleted.
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 2)
+        self.assertEqual(self.state.get_entry("/top-0/new.txt")["size"], 3)
+        self.assertIsNone(self.state.get_entry("/top-0/sub-0/file-0.txt"))
+        self.assertEqual(self.state.get_folder_refresh("/top-0")["interval_seconds"], 15)
+        self.assertEqual(self.state.get_folder_refresh("/top-1")["interval_seconds"], 600)
+        due = [row["path"] for row in self.state.list_due_folders(1020, 10)]
+        self.assertEqual(due, ["/top-0"])
+
+    def test_remote_move_into_unlisted_folder_keeps_local_content(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=2, subfolders=1, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        engine.ensure_local_file("/top-0/sub-0/file-0.txt")
+        session.find("/top-0/sub-0/file-0.txt")["parent"] = session.find("/top-1")["drivewsid"]
+        session.calls.clear()
+
+        engine._refresh_folders(["/top-0/sub-0"], now=1000)
+
+        self.assertTrue(self.state.get_entry("/top-0/sub-0/file-0.txt")["hydrated"])
+        due = [row["path"] for row in self.state.list_due_folders(1000, 10)]
+        self.assertIn("/top-1", due)
+
+        engine._refresh_folders(due, now=1001)
+
+        self.assertIsNone(self.state.get_entry("/top-0/sub-0/file-0.txt"))
+        self.assertTrue(self.state.get_entry("/top-1/file-0.txt")["hydrated"])
+        self.assertEqual(self.mirror.read("/top-1/file-0.txt", 100, 0), b"x")
+        self.assertEqual(session.count("download"), 0)
+
+    def test_move_between_folders_listed_together_needs_no_extra_request(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=2, subfolders=1, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        session._remove_tree(session.find("/top-1/sub-0/file-0.txt")["drivewsid"])
+        moved = session.find("/top-0/sub-0/file-0.txt")
+        moved["parent"] = session.find("/top-1/sub-0")["drivewsid"]
+        session.calls.clear()
+
+        engine._refresh_folders(["/top-0/sub-0", "/top-1/sub-0"], now=1000)
+
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 1)
+        self.assertIsNone(self.state.get_entry("/top-0/sub-0/file-0.txt"))
+        self.assertEqual(self.state.get_entry("/top-1/sub-0/file-0.txt")["remote_drivewsid"], moved["drivewsid"])
+
+    def test_refresh_honours_overrides_and_request_budget(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=3, subfolders=0, files=1)
+        engine = self.make_engine(
+            session,
+            warmup_mode="lazy",
+            crawl_batch_size=1,
+            refresh_overrides={"/top-1": 5},
+            refresh_max_requests_per_minute=2,
+        )
+        engine.initial_scan()
+        session.calls.clear()
+        later = time.time() + 10 ** 6
+
+        self.assertEqual(engine._refresh_due_folders(now=later), 2)
+        self.assertEqual(engine._refresh_due_folders(now=later), 0)
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 2)
+        self.assertEqual(engine._folder_refresh_interval("/top-1/deep", 600, False), 5)
+
+    def test_per_folder_fallbacks_count_against_refresh_budget(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=3, subfolders=0, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy", crawl_batch_size=3)
+        engine.initial_scan()
+        handler = session._post_retrieveItemDetailsInFolders
+
+        def reject_batches(url, payload, files):
+            if len(payload) > 1:
+                return fake_response({"error": "batch"}, status_code=500)
+            return handler(url, payload, files)
+
+        session._post_retrieveItemDetailsInFolders = reject_batches
+
+        requests = engine._refresh_folders(["/top-0", "/top-1", "/top-2"], now=1000)
+
+        self.assertEqual(requests, 1 + 3)
+        self.assertEqual(len(engine.refresh_request_times), 1 + 3)
+
+    def test_readdir_of_stale_directory_triggers_background_relist(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=1, subfolders=1, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy", directory_ttl_seconds=30)
+        engine.initial_scan()
+        fs = self.make_fs(engine)
+        session.add_file(session.find("/top-0")["drivewsid"], "fresh.txt", b"!")
+        session.calls.clear()
+
+        list(fs.readdir("/top-0", 0))
+        engine.revalidate_executor.shutdown(wait=True)
+        self.assertEqual(session.calls, [])
+
+        self.state.record_folder_refresh("/top-0", time.time() - 60, False, 300)
+        engine.revalidate_executor = ThreadPoolExecutor(max_workers=1)
+        list(fs.readdir("/top-0", 0))
+        engine.revalidate_executor.shutdown(wait=True)
+
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 1)
+        self.assertIsNotNone(self.state.get_entry("/top-0/fresh.txt"))
+        self.assertIn("fresh.txt", self.mirror.listdir("/top-0"))
+
+    def crawl_peak_memory(self, folders):
+        session = SyntheticICloudSession(folders=folders, files_per_folder=100)
+        # One worker keeps the peak deterministic; with more, it depends on how many
+        # listings happen to be in flight at once.
+        engine = self.make_engine(session, crawl_workers=1, crawl_batch_size=5, crawl_page_size=200)
+        tracemalloc.start()
+        try:
+            engine._crawl_remote_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(self.state.count_staged_entries(), folders * 101)
+        return peak
+
+    def test_crawl_memory_stays_flat_as_drive_grows(self):
+        # ICLOUD_LINUX_BENCH_FOLDERS=10000 exercises a million-entry drive.
+        large = int(os.environ.get("ICLOUD_LINUX_BENCH_FOLDERS", "100"))
+        small_peak = self.crawl_peak_memory(folders=10)
+        large_peak = self.crawl_peak_memory(folders=large)
+
+        # Each extra entry may add a few bytes to the peak at most; holding on to as
+        # little as each entry's path would cost well over this.
+        extra_entries = (large - 10) * 101
+        self.assertLess(large_peak - small_peak, extra_entries * 32)
+
+    def test_interrupted_crawl_resumes_with_only_remaining_calls(self):
+        session = FakeICloudSession()
+        build_fake_tree(session)
+        first = self.make_engine(session, crawl_workers=1, crawl_batch_size=1)
+        handler = session._post_retrieveItemDetailsInFolders
+
+        def stop_after_seven(url, payload, files):
+            if session.count("retrieveItemDetailsInFolders") == 7:
+                first.stop_event.set()
+            return handler(url, payload, files)
+
+        session._post_retrieveItemDetailsInFolders = stop_after_seven
+        with self.assertRaises(CrawlInterrupted):
+            first._crawl_remote_snapshot()
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 7)
+        session.calls.clear()
+
+        resumed = self.make_engine(
+            session,
+            state=SyncState(self.state.db_path),
+            warmup_mode="lazy",
+            crawl_workers=1,
+            crawl_batch_size=1,
+        )
+        resumed.initial_scan()
+
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 19 - 7)
+        self.assertEqual(self.state.count_entries(), 3 + 15 + 30)
+        self.assertFalse(self.state.crawl_in_progress())
+
+    def test_crawl_stops_when_engine_is_shut_down(self):
+        session = FakeICloudSession()
+        build_fake_tree(session)
+        engine = self.make_engine(session, crawl_workers=2)
+        engine.stop_event.set()
+
+        with self.assertRaises(CrawlInterrupted):
+            engine._crawl_remote_snapshot()
+
+    def test_listing_errors_do_not_rely_on_pyicloud_private_helpers(self):
+        response = fake_response({"error": "unavailable"}, status_code=503)
+        drive = SimpleNamespace(
+            session=SimpleNamespace(post=lambda url, params, json: response), service_root=SERVICE_ROOT, params={}
+        )
+
+        with self.assertRaises(PyiCloudAPIResponseException) as caught:
+            retrieve_folder_details(drive, [(ROOT_DRIVEWSID, None)])
+
+        self.assertEqual(caught.exception.code, 503)
+
+
+class UploadSyncTests(FakeDriveTestCase):
+    def write_files(self, fs, folder, count):
+        fs.mkdir(folder, 0o755)
+        for index in range(count):
+            path = f"{folder}/file-{index}.txt"
+            fs.create(path, 0o644)
+            fs.write(path, f"content {index}".encode(), 0)
+
+    def timed_upload(self, session, top, workers):
+        engine = self.make_engine(session, warmup_mode="lazy", upload_workers=workers)
+        fs = self.make_fs(engine)
+        fs.mkdir(top, 0o755)
+        for index in range(4):
+            fs.mkdir(f"{top}/dir-{index}", 0o755)
+            self.write_files(fs, f"{top}/dir-{index}/sub", 6)
+        started_at = time.monotonic()
+        engine.sync_dirty_entries()
+        return time.monotonic() - started_at
+
+    def test_parallel_upload_orders_folders_before_contents_and_scales(self):
+        session = FakeICloudSession(latency=0.01)
+
+        serial_seconds = self.timed_upload(session, "/serial", workers=1)
+        parallel_seconds = self.timed_upload(session, "/parallel", workers=8)
+
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(session.count("createFolders"), 2 * (1 + 4 + 4))
+        self.assertEqual(session.count("documents"), 2 * 24)
+        self.assertEqual(session.find("/parallel/dir-3/sub/file-5.txt")["size"], len(b"content 5"))
+        self.assertLess(parallel_seconds, serial_seconds / 2)
+
+    def test_failed_folder_holds_back_its_contents(self):
+        session = FakeICloudSession()
+        engine = self.make_engine(session, warmup_mode="lazy", upload_workers=4)
+        self.write_files(self.make_fs(engine), "/bulk", 10)
+        handler = session._post_createFolders
+        session._post_createFolders = lambda url, payload, files: fake_response({}, status_code=500)
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("createFolders"), 1)
+        self.assertEqual(session.count("documents"), 0)
+        self.assertEqual(len(self.state.list_dirty_entries()), 11)
+
+        session._post_createFolders = handler
+        engine.sync_dirty_entries()
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_bulk_upload_takes_metadata_from_api_responses(self):
+        session = FakeICloudSession()
+        engine = self.make_engine(session, warmup_mode="lazy")
+        self.write_files(self.make_fs(engine), "/bulk", 50)
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("createFolders"), 1)
+        self.assertEqual(session.count("documents"), 50)
+        # Only the one-time lookup of the drive root; no relist of /bulk.
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 1)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        entry = self.state.get_entry("/bulk/file-7.txt")
+        self.assertEqual(entry["remote_docwsid"], session.find("/bulk/file-7.txt")["docwsid"])
+
+    def test_upload_without_document_reply_relists_parent_once(self):
+        session = FakeICloudSession()
+        handler = session._post_documents
+        session._post_documents = lambda url, payload, files: (handler(url, payload, files), fake_response({}))[1]
+        engine = self.make_engine(session, warmup_mode="lazy")
+        self.write_files(self.make_fs(engine), "/bulk", 20)
+        session.calls.clear()
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 1 + 1)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_bulk_upload_resolves_existing_parent_once(self):
+        session = FakeICloudSession()
+        session.add_folder(ROOT_DRIVEWSID, "docs")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        fs = self.make_fs(engine)
+        for index in range(30):
+            fs.create(f"/docs/file-{index}.txt", 0o644)
+            fs.write(f"/docs/file-{index}.txt", b"data", 0)
+        lookups = []
+        get_entry = self.state.get_entry
+        self.state.get_entry = lambda path: (lookups.append(path), get_entry(path))[1]
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(lookups.count("/docs"), 1)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_move_takes_etag_from_api_response(self):
+        session = FakeICloudSession()
+        docs = session.add_folder(ROOT_DRIVEWSID, "docs")
+        session.add_folder(ROOT_DRIVEWSID, "archive")
+        session.add_file(docs, "report.txt", b"report")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        fs = self.make_fs(engine)
+        fs.rename("/docs", "/archive/docs-2024")
+        session.calls.clear()
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("moveItems"), 1)
+        self.assertEqual(session.count("renameItems"), 1)
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 0)
+        entry = self.state.get_entry("/archive/docs-2024")
+        self.assertEqual(entry["remote_etag"], session.find("/archive/docs-2024")["etag"])
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+
+class SyncPlannerTests(FakeDriveTestCase):
+    def synced_drive(self):
+        session = FakeICloudSession()
+        docs = session.add_folder(ROOT_DRIVEWSID, "docs")
+        session.add_folder(ROOT_DRIVEWSID, "archive")
+        session.add_file(docs, "report.txt", b"report")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        engine.ensure_local_file("/docs/report.txt")
+        session.calls.clear()
+        return session, engine, self.make_fs(engine)
+
+    def test_compact_ops_keys_history_by_current_path(self):
+        ops = [
+            {"op": "create", "path": "/b.txt", "target_path": None},
+            {"op": "update", "path": "/b.txt", "target_path": None},
+            {"op": "rename", "path": "/a.txt", "target_path": "/b.txt"},
+            {"op": "rename", "path": "/c.txt", "target_path": "/d.txt"},
+            {"op": "update", "path": "/e.txt", "target_path": None},
+            {"op": "delete", "path": "/e.txt", "target_path": None},
+        ]
+
+        self.assertEqual(
+            compact_ops(ops),
+            {"/b.txt": {"create", "update", "rename"}, "/d.txt": {"rename"}, "/e.txt": {"delete"}},
+        )
+
+    def test_repeated_writes_queue_a_single_op(self):
+        session, engine, fs = self.synced_drive()
+        fs.create("/docs/log.txt", 0o644)
+        for index in range(100):
+            fs.write("/docs/log.txt", b"line\n", index * 5)
+
+        self.assertEqual([op["op"] for op in self.state.list_pending_ops()], ["create"])
+
+    def test_editor_atomic_save_updates_existing_document(self):
+        session, engine, fs = self.synced_drive()
+        fs.create("/docs/.report.txt.swp", 0o644)
+        fs.write("/docs/.report.txt.swp", b"edited report", 0)
+        self.assertEqual(fs.rename("/docs/.report.txt.swp", "/docs/report.txt"), 0)
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("documents"), 1)
+        self.assertEqual(session.count("moveItems") + session.count("renameItems"), 0)
+        self.assertEqual([node["name"] for node in session.children(session.find("/docs")["drivewsid"])], ["report.txt"])
+        self.assertEqual(session.find("/docs/report.txt")["size"], len(b"edited report"))
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(self.state.list_pending_ops(), [])
+
+    def test_synced_folder_renames_leave_no_ops_behind(self):
+        session, engine, fs = self.synced_drive()
+        for oldpath, newpath in [("/docs", "/ren-0"), ("/ren-0", "/ren-1"), ("/ren-1", "/ren-2")]:
+            self.assertEqual(fs.rename(oldpath, newpath), 0)
+            engine.sync_dirty_entries()
+
+        self.assertEqual(
+            session.find("/ren-2/report.txt")["drivewsid"], self.state.get_entry("/ren-2/report.txt")["remote_drivewsid"]
+        )
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(self.state.list_pending_ops(), [])
+
+    def test_rename_chain_moves_without_reupload(self):
+        session, engine, fs = self.synced_drive()
+        fs.rename("/docs/report.txt", "/docs/report-draft.txt")
+        fs.rename("/docs/report-draft.txt", "/archive/report-final.txt")
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("moveItems"), 1)
+        self.assertEqual(session.count("renameItems"), 1)
+        self.assertEqual(session.count("documents"), 0)
+        self.assertEqual(session.find("/archive/report-final.txt")["size"], len(b"report"))
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_rename_inside_renamed_folder_keeps_both_renames(self):
+        session, engine, fs = self.synced_drive()
+        fs.rename("/docs/report.txt", "/docs/final.txt")
+        fs.rename("/docs", "/papers")
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("renameItems"), 2)
+        self.assertEqual(session.count("documents"), 0)
+        self.assertEqual(session.find("/papers/final.txt")["size"], len(b"report"))
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_build_scratch_files_cause_no_remote_traffic(self):
+        session, engine, fs = self.synced_drive()
+        fs.mkdir("/docs/build", 0o755)
+        for name in ("a", "b", "c"):
+            fs.create(f"/docs/build/{name}.o.tmp", 0o644)
+            fs.write(f"/docs/build/{name}.o.tmp", b"object", 0)
+            fs.rename(f"/docs/build/{name}.o.tmp", f"/docs/build/{name}.o")
+        for name in ("a", "b", "c"):
+            fs.unlink(f"/docs/build/{name}.o")
+        fs.rmdir("/docs/build")
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.calls, [])
+        self.assertEqual(self.state.list_pending_ops(), [])
+
+    def test_autosave_replaces_content_in_place(self):
+        session, engine, fs = self.synced_drive()
+        drivewsid = self.state.get_entry("/docs/report.txt")["remote_drivewsid"]
+
+        for revision in range(3):
+            fs.write("/docs/report.txt", f"revision {revision}".encode(), 0)
+            engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("deleteItems"), 0)
+        self.assertEqual(session.count("retrieveItemDetailsInFolders"), 0)
+        self.assertEqual(len(session.calls), 3 * 3)
+        self.assertEqual(self.state.get_entry("/docs/report.txt")["remote_drivewsid"], drivewsid)
+        self.assertEqual(session.contents[session.find("/docs/report.txt")["docwsid"]], b"revision 2")
+
+    def test_rejected_replace_falls_back_to_delete_and_upload(self):
+        session, engine, fs = self.synced_drive()
+        handler = session._post_documents
+        existing = {node["docwsid"] for node in session.nodes.values()}
+
+        def reject_replace(url, payload, files):
+            if payload["document_id"] in existing:
+                return fake_response({"error": "conflict"}, status_code=409)
+            return handler(url, payload, files)
+
+        session._post_documents = reject_replace
+        fs.write("/docs/report.txt", b"rewritten", 0)
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("deleteItems"), 1)
+        self.assertEqual(session.count("documents"), 2)
+        self.assertEqual(session.contents[session.find("/docs/report.txt")["docwsid"]], b"rewritten")
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_replace_failing_for_other_reasons_is_retried_without_deleting(self):
+        session, engine, fs = self.synced_drive()
+        handler = session._post_documents
+        existing = {node["docwsid"] for node in session.nodes.values()}
+        for attempt, status_code in enumerate((429, 503, 401)):
+            with self.subTest(status_code=status_code):
+
+                def fail_replace(url, payload, files):
+                    if payload["document_id"] in existing:
+                        return fake_response({"error": "unavailable"}, status_code=status_code)
+                    return handler(url, payload, files)
+
+                session._post_documents = fail_replace
+                # A different size each time so the per-path upload backoff does not apply.
+                fs.write("/docs/report.txt", b"rewritten" * (attempt + 1), 0)
+
+                engine.sync_dirty_entries()
+
+                self.assertEqual(session.count("documents"), attempt + 1)
+                self.assertEqual(session.count("deleteItems"), 0)
+                self.assertIsNotNone(session.find("/docs/report.txt"))
+                self.assertEqual([entry["path"] for entry in self.state.list_dirty_entries()], ["/docs/report.txt"])
+
+
+class RemoteDeleteTests(FakeDriveTestCase):
+    def synced_tree(self, **options):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=2, subfolders=3, files=20)
+        engine = self.make_engine(session, warmup_mode="lazy", **options)
+        engine.initial_scan()
+        session.calls.clear()
+        return session, engine, self.make_fs(engine)
+
+    def remove_tree(self, fs, path):
+        for child in self.state.list_children(path):
+            if child["type"] == "folder":
+                self.remove_tree(fs, child["path"])
+            else:
+                self.assertEqual(fs.unlink(child["path"]), 0)
+        self.assertEqual(fs.rmdir(path), 0)
+
+    def test_removed_tree_is_one_delete_request(self):
+        session, engine, fs = self.synced_tree()
+        self.remove_tree(fs, "/top-0")
+
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("deleteItems"), 1)
+        self.assertIsNone(self.state.get_entry("/top-0"))
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual([node["name"] for node in session.children(ROOT_DRIVEWSID)], ["top-1"])
+
+    def test_separate_deletes_are_batched(self):
+        session, engine, fs = self.synced_tree(delete_batch_size=25)
+        for sub_index in range(3):
+            for file_index in range(20):
+                fs.unlink(f"/top-1/sub-{sub_index}/file-{file_index}.txt")
+        fs.rename("/top-0/sub-0/file-0.txt", "/top-0/sub-1/moved.txt")
+        self.remove_tree(fs, "/top-0/sub-1")
+
+        engine.sync_dirty_entries()
+
+        # 60 files from top-1 plus sub-1 and the file moved into it before removal.
+        self.assertEqual(session.count("deleteItems"), 3)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(session.children(session.find("/top-1/sub-2")["drivewsid"]), [])
+        self.assertEqual(len(session.children(session.find("/top-0/sub-0")["drivewsid"])), 19)
+        self.assertNotIn("file-0.txt", [node["name"] for node in session.children(session.find("/top-0/sub-0")["drivewsid"])])
+
+    def test_failed_items_stay_queued(self):
+        session, engine, fs = self.synced_tree()
+        fs.unlink("/top-0/sub-0/file-0.txt")
+        fs.unlink("/top-0/sub-0/file-1.txt")
+        handler = session._post_deleteItems
+        rejected = session.find("/top-0/sub-0/file-1.txt")["drivewsid"]
+
+        def reject_one(url, payload, files):
+            response = handler(url, {"items": [item for item in payload["items"] if item["drivewsid"] != rejected]}, files)
+            return fake_response({"items": response.json()["items"] + [{"drivewsid": rejected, "status": "ERROR"}]})
+
+        session._post_deleteItems = reject_one
+        engine.sync_dirty_entries()
+
+        self.assertEqual([entry["path"] for entry in self.state.list_dirty_entries()], ["/top-0/sub-0/file-1.txt"])
+
+    def test_unsynced_folder_waits_for_deletes_of_items_moved_into_it(self):
+        session, engine, fs = self.synced_tree()
+        moved = session.find("/top-0/sub-0/file-0.txt")["drivewsid"]
+        self.assertEqual(fs.mkdir("/new", 0o755), 0)
+        self.assertEqual(fs.rename("/top-0/sub-0/file-0.txt", "/new/moved.txt"), 0)
+        self.remove_tree(fs, "/new")
+        handler = session._post_deleteItems
+
+        def fail(url, payload, files):
+            raise PyiCloudAPIResponseException("Service Unavailable", 503)
+
+        session._post_deleteItems = fail
+        engine.sync_dirty_entries()
+
+        self.assertIn(moved, session.nodes)
+        self.assertEqual(
+            [entry["path"] for entry in self.state.list_dirty_entries()], ["/new", "/new/moved.txt"]
+        )
+
+        session._post_deleteItems = handler
+        engine.sync_dirty_entries()
+
+        self.assertNotIn(moved, session.nodes)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+
+class UploadRetryTests(FakeDriveTestCase):
+    def allow_retry_now(self):
+        self.state.conn.execute("UPDATE upload_failures SET next_attempt_at = 0")
+        self.state.conn.commit()
+
+    def test_dropped_uploads_back_off_then_complete(self):
+        session = FlakyUploadSession(failures=2)
+        self.addCleanup(session.close)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        fs = self.make_fs(engine)
+        content = os.urandom(2 * 1024 * 1024)
+        fs.create("/big.bin", 0o644)
+        fs.write("/big.bin", content, 0)
+
+        engine.sync_dirty_entries()
+        first = self.state.get_upload_failure("/big.bin")
+        engine.sync_dirty_entries()
+
+        self.assertEqual(first["attempts"], 1)
+        self.assertEqual(session.count("content"), 1)
+
+        self.allow_retry_now()
+        engine.sync_dirty_entries()
+        second = self.state.get_upload_failure("/big.bin")
+        self.assertEqual(second["attempts"], 2)
+        self.assertGreater(second["next_attempt_at"] - time.time(), first["next_attempt_at"] - time.time())
+
+        self.allow_retry_now()
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("content"), 3)
+        self.assertIsNone(self.state.get_upload_failure("/big.bin"))
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(session.contents[session.find("/big.bin")["docwsid"]], content)
+
+    def test_local_edit_skips_the_backoff(self):
+        session = FlakyUploadSession(failures=1)
+        self.addCleanup(session.close)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        fs = self.make_fs(engine)
+        fs.create("/notes.txt", 0o644)
+        fs.write("/notes.txt", b"draft", 0)
+        engine.sync_dirty_entries()
+
+        fs.write("/notes.txt", b"final draft", 0)
+        engine.sync_dirty_entries()
+
+        self.assertEqual(session.count("content"), 2)
+        self.assertEqual(self.state.list_dirty_entries(), [])
+
+    def test_backoff_follows_a_renamed_file(self):
+        session = FlakyUploadSession(failures=1)
+        self.addCleanup(session.close)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        fs = self.make_fs(engine)
+        fs.mkdir("/drafts", 0o755)
+        fs.create("/drafts/notes.txt", 0o644)
+        fs.write("/drafts/notes.txt", b"draft", 0)
+        engine.sync_dirty_entries()
+
+        fs.rename("/drafts", "/final")
+        engine.sync_dirty_entries()
+
+        self.assertIsNone(self.state.get_upload_failure("/drafts/notes.txt"))
+        self.assertEqual(self.state.get_upload_failure("/final/notes.txt")["attempts"], 1)
+        self.assertEqual(session.count("content"), 1)
+
+
+class DelaySchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = DelayScheduler(Mock())
+        self.fired = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def schedule(self, key, delay):
+        self.scheduler.schedule(key, delay, lambda: self.fired.append(key))
+
+    def test_runs_callbacks_in_due_order_with_cancel_and_reschedule(self):
+        self.schedule("late", 0.15)
+        self.schedule("cancelled", 0.05)
+        self.schedule("moved", 0.01)
+        self.schedule("early", 0.02)
+        self.schedule("moved", 0.1)
+        self.assertTrue(self.scheduler.cancel("cancelled"))
+        self.assertFalse(self.scheduler.cancel("unknown"))
+        self.scheduler.schedule("last", 0.2, self.done.set)
+
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["early", "moved", "late"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_shutdown_drops_pending_callbacks_and_stops_thread(self):
+        self.schedule("pending", 0.1)
+
+        self.scheduler.shutdown()
+
+        self.assertFalse(self.scheduler.thread.is_alive())
+        self.assertFalse(self.scheduler.schedule("after", 0, self.done.set))
+        time.sleep(0.15)
+        self.assertEqual(self.fired, [])
+
+    def test_mass_download_failures_keep_thread_count_constant(self):
+        root = tempfile.mkdtemp(prefix="icloud-linux-test-")
+        self.addCleanup(shutil.rmtree, root)
+        engine = ICloudSyncEngine(
+            Mock(), LocalMirror(root), SyncState(os.path.join(root, "state.sqlite3")), Mock()
+        )
+        self.addCleanup(engine.shutdown)
+        engine.ensure_local_file = Mock(side_effect=RuntimeError("outage"))
+        engine._download_job("/warmup")
+        threads_before = threading.active_count()
+
+        for index in range(5000):
+            engine._download_job(f"/file-{index}.bin")
+
+        self.assertEqual(len(engine.retry_scheduler), 5001)
+        self.assertEqual(threading.active_count(), threads_before)
+        engine.shutdown()
+        self.assertEqual(len(engine.retry_scheduler), 0)
+        self.assertFalse(engine.retry_scheduler.thread.is_alive())
+
+
+class RequestBrokerTests(unittest.TestCase):
+    def test_waiting_requests_are_admitted_by_priority(self):
+        broker = RequestBroker(initial_limit=1)
+        admitted = []
+        release = threading.Event()
+
+        def hold():
+            with broker.slot("upload"):
+                release.wait(5)
+
+        def request(priority):
+            with broker.slot(priority):
+                admitted.append(priority)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        waiters = []
+        for priority in ("warmup", "crawl", "warmup", "interactive", "upload"):
+            waiter = threading.Thread(target=request, args=(priority,))
+            waiter.start()
+            waiters.append(waiter)
+            while len(broker.waiting) < len(waiters):
+                time.sleep(0.005)
+        release.set()
+        for thread in [holder] + waiters:
+            thread.join(5)
+
+        self.assertEqual(admitted, ["interactive", "upload", "crawl", "warmup", "warmup"])
+
+    def test_limit_grows_on_success_and_halves_on_throttling(self):
+        broker = RequestBroker(initial_limit=2, max_limit=8)
+        for _ in range(40):
+            with broker.slot("warmup"):
+                pass
+        self.assertEqual(int(broker.limit), 8)
+
+        with self.assertRaises(PyiCloudAPIResponseException):
+            with broker.slot("warmup"):
+                raise PyiCloudAPIResponseException("Service Unavailable", 503)
+        self.assertEqual(int(broker.limit), 4)
+
+        with self.assertRaises(KeyError):
+            with broker.slot("warmup"):
+                raise KeyError("not a throttling error")
+        self.assertGreaterEqual(int(broker.limit), 4)
+
+    def test_concurrency_climbs_to_the_service_limit(self):
+        broker = RequestBroker(initial_limit=1, max_limit=32)
+        active = []
+        peaks = []
+        throttled = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                with broker.slot("crawl"):
+                    with lock:
+                        active.append(1)
+                        busy = len(active)
+                        peaks.append(busy)
+                    try:
+                        time.sleep(0.002)
+                        if busy > 6:
+                            throttled.append(1)
+                            raise PyiCloudAPIResponseException("Too Many Requests", 429)
+                    finally:
+                        with lock:
+                            active.pop()
+            except PyiCloudAPIResponseException:
+                pass
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(lambda _: call(), range(600)))
+
+        self.assertGreaterEqual(max(peaks), 5)
+        self.assertLess(len(throttled), len(peaks) // 5)
+
+
+class SessionPoolTests(FakeDriveTestCase):
+    def warmup(self, session_count):
+        backend = FakeICloudSession()
+        build_fake_tree(backend, folders=2, subfolders=2, files=4)
+        sessions = [ExclusiveSession(backend) for _ in range(session_count)]
+        engine = self.make_engine(
+            backend,
+            warmup_mode="lazy",
+            warmup_workers=4,
+            transfer_sessions=[session.api() for session in sessions],
+        )
+        engine.initial_scan()
+        started_at = time.monotonic()
+        engine._schedule_all_unhydrated()
+        while self.state.list_unhydrated_paths() and time.monotonic() - started_at < 5:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started_at
+        self.assertEqual(self.state.list_unhydrated_paths(), [])
+        self.assertEqual(len(engine.retry_scheduler), 0)
+        return sessions, elapsed
+
+    def test_parallel_downloads_each_use_their_own_session(self):
+        sessions, elapsed = self.warmup(4)
+
+        self.assertTrue(all(session.requests for session in sessions))
+        # 16 files at two requests each would take 0.64 s on one session.
+        self.assertLess(elapsed, 16 * 2 * 0.02 / 2)
+
+    def test_single_session_pool_serializes_transfers(self):
+        sessions, _ = self.warmup(1)
+
+        self.assertEqual(sessions[0].requests, 16 * 2)
+
+    def test_lazy_session_opens_on_first_transfer_and_falls_back_on_failure(self):
+        backend = FakeICloudSession()
+        main = backend.api()
+        opened = []
+
+        def opener():
+            opened.append(1)
+            return ExclusiveSession(backend).api()
+
+        def failing_opener():
+            raise RuntimeError("session was not trusted")
+
+        lazy = LazySession(opener, main, Mock())
+        failing = LazySession(failing_opener, main, Mock())
+        self.assertEqual(opened, [])
+
+        self.assertIsNot(lazy.drive, main.drive)
+        lazy.drive
+        self.assertEqual(opened, [1])
+        self.assertIs(failing.drive, main.drive)
+
+
+class ResumableDownloadTests(FakeDriveTestCase):
+    def interrupted_download(self, content, cutoff):
+        session = FakeICloudSession()
+        session.add_file(ROOT_DRIVEWSID, "big.bin", content)
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        session.download_cutoff = cutoff
+        with self.assertRaises(ConnectionResetError):
+            engine.ensure_local_file("/big.bin")
+        session.download_cutoff = None
+        return session, engine
+
+    def test_retry_resumes_partial_download_with_range_request(self):
+        session, engine = self.interrupted_download(b"0123456789abcdef", 6)
+
+        partial = self.state.get_partial_download("/big.bin")
+        self.assertEqual(partial["bytes_received"], 6)
+        self.assertTrue(partial["tmp_path"].startswith(self.mirror.tmp_dir))
+
+        engine.ensure_local_file("/big.bin")
+
+        self.assertEqual(session.download_ranges, [None, "bytes=6-"])
+        self.assertEqual(self.mirror.read("/big.bin", 100, 0), b"0123456789abcdef")
+        entry = self.state.get_entry("/big.bin")
+        self.assertTrue(entry["hydrated"])
+        self.assertEqual(entry["local_sha256"], hashlib.sha256(b"0123456789abcdef").hexdigest())
+        self.assertIsNone(self.state.get_partial_download("/big.bin"))
+        self.assertEqual(os.listdir(self.mirror.tmp_dir), [])
+
+    def test_partial_download_is_discarded_when_remote_etag_changes(self):
+        session, engine = self.interrupted_download(b"old content here", 4)
+        node = session.find("/big.bin")
+        session.contents[node["docwsid"]] = b"new content here"
+        self.state.set_remote_etag("/big.bin", "etag-changed")
+
+        engine.ensure_local_file("/big.bin")
+
+        self.assertEqual(session.download_ranges, [None, None])
+        self.assertEqual(self.mirror.read("/big.bin", 100, 0), b"new content here")
+
+    def test_removing_the_entry_removes_its_partial_file(self):
+        session, engine = self.interrupted_download(b"0123456789abcdef", 6)
+        tmp_path = self.state.get_partial_download("/big.bin")["tmp_path"]
+
+        self.state.remove_subtree("/big.bin")
+
+        self.assertIsNone(self.state.get_partial_download("/big.bin"))
+        self.assertFalse(os.path.exists(tmp_path))
+
+    def test_startup_sweeps_tmp_files_without_a_partial_download_row(self):
+        session, engine = self.interrupted_download(b"0123456789abcdef", 6)
+        kept = self.state.get_partial_download("/big.bin")["tmp_path"]
+        orphan = self.mirror.partial_download_path("/gone.bin")
+        with open(orphan, "wb") as handle:
+            handle.write(b"stale")
+
+        engine._sweep_tmp_dir()
+
+        self.assertEqual(os.listdir(self.mirror.tmp_dir), [os.path.basename(kept)])
+
+
+class StartupMountTests(FakeDriveTestCase):
+    def test_first_listing_is_served_while_crawl_runs(self):
+        session = FakeICloudSession(latency=0.02)
+        build_fake_tree(session, folders=20, subfolders=5, files=1)
+        engine = self.make_engine(session, warmup_mode="lazy", crawl_workers=1, crawl_batch_size=1)
+        fs = self.make_fs(engine)
+        started_at = time.monotonic()
+
+        engine.start()
+        names = [entry.name for entry in fs.readdir("/", 0)]
+        attrs = fs.getattr("/top-7/sub-3/file-0.txt")
+        first_answers = time.monotonic() - started_at
+
+        self.assertFalse(engine.ready.is_set())
+        self.assertEqual(sorted(names), sorted([".", ".."] + [f"top-{index}" for index in range(20)]))
+        self.assertEqual(attrs.st_size, 1)
+        self.assertLess(first_answers, 1)
+        self.assertTrue(engine.ready.wait(10))
+        self.assertTrue(engine.folders_listed.is_set())
+        self.assertEqual(fs.getattr("/top-19/sub-4/file-0.txt").st_size, 1)
+        self.assertEqual(fs.getattr("/top-19/missing.txt"), -errno.ENOENT)
+
+    def test_background_threads_start_even_when_the_first_crawl_fails(self):
+        session = FakeICloudSession()
+        session.add_folder(ROOT_DRIVEWSID, "docs")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan = Mock(side_effect=RuntimeError("crawl failed"))
+
+        engine.start()
+
+        self.assertTrue(engine.ready.wait(5))
+        self.assertEqual(
+            sorted(thread.name for thread in engine.threads), ["icloud-refresh", "icloud-startup", "icloud-upload"]
+        )
+        self.assertFalse(engine.folders_listed.is_set())
+        self.assertEqual([entry.name for entry in self.make_fs(engine).readdir("/", 0)], [".", "..", "docs"])
+
+    def test_on_demand_listing_shortcuts_are_bounded(self):
+        session = FakeICloudSession()
+        build_fake_tree(session, folders=6, subfolders=0)
+        engine = self.make_engine(session, warmup_mode="lazy")
+
+        with patch("driver.LISTED_FOLDERS_LIMIT", 3):
+            for index in range(6):
+                engine.ensure_listed(f"/top-{index}")
+
+        self.assertEqual(list(engine.listed_folders), ["/top-3", "/top-4", "/top-5"])
+        self.assertIsNotNone(self.state.get_folder_refresh("/top-0")["last_listed_at"])
+
+    def test_readdir_includes_files_reconciliation_has_not_restored(self):
+        session = FakeICloudSession()
+        session.add_file(session.add_folder(ROOT_DRIVEWSID, "docs"), "a.txt", b"a")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        self.mirror.remove_tree("/docs")
+        fresh = self.make_engine(session, warmup_mode="lazy")
+
+        names = [entry.name for entry in self.make_fs(fresh).readdir("/docs", 0)]
+
+        self.assertEqual(names, [".", "..", "a.txt"])
+
+    def test_reconciled_rows_changed_meanwhile_are_left_alone(self):
+        self.state.upsert_entry(
+            {"path": "/a.txt", "type": "file", "parent_path": "/", "size": 1, "hydrated": True, "synced_path": "/a.txt"}
+        )
+        snapshot = self.state.get_entry("/a.txt")
+        self.state.mark_dirty("/a.txt", size=5, local_sha256="written")
+
+        updated = self.state.update_reconciled([({**snapshot, "size": 1, "local_sha256": "stale"}, snapshot)])
+
+        self.assertEqual(updated, 0)
+        entry = self.state.get_entry("/a.txt")
+        self.assertEqual((entry["size"], entry["local_sha256"], entry["dirty"]), (5, "written", 1))
+
+
+class WarmupOrderTests(FakeDriveTestCase):
+    def warmup_order(self, order):
+        session = FakeICloudSession()
+        archive = session.add_folder(ROOT_DRIVEWSID, "Archive")
+        old = session.add_folder(archive, "2019")
+        for name, size, modified in [
+            ("big.iso", 4000, "2019-03-01T00:00:00Z"),
+            ("notes.txt", 10, "2019-03-02T00:00:00Z"),
+        ]:
+            session.nodes[session.add_file(old, name, b"a" * size)]["dateModified"] = modified
+        work = session.add_folder(ROOT_DRIVEWSID, "Work")
+        session.nodes[session.add_file(work, "plan.doc", b"b" * 300)]["dateModified"] = "2026-10-01T00:00:00Z"
+        session.nodes[session.add_file(ROOT_DRIVEWSID, "todo.txt", b"c" * 50)]["dateModified"] = "2025-01-01T00:00:00Z"
+        self.state = SyncState(os.path.join(self.root, f"state-{order}.sqlite3"))
+        self.mirror = LocalMirror(os.path.join(self.root, f"cache-{order}"))
+        logger = Mock()
+        engine = ICloudSyncEngine(session.api(), self.mirror, self.state, logger, warmup_order=order)
+        self.engines.append(engine)
+        hydrated = []
+        ensure_local_file = engine.ensure_local_file
+        engine.ensure_local_file = lambda path, priority: (hydrated.append(path), ensure_local_file(path, priority))
+        engine.initial_scan()
+        self.assertEqual(hydrated, [])
+        engine._schedule_all_unhydrated()
+        started_at = time.monotonic()
+        while (
+            self.state.list_unhydrated_paths() or engine.hydration_completed < engine.hydration_total
+        ) and time.monotonic() - started_at < 5:
+            time.sleep(0.01)
+        return hydrated, logger
+
+    def test_orders_hydrate_working_set_first(self):
+        expected = {
+            "path": ["/Archive/2019/big.iso", "/Archive/2019/notes.txt", "/Work/plan.doc", "/todo.txt"],
+            "smallest": ["/Archive/2019/notes.txt", "/todo.txt", "/Work/plan.doc", "/Archive/2019/big.iso"],
+            "recent": ["/Work/plan.doc", "/todo.txt", "/Archive/2019/notes.txt", "/Archive/2019/big.iso"],
+            "shallowest": ["/todo.txt", "/Work/plan.doc", "/Archive/2019/big.iso", "/Archive/2019/notes.txt"],
+        }
+        for order, paths in expected.items():
+            with self.subTest(order=order):
+                hydrated, _ = self.warmup_order(order)
+                self.assertEqual(hydrated, paths)
+
+    def test_orders_use_partial_indexes(self):
+        for order, clause in WARMUP_ORDERS.items():
+            plan = self.state.conn.execute(
+                "EXPLAIN QUERY PLAN SELECT path, size FROM entries "
+                f"WHERE type = 'file' AND tombstone = 0 AND hydrated = 0 ORDER BY {clause}"
+            ).fetchall()
+            self.assertIn(f"idx_entries_warmup_{order}", plan[0]["detail"])
+
+    def test_progress_reports_bytes(self):
+        _, logger = self.warmup_order("smallest")
+
+        messages = [call.args[0] % call.args[1:] for call in logger.info.call_args_list]
+        self.assertIn("Background cache warmup progress: 4/4 files, 4360/4360 bytes hydrated", messages)
+
+
+class BoundedStateTests(FakeDriveTestCase):
+    def failed_warmups(self, names):
+        session = FakeICloudSession()
+        docs = session.add_folder(ROOT_DRIVEWSID, "docs")
+        for name in names:
+            session.add_file(docs, name, b"content")
+        engine = self.make_engine(session, warmup_mode="lazy")
+        engine.initial_scan()
+        engine._retry_delay_for_attempt = lambda attempt: 3600
+        with patch.object(engine, "ensure_local_file", side_effect=RuntimeError("outage")):
+            for name in names:
+                engine._download_job(f"/docs/{name}")
+        self.assertEqual(len(engine.retry_scheduler), len(names))
+        return engine, self.make_fs(engine)
+
+    def test_pending_retries_follow_hydration_removal_and_rename(self):
+        engine, fs = self.failed_warmups(["opened.txt", "removed.txt", "moved.txt"])
+
+        engine.ensure_local_file("/docs/opened.txt")
+        fs.unlink("/docs/removed.txt")
+        fs.rename("/docs", "/archive")
+
+        self.assertEqual(engine.retry_scheduler.keys(), ["/archive/moved.txt"])
+        self.assertEqual(engine.scheduled_downloads, {"/archive/moved.txt"})
+        self.assertEqual(engine.retry_scheduler.pop("/archive/moved.txt")[1], 1)
+
+    def test_removed_folder_drops_retries_below_it(self):
+        engine, fs = self.failed_warmups(["a.txt", "b.txt"])
+
+        engine._apply_remote_deletion(self.state.get_entry("/docs"))
+
+        self.assertEqual(len(engine.retry_scheduler), 0)
+        self.assertEqual(engine.scheduled_downloads, set())
+
+    def test_backoff_grows_for_every_failing_path(self):
+        names = [f"file-{index}.txt" for index in range(5)]
+        engine, _ = self.failed_warmups(names)
+        del engine._retry_delay_for_attempt
+        delays = {f"/docs/{name}": [] for name in names}
+        schedule = engine.retry_scheduler.schedule
+
+        def record(key, delay_seconds, callback, data=None):
+            delays[key].append(delay_seconds)
+            return schedule(key, 3600, callback, data)
+
+        with patch.object(engine.retry_scheduler, "schedule", side_effect=record), patch.object(
+            engine, "ensure_local_file", side_effect=RuntimeError("outage")
+        ):
+            for _ in range(4):
+                for path in delays:
+                    _, attempt = engine.retry_scheduler.pop(path)
+                    engine._download_job(path, attempt)
+
+        self.assertEqual(delays, {path: [10, 20, 40, 80] for path in delays})
+        self.assertEqual(len(engine.retry_scheduler), len(names))
+
+    def test_path_locks_are_released_when_idle(self):
+        engine = self.make_engine(FakeICloudSession(), warmup_mode="lazy")
+        inside = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with engine._path_lock("/a.txt"):
+                inside.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        inside.wait(5)
+        self.assertEqual(len(engine.path_locks), 1)
+        release.set()
+        holder.join(5)
+
+        self.assertEqual(engine.path_locks, {})
+
+    def test_long_run_keeps_lock_and_retry_memory_flat(self):
+        # Measured with tracemalloc rather than process RSS, which the allocator keeps
+        # high after frees and which would make this flaky; tracemalloc sees exactly
+        # the Python objects the lock and retry tables keep alive.
+        session = FakeICloudSession()
+        for index in range(250):
+            session.add_file(ROOT_DRIVEWSID, f"file-{index}.bin", b"x")
+        logger = logging.getLogger("icloud-linux-test")
+        logger.disabled = True
+        engine = ICloudSyncEngine(
+            session.api(), self.mirror, self.state, logger, warmup_mode="lazy", node_cache_size=16
+        )
+        self.engines.append(engine)
+        engine.initial_scan()
+        engine._retry_delay_for_attempt = lambda attempt: 3600
+        ensure_local_file = engine.ensure_local_file
+
+        def outage(path, priority="interactive"):
+            raise RuntimeError("outage")
+
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        sizes = []
+        for round_index in range(5):
+            for index in range(round_index * 50, round_index * 50 + 50):
+                ensure_local_file(f"/file-{index}.bin")
+            for index in range(10000):
+                with engine._path_lock(f"/round-{round_index}/path-{index}"):
+                    pass
+            engine.ensure_local_file = outage
+            for index in range(200):
+                engine._download_job(f"/missing-{index}.bin")
+            engine.ensure_local_file = ensure_local_file
+            sizes.append(tracemalloc.get_traced_memory()[0])
+
+        self.assertEqual(self.state.list_unhydrated_paths(), [])
+        self.assertEqual(engine.path_locks, {})
+        self.assertEqual(len(engine.retry_scheduler), 200)
+        self.assertLess(len(engine.retry_scheduler.heap), 2 * 200 + 64)
+        self.assertLess(sizes[-1] - sizes[0], 256 * 1024)
+
+
+class SelectiveSyncTests(FakeDriveTestCase):
+    def test_rules_match_globs_subtrees_and_size_cap(self):
+        rules = WarmupRules(["/Work", "/Photos/**/*.jpg"], ["*.iso", "**/node_modules"], max_file_size=1000)
+
+        self.assertTrue(rules.wants("/Work/plan.doc", 10))
+        self.assertTrue(rules.wants("/Work/a/b/c.txt", 10))
+        self.assertTrue(rules.wants("/Photos/2024/05/beach.jpg", 10))
+        self.assertTrue(rules.wants("/Photos/top.jpg", 10))
+        self.assertFalse(rules.wants("/Photos/2024/raw.cr2", 10))
+        self.assertFalse(rules.wants("/Workshop/notes.txt", 10))
+        self.assertFalse(rules.wants("/Work/disk.iso", 10))
+        self.assertFalse(rules.wants("/Work/app/node_modules/lib/index.js", 10))
+        self.assertFalse(rules.wants("/Work/video.mov", 1001))
+        self.assertTrue(WarmupRules().wants("/anything/at/all.bin", 10**12))
+
+    def test_excluded_files_stay_placeholders_until_opened(self):
+        session = FakeICloudSession()
+        archive = session.add_folder(ROOT_DRIVEWSID, "Archive")
+        session.add_file(archive, "old.txt", b"old")
+        work = session.add_folder(ROOT_DRIVEWSID, "Work")
+        session.add_file(work, "plan.txt", b"plan")
+        session.add_file(work, "movie.mov", b"m" * 500)
+        engine = self.make_engine(session, warmup_exclude=["/Archive"], warmup_max_file_size=100)
+        engine.initial_scan()
+        engine._schedule_all_unhydrated()
+        engine.executor.shutdown(wait=True)
+
+        self.assertEqual(self.state.list_unhydrated_paths(), ["/Archive/old.txt", "/Work/movie.mov"])
+        engine.ensure_local_file("/Archive/old.txt")
+        self.assertEqual(self.mirror.read("/Archive/old.txt", 10, 0), b"old")
+
+    def test_refresh_applies_rules_to_new_remote_files(self):
+        session = FakeICloudSession()
+        archive = session.add_folder(ROOT_DRIVEWSID, "Archive")
+        work = session.add_folder(ROOT_DRIVEWSID, "Work")
+        engine = self.make_engine(session, warmup_exclude=["/Archive"])
+        engine.initial_scan()
+        engine._schedule_download = Mock()
+        session.add_file(archive, "new-old.txt", b"old")
+        session.add_file(work, "new-plan.txt", b"plan")
+
+        engine._crawl_remote_snapshot()
+        engine._apply_remote_snapshot()
+
+        engine._schedule_download.assert_called_once_with("/Work/new-plan.txt")
+
+
+class BandwidthLimitTests(FakeDriveTestCase):
+    RATE = 512 * 1024
+    SIZE = 384 * 1024
+
+    def expected_seconds(self):
+        # The bucket starts with a quarter second of burst.
+        return (self.SIZE - self.RATE * TokenBucket.BURST_SECONDS) / self.RATE
+
+    def timed_download(self, priority, **options):
+        session = FakeICloudSession()
+        session.add_file(ROOT_DRIVEWSID, "large.bin", os.urandom(self.SIZE))
+        self.state = SyncState(os.path.join(self.root, f"state-{len(self.engines)}.sqlite3"))
+        self.mirror = LocalMirror(os.path.join(self.root, f"cache-{len(self.engines)}"))
+        engine = self.make_engine(session, warmup_mode="lazy", download_bytes_per_second=self.RATE, **options)
+        engine.initial_scan()
+        started_at = time.monotonic()
+        engine.ensure_local_file("/large.bin", priority=priority)
+        elapsed = time.monotonic() - started_at
+        self.assertTrue(self.state.get_entry("/large.bin")["hydrated"])
+        return engine, elapsed
+
+    def test_warmup_download_throughput_is_capped(self):
+        engine, elapsed = self.timed_download("warmup")
+
+        self.assertGreaterEqual(elapsed, self.expected_seconds() * 0.95)
+        self.assertLess(elapsed, self.expected_seconds() + 0.5)
+
+    def test_interactive_download_is_exempt_unless_configured(self):
+        engine, exempt_elapsed = self.timed_download("interactive")
+        engine, throttled_elapsed = self.timed_download("interactive", throttle_interactive_downloads=True)
+
+        self.assertLess(exempt_elapsed, self.expected_seconds() / 2)
+        self.assertGreaterEqual(throttled_elapsed, self.expected_seconds() * 0.95)
+
+    def test_throttled_download_streams_without_holding_a_broker_slot(self):
+        session = FakeICloudSession()
+        session.add_file(ROOT_DRIVEWSID, "large.bin", os.urandom(self.SIZE))
+        engine = self.make_engine(
+            session,
+            warmup_mode="lazy",
+            download_bytes_per_second=self.RATE,
+            request_concurrency_initial=1,
+            request_concurrency_max=1,
+        )
+        engine.initial_scan()
+        download = threading.Thread(target=engine.ensure_local_file, args=("/large.bin", "warmup"))
+        download.start()
+        while not session.download_ranges:
+            time.sleep(0.005)
+        started_at = time.monotonic()
+        with engine.broker.slot("interactive"):
+            waited = time.monotonic() - started_at
+        download.join()
+
+        self.assertTrue(self.state.get_entry("/large.bin")["hydrated"])
+        self.assertLess(waited, self.expected_seconds() / 2)
+
+    def test_throttled_download_keeps_its_session_without_blocking_opens(self):
+        backend = FakeICloudSession()
+        backend.add_file(ROOT_DRIVEWSID, "large.bin", os.urandom(self.SIZE))
+        backend.add_file(ROOT_DRIVEWSID, "small.txt", b"opened")
+        engine = self.make_engine(
+            backend,
+            warmup_mode="lazy",
+            download_bytes_per_second=self.RATE,
+            transfer_sessions=[ExclusiveSession(backend, latency=0).api() for _ in range(2)],
+        )
+        engine.initial_scan()
+        download = threading.Thread(target=engine.ensure_local_file, args=("/large.bin", "warmup"))
+        download.start()
+        while not backend.download_ranges:
+            time.sleep(0.005)
+        started_at = time.monotonic()
+        engine.ensure_local_file("/small.txt")
+        elapsed = time.monotonic() - started_at
+        download.join()
+
+        self.assertEqual(self.mirror.read("/small.txt", 100, 0), b"opened")
+        self.assertLess(elapsed, self.expected_seconds() / 2)
+
+    def test_single_session_is_held_until_the_download_body_is_read(self):
+        backend = FakeICloudSession()
+        backend.add_file(ROOT_DRIVEWSID, "large.bin", os.urandom(self.SIZE))
+        backend.add_file(ROOT_DRIVEWSID, "small.txt", b"opened")
+        engine = self.make_engine(
+            backend,
+            warmup_mode="lazy",
+            download_bytes_per_second=self.RATE,
+            transfer_sessions=[ExclusiveSession(backend, latency=0).api()],
+        )
+        engine.initial_scan()
+        download = threading.Thread(target=engine.ensure_local_file, args=("/large.bin", "warmup"))
+        download.start()
+        while not backend.download_ranges:
+            time.sleep(0.005)
+        engine.ensure_local_file("/small.txt")
+        download.join()
+
+        self.assertEqual(self.mirror.read("/small.txt", 100, 0), b"opened")
+        self.assertTrue(self.state.get_entry("/large.bin")["hydrated"])
+
+    def test_throttled_uploads_do_not_block_interactive_opens(self):
+        backend = FakeICloudSession()
+        backend.add_file(ROOT_DRIVEWSID, "small.txt", b"opened")
+        engine = self.make_engine(
+            backend,
+            warmup_mode="lazy",
+            upload_bytes_per_second=self.RATE,
+            upload_workers=2,
+            transfer_sessions=[ExclusiveSession(backend, latency=0).api() for _ in range(2)],
+        )
+        engine.initial_scan()
+        fs = self.make_fs(engine)
+        for name in ("first.bin", "second.bin"):
+            fs.create(f"/{name}", 0o644)
+            fs.write(f"/{name}", os.urandom(self.SIZE), 0)
+        upload = threading.Thread(target=engine.sync_dirty_entries)
+        upload.start()
+        while not backend.count("content"):
+            time.sleep(0.005)
+        started_at = time.monotonic()
+        engine.ensure_local_file("/small.txt")
+        elapsed = time.monotonic() - started_at
+        upload.join()
+
+        self.assertEqual(self.mirror.read("/small.txt", 100, 0), b"opened")
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertLess(elapsed, self.expected_seconds() / 2)
+
+    def test_upload_throughput_is_capped_and_adjustable_at_runtime(self):
+        session = FakeICloudSession()
+        engine = self.make_engine(session, warmup_mode="lazy", upload_bytes_per_second=self.RATE)
+        fs = self.make_fs(engine)
+        fs.create("/first.bin", 0o644)
+        fs.write("/first.bin", os.urandom(self.SIZE), 0)
+        started_at = time.monotonic()
+        engine.sync_dirty_entries()
+        throttled_elapsed = time.monotonic() - started_at
+
+        engine.set_bandwidth_limits(0, 0, False)
+        fs.create("/second.bin", 0o644)
+        fs.write("/second.bin", os.urandom(self.SIZE), 0)
+        started_at = time.monotonic()
+        engine.sync_dirty_entries()
+        unlimited_elapsed = time.monotonic() - started_at
+
+        self.assertEqual(self.state.list_dirty_entries(), [])
+        self.assertEqual(session.find("/first.bin")["size"], self.SIZE)
+        self.assertGreaterEqual(throttled_elapsed, self.expected_seconds() * 0.95)
+        self.assertLess(unlimited_elapsed, self.expected_seconds() / 2)
+
+
+class UploadTriggerTests(FakeDriveTestCase):
+    def start_upload_loop(self, engine):
+        thread = threading.Thread(target=engine._upload_loop, daemon=True)
+        engine.threads.append(thread)
+        thread.start()
+        time.sleep(0.1)
+
+    def wait_for(self, predicate, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def test_upload_waits_for_writes_to_go_quiet(self):
+        session = FakeICloudSession()
+        engine = self.make_engine(session, warmup_mode="lazy", upload_debounce_seconds=0.3)
+        fs = self.make_fs(engine)
+        self.start_upload_loop(engine)
+
+        fs.create("/notes.txt", 0o644)
+        for index in range(5):
+            fs.write("/notes.txt", b"x" * 10, index * 10)
+            time.sleep(0.1)
+
+        self.assertEqual(session.count("documents"), 0)
+        self.assertTrue(self.wait_for(lambda: not self.state.has_dirty_entries()))
+        self.assertEqual(session.count("documents"), 1)
+        self.assertEqual(session.find("/notes.txt")["size"], 50)
+
+    def test_release_uploads_immediately_and_idle_loop_does_not_poll(self):
+        session = FakeICloudSession()
+        engine = self.make_engine(session, warmup_mode="lazy", upload_debounce_seconds=60)
+        fs = self.make_fs(engine)
+        self.start_upload_loop(engine)
+        scans = []
+        list_dirty_entries = self.state.list_dirty_entries
+        self.state.list_dirty_entries = lambda: (scans.append(1), list_dirty_entries())[1]
+
+        fs.create("/notes.txt", 0o644)
+        fs.write("/notes.txt", b"saved", 0)
+        fs.release("/notes.txt", 0)
+
+        self.assertTrue(self.wait_for(lambda: not self.state.has_dirty_entries()))
+        self.assertEqual(session.count("documents"), 1)
+        settled_scans = len(scans)
+        time.sleep(0.3)
+        self.assertEqual(len(scans), settled_scans)
+
+
 if __name__ == "__main__":
     unittest.main()